@@ -1,52 +1,146 @@
 import sqlite3
 import os
+import io
 import json
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, g, redirect, url_for, flash, session
+import re
+import sys
+import shutil
+import bisect
+import time
+import itertools
+import collections
+import threading
+import contextlib
+import click
+from datetime import date, datetime, timedelta, timezone
+from flask import Flask, render_template, request, jsonify, g, redirect, url_for, flash, session, send_from_directory
+from flask.sessions import SecureCookieSessionInterface
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, render_template, request, jsonify, g, redirect, url_for, flash, session
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from authlib.integrations.flask_client import OAuth
-from dotenv import load_dotenv
 
-# Load environment variables from .env file if present
-load_dotenv()
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IS_VERCEL = os.environ.get('VERCEL') == '1' or bool(os.environ.get('VERCEL_ENV'))
 
-# --- Google Gemini AI ---
-import urllib.request
-import urllib.error
+# Load environment variables from .env file if present. python-dotenv is only
+# imported when there is a file to read, so serverless cold starts skip it.
+if os.path.exists(os.path.join(BASE_DIR, '.env')):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(BASE_DIR, '.env'))
 
 app = Flask(__name__)
 # Try to securely load the secret key, otherwise fallback for local dev
 app.secret_key = os.environ.get('SECRET_KEY', 'dev_super_secret_key_12345')
 
 # --- OAuth Setup ---
-oauth = OAuth(app)
-google = oauth.register(
-    name='google',
-    client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-    client_secret=os.environ.get('GOOGLE_CLIENT_SECRET'),
-    access_token_url='https://accounts.google.com/o/oauth2/token',
-    access_token_params=None,
-    authorize_url='https://accounts.google.com/o/oauth2/auth',
-    authorize_params=None,
-    api_base_url='https://www.googleapis.com/oauth2/v1/',
-    client_kwargs={'scope': 'openid email profile'},
-)
+# Authlib pulls in joserfc, requests and certifi (~100ms of imports), so the
+# Google client is only built the first time someone actually uses it.
+_google_client = None
+
+def get_google():
+    global _google_client
+    if _google_client is None:
+        from authlib.integrations.flask_client import OAuth
+        oauth = OAuth(app)
+        _google_client = oauth.register(
+            name='google',
+            client_id=os.environ.get('GOOGLE_CLIENT_ID'),
+            client_secret=os.environ.get('GOOGLE_CLIENT_SECRET'),
+            access_token_url='https://accounts.google.com/o/oauth2/token',
+            access_token_params=None,
+            authorize_url='https://accounts.google.com/o/oauth2/auth',
+            authorize_params=None,
+            api_base_url='https://www.googleapis.com/oauth2/v1/',
+            client_kwargs={'scope': 'openid email profile'},
+        )
+    return _google_client
 
 # Use /tmp for database on Vercel deployment, otherwise local directory
-if os.environ.get('VERCEL') == '1' or os.environ.get('VERCEL_ENV'):
+if IS_VERCEL:
     DATABASE = '/tmp/study_planner.db'
 else:
-    DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'study_planner.db')
+    DATABASE = os.path.join(BASE_DIR, 'study_planner.db')
 
 # --- Groq AI Configuration (Open Source LLaMA) ---
 GROQ_API_KEY = os.environ.get('GROQ_API_KEY', '')
 ai_client_active = True if GROQ_API_KEY else False
-
-def call_groq_rest(prompt, model_name='llama3-8b-8192'):
+# Seconds to wait on Groq before treating the call as failed
+GROQ_TIMEOUT = float(os.environ.get('GROQ_TIMEOUT', 10))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that the breaker has cut off."""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after `threshold` consecutive failures.
+
+    While open every call is refused at once; after `cooldown` seconds a single
+    trial call is let through (half-open) and its outcome closes or reopens it.
+    State is per worker.
+    """
+
+    def __init__(self, threshold=3, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self.last_error = None
+
+    def is_open(self):
+        """True while calls would be refused: cooling down, or a trial call is running."""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            return self._trial or time.monotonic() - self.opened_at < self.cooldown
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial or time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError('upstream circuit open')
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = f'{type(error).__name__}: {error}'
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+    def snapshot(self):
+        with self._lock:
+            if self.opened_at is None:
+                state, retry_in = 'closed', 0.0
+            elif self._trial:
+                state, retry_in = 'half_open', 0.0
+            else:
+                retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+                state = 'open' if retry_in else 'half_open'
+            return {'state': state, 'failures': self.failures, 'retry_in': round(retry_in, 1),
+                    'last_error': self.last_error}
+
+
+groq_breaker = CircuitBreaker(threshold=int(os.environ.get('GROQ_BREAKER_THRESHOLD', 3)),
+                              cooldown=float(os.environ.get('GROQ_BREAKER_COOLDOWN', 30)))
+
+
+def call_groq_rest(prompt, model_name='llama3-8b-8192', kind='other'):
+    # urllib.request drags in http.client/email/ssl; only pay for it on AI calls
+    import urllib.request
+    import urllib.error
+
+    groq_breaker.before_call()
+    record_prompt(kind, prompt)
     url = "https://api.groq.com/openai/v1/chat/completions"
     data = json.dumps({
         "model": model_name,
@@ -60,9 +154,46 @@ def call_groq_rest(prompt, model_name='llama3-8b-8192'):
         'User-Agent': 'SmartStudyPlanner/1.0'
     })
     
-    with urllib.request.urlopen(req) as response:
-        result = json.loads(response.read().decode())
-        return result['choices'][0]['message']['content'].strip()
+    try:
+        with urllib.request.urlopen(req, timeout=GROQ_TIMEOUT) as response:
+            result = json.loads(response.read().decode())
+    except urllib.error.HTTPError as e:
+        # A 4xx is a problem with our request, not an outage; 429 and 5xx are
+        if e.code == 429 or e.code >= 500:
+            groq_breaker.record_failure(e)
+        else:
+            groq_breaker.record_success()
+        raise
+    except Exception as e: # timeouts, refused connections, unreadable bodies
+        groq_breaker.record_failure(e)
+        raise
+    groq_breaker.record_success()
+    record_usage(kind, result.get('usage') or {})
+    return result['choices'][0]['message']['content'].strip()
+
+
+# Prompt size per call kind: our own estimate before sending, and the
+# provider's reported usage afterwards. Served by /api/ai/metrics.
+_ai_metrics_lock = threading.Lock()
+AI_METRICS = {}
+
+def _metrics_for(kind):
+    return AI_METRICS.setdefault(kind, {'calls': 0, 'prompt_tokens_est': 0, 'max_prompt_tokens_est': 0,
+                                        'prompt_tokens': 0, 'completion_tokens': 0})
+
+def record_prompt(kind, prompt):
+    tokens = estimate_tokens(prompt)
+    with _ai_metrics_lock:
+        m = _metrics_for(kind)
+        m['calls'] += 1
+        m['prompt_tokens_est'] += tokens
+        m['max_prompt_tokens_est'] = max(m['max_prompt_tokens_est'], tokens)
+
+def record_usage(kind, usage):
+    with _ai_metrics_lock:
+        m = _metrics_for(kind)
+        m['prompt_tokens'] += usage.get('prompt_tokens', 0)
+        m['completion_tokens'] += usage.get('completion_tokens', 0)
 
 
 # --- Authentication Setup ---
@@ -81,7 +212,7 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    db = get_db()
+    db = get_global_db()
     user_data = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
     if user_data:
         return User(user_data['id'], user_data['email'], user_data['name'], user_data['password_hash'], user_data['google_id'])
@@ -89,39 +220,304 @@ def load_user(user_id):
 
 # ===================== DATABASE =====================
 
+# Databases already checked by this process; avoids re-reading user_version
+# on every request once a worker is warm.
+_schema_ready = set()
+
+
+def ensure_schema(db, path=None):
+    """Apply pending migrations only if the database is older than SCHEMA_VERSION."""
+    path = path or DATABASE
+    if path in _schema_ready:
+        return
+    # PRAGMA user_version mirrors the newest applied migration, so the warm
+    # path is a single header read instead of a schema_version query
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    if version < SCHEMA_VERSION:
+        migrate_db(db)
+    # journal_mode is persistent, so it only needs setting once per process.
+    # Avoid WAL mode on Vercel as it can cause issues in /tmp
+    if not IS_VERCEL:
+        db.execute("PRAGMA journal_mode=WAL")
+    _schema_ready.add(path)
+
+
+def connect_db(path, check_same_thread=True):
+    db = sqlite3.connect(path, check_same_thread=check_same_thread)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA foreign_keys=ON")
+
+    # Creates the schema on a fresh DB (common on Vercel cold starts) and
+    # is a no-op once this process has seen the current version
+    ensure_schema(db, path)
+    return db
+
+
+# --- Connection pool ---
+# Main-DB connections kept open between requests, so a warm worker skips the
+# connect and keeps its page cache. The production server (`serve`) turns it
+# on; 0 keeps the dev server's connection-per-request behaviour.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+
+
+class ConnectionPool:
+    """Process-local pool of main-DB connections, each lent to one request at a time.
+
+    Requests can land on any thread, so connections are opened with
+    check_same_thread=False; the pool makes sure only one thread holds each.
+    SQLite handles must not cross a fork, so a pool inherited by a child
+    process starts over empty.
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._idle = collections.deque() # popped from the right: warmest page cache first
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            self._pid, self._idle = os.getpid(), collections.deque()
+        try:
+            return self._idle.pop()
+        except IndexError:
+            return connect_db(DATABASE, check_same_thread=False)
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        if self._pid == os.getpid() and len(self._idle) < DB_POOL_SIZE:
+            self._idle.append(db)
+        else:
+            db.close()
+
+    def warm(self):
+        """Open every pooled connection up front and read the schema into each."""
+        conns = [self.acquire() for _ in range(DB_POOL_SIZE)]
+        for db in conns:
+            db.execute('SELECT COUNT(*) FROM sqlite_schema').fetchone()
+            self.release(db)
+
+
+main_pool = ConnectionPool()
+
+
+def open_main_db():
+    """Main-DB connection for this request: from the pool when enabled, else a fresh one."""
+    if DB_POOL_SIZE:
+        g.main_pooled = True
+        return main_pool.acquire()
+    return connect_db(DATABASE)
+
+
+def release_main_db(db):
+    if g.pop('main_pooled', False):
+        main_pool.release(db)
+    else:
+        db.close()
+
+
+# --- Sharding ---
+# DB_SHARDS=N keeps each user's data in shards/shard-<user_id % N>.db while the
+# main DATABASE stays the source of truth for users/auth and the user_shards
+# map. Users without a map entry (everyone from before sharding was switched
+# on) keep living in the main DB until `flask db rebalance` moves them.
+DB_SHARDS = int(os.environ.get('DB_SHARDS', 0))
+SHARD_DIR = os.environ.get('SHARD_DIR') # defaults to shards/ next to DATABASE
+# Idle connections kept per shard between requests
+SHARD_POOL_SIZE = int(os.environ.get('SHARD_POOL_SIZE', 8))
+# Each shard hands out row ids from its own range so rows can move between shards
+SHARD_ID_SPAN = 1 << 40
+# Per-user tables in foreign-key order (parents first)
+SHARDED_TABLES = ('user_profile', 'subjects', 'tasks', 'study_sessions', 'goals', 'notes', 'note_reviews',
+                  'planner_blocks', 'suggestion_cache', 'ai_suggestion_cache', 'sync_tombstones',
+                  'session_rollups', 'session_slot_rollups', 'study_sessions_archive')
+# Columns that hold another sharded table's id, rewritten when a move renumbers rows
+SHARD_ID_REFS = {'subject_id': 'subjects', 'note_id': 'notes'}
+# Tables whose ids are allocated from another table's counter
+SHARD_ID_COUNTERS = {'study_sessions_archive': 'study_sessions'}
+
+
+def shard_path(shard):
+    """File for a shard index; None is the main DATABASE."""
+    if shard is None:
+        return DATABASE
+    return os.path.join(SHARD_DIR or os.path.join(os.path.dirname(DATABASE), 'shards'), f'shard-{shard:03d}.db')
+
+
+def shard_id_range(shard):
+    """[start, end) of the row ids a shard (None = main DB) allocates itself."""
+    start = 0 if shard is None else (shard + 1) * SHARD_ID_SPAN
+    return start, start + SHARD_ID_SPAN
+
+
+def open_shard(shard, check_same_thread=True):
+    path = shard_path(shard)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = connect_db(path, check_same_thread=check_same_thread)
+    # Seeds the id range once, for tables that have never allocated an id. The
+    # check is a plain read, so opening a shard never waits on its writers.
+    seeded = {r[0] for r in db.execute('SELECT name FROM sqlite_sequence')}
+    missing = [t for t in SHARDED_TABLES if t not in seeded]
+    if missing:
+        start = shard_id_range(shard)[0]
+        db.executemany('INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? '
+                       'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)',
+                       [(table, start, table) for table in missing])
+        db.commit()
+    return db
+
+
+class ShardPool:
+    """Process-local pools of shard connections keyed by shard index.
+
+    Same lending rules as ConnectionPool: any thread may borrow a connection,
+    one request holds it at a time, and a forked child starts over empty. Up
+    to `size` idle connections are kept per shard.
+    """
+
+    def __init__(self, size=SHARD_POOL_SIZE):
+        self.size = size
+        self._pid = os.getpid()
+        self._idle = {}
+
+    def acquire(self, shard):
+        if self._pid != os.getpid():
+            self._pid, self._idle = os.getpid(), {}
+        try:
+            return self._idle.setdefault(shard, collections.deque()).pop()
+        except IndexError:
+            return open_shard(shard, check_same_thread=False)
+
+    def release(self, shard, db):
+        if db.in_transaction:
+            db.rollback()
+        idle = self._idle.setdefault(shard, collections.deque())
+        if self._pid == os.getpid() and len(idle) < self.size:
+            idle.append(db)
+        else:
+            db.close()
+
+
+shard_pool = ShardPool()
+
+
+def user_shard(db, user_id):
+    """Shard index holding a user's data, or None for the main DB."""
+    if not DB_SHARDS:
+        return None
+    row = db.execute('SELECT shard FROM user_shards WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def get_global_db():
+    """Main database: users, auth and the shard map. Same connection as get_db() when unsharded."""
+    if not DB_SHARDS:
+        return get_db()
+    if 'global_db' not in g:
+        g.global_db = open_main_db()
+    return g.global_db
+
+
 def get_db():
+    """The current user's database: their shard when sharding is on, else the main DB."""
     if 'db' not in g:
-        db_exists = os.path.exists(DATABASE)
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
-        
-        # Avoid WAL mode on Vercel as it can cause issues in /tmp
-        if not (os.environ.get('VERCEL') == '1' or os.environ.get('VERCEL_ENV')):
-            g.db.execute("PRAGMA journal_mode=WAL")
-            
-        g.db.execute("PRAGMA foreign_keys=ON")
-        
-        # If the DB was just created (common on Vercel cold starts), initialize it
-        if not db_exists:
-            init_db_with_connection(g.db)
-            
+        shard = None
+        if DB_SHARDS and current_user.is_authenticated:
+            shard = user_shard(get_global_db(), current_user.id)
+        if shard is None:
+            g.db = get_global_db() if DB_SHARDS else open_main_db()
+        else:
+            g.db = shard_pool.acquire(shard)
+            g.db_shard = shard
     return g.db
 
 
+def create_user_profile(db, user_id):
+    """Give a new user their profile row, on a shard when sharding is on.
+
+    `db` is the main DB the users row was just inserted into; the caller commits it.
+    """
+    if not DB_SHARDS:
+        db.execute('INSERT INTO user_profile (user_id, xp, level) VALUES (?, 0, 1)', (user_id,))
+        return
+    shard = user_id % DB_SHARDS
+    db.execute('INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)', (user_id, shard))
+    shard_db = shard_pool.acquire(shard)
+    try:
+        # Mirror of the users row so the shard's foreign keys and cascades keep working
+        user = db.execute('SELECT email, name FROM users WHERE id = ?', (user_id,)).fetchone()
+        shard_db.execute('INSERT OR REPLACE INTO users (id, email, name) VALUES (?, ?, ?)', (user_id, user['email'], user['name']))
+        shard_db.execute('INSERT OR IGNORE INTO user_profile (user_id, xp, level) VALUES (?, 0, 1)', (user_id,))
+        shard_db.commit()
+    finally:
+        shard_pool.release(shard, shard_db)
+
+
+def database_paths():
+    """Main DB plus every shard file that exists, for batch jobs that cover all users."""
+    paths = [DATABASE]
+    shard_dir = os.path.dirname(shard_path(0))
+    if os.path.isdir(shard_dir):
+        paths += sorted(os.path.join(shard_dir, f) for f in os.listdir(shard_dir) if re.fullmatch(r'shard-\d+\.db', f))
+    return paths
+
+
 @app.teardown_appcontext
 def close_db(exception):
     db = g.pop('db', None)
-    if db:
-        db.close()
+    global_db = g.pop('global_db', None)
+    shard = g.pop('db_shard', None)
+    if db is not None and shard is not None:
+        shard_pool.release(shard, db)
+    elif db is not None and db is not global_db:
+        release_main_db(db)
+    if global_db is not None:
+        release_main_db(global_db)
 
 
 def init_db():
     db = sqlite3.connect(DATABASE)
-    init_db_with_connection(db)
+    ensure_schema(db)
     db.close()
 
-def init_db_with_connection(db):
-    db.executescript('''
+
+# ===================== MIGRATIONS =====================
+
+# Tables mirrored to offline clients through /api/sync
+SYNC_TABLES = ('subjects', 'tasks', 'notes', 'study_sessions', 'goals', 'planner_blocks')
+
+# Millisecond-precision UTC stamp, so sync tokens rarely tie within a second
+SYNC_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def sync_tracking_sql(table, has_updated_at=False, has_created_at=True):
+    """DDL that stamps updated_at on every write and records deletes as tombstones."""
+    sql = '' if has_updated_at else f'ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP;\n'
+    backfill = f'COALESCE(created_at, {SYNC_NOW})' if has_created_at else SYNC_NOW
+    return sql + f'''
+        UPDATE {table} SET updated_at = {backfill} WHERE updated_at IS NULL;
+        CREATE INDEX IF NOT EXISTS idx_{table}_sync ON {table}(user_id, updated_at);
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_ins AFTER INSERT ON {table} BEGIN
+            UPDATE {table} SET updated_at = {SYNC_NOW} WHERE id = NEW.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_upd AFTER UPDATE ON {table} BEGIN
+            UPDATE {table} SET updated_at = {SYNC_NOW} WHERE id = NEW.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_del AFTER DELETE ON {table} BEGIN
+            INSERT INTO sync_tombstones (user_id, table_name, row_id, deleted_at)
+            VALUES (OLD.user_id, '{table}', OLD.id, {SYNC_NOW});
+        END;
+    '''
+
+
+# Each migration is (version, name, sql). Versions are applied in order, each
+# in its own short transaction, and recorded in the schema_version table.
+# Never edit a migration that has shipped -- append a new one instead.
+#
+# Index migrations use CREATE INDEX IF NOT EXISTS so they are safe to re-run,
+# and rely on WAL mode + busy_timeout so readers keep working while the write
+# lock is held for the build.
+MIGRATIONS = [
+    (1, 'baseline schema', '''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
@@ -203,7 +599,514 @@ def init_db_with_connection(db):
             level INTEGER DEFAULT 1,
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         );
+    '''),
+    (2, 'per-user lookup indexes', '''
+        CREATE INDEX IF NOT EXISTS idx_subjects_user ON subjects(user_id);
+        CREATE INDEX IF NOT EXISTS idx_tasks_user_status ON tasks(user_id, status);
+        CREATE INDEX IF NOT EXISTS idx_tasks_subject ON tasks(subject_id);
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_created ON study_sessions(user_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_sessions_subject ON study_sessions(subject_id);
+        CREATE INDEX IF NOT EXISTS idx_goals_user_status ON goals(user_id, status);
+        CREATE INDEX IF NOT EXISTS idx_notes_user_updated ON notes(user_id, updated_at);
+        CREATE INDEX IF NOT EXISTS idx_planner_user_day ON planner_blocks(user_id, day_of_week, start_hour);
+    '''),
+    (3, 'incremental streak and goal counters', '''
+        ALTER TABLE user_profile ADD COLUMN current_streak INTEGER DEFAULT 0;
+        ALTER TABLE user_profile ADD COLUMN longest_streak INTEGER DEFAULT 0;
+        ALTER TABLE user_profile ADD COLUMN last_study_day TEXT;
+        WITH days AS (
+            SELECT DISTINCT user_id, DATE(created_at) AS d FROM study_sessions
+        ), runs AS (
+            SELECT user_id, MAX(d) AS last_day, COUNT(*) AS len
+            FROM (SELECT user_id, d, julianday(d) - ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY d) AS grp FROM days)
+            GROUP BY user_id, grp
+        )
+        UPDATE user_profile SET
+            longest_streak = COALESCE((SELECT MAX(len) FROM runs WHERE runs.user_id = user_profile.user_id), 0),
+            last_study_day = (SELECT MAX(last_day) FROM runs WHERE runs.user_id = user_profile.user_id),
+            current_streak = COALESCE((SELECT len FROM runs WHERE runs.user_id = user_profile.user_id
+                                       ORDER BY last_day DESC LIMIT 1), 0);
+        UPDATE goals SET current_hours = (
+            SELECT COALESCE(SUM(duration_minutes), 0) / 60.0 FROM study_sessions ss
+            WHERE ss.user_id = goals.user_id AND ss.created_at >= goals.created_at
+        ) WHERE status = 'active' AND current_hours = 0;
+    '''),
+    (4, 'event log for the shared SSE broker', '''
+        CREATE TABLE IF NOT EXISTS event_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_event_log_user ON event_log(user_id, id);
+    '''),
+    (5, 'change tracking for delta sync', '''
+        CREATE TABLE IF NOT EXISTS sync_tombstones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            deleted_at TIMESTAMP NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sync_tombstones_user ON sync_tombstones(user_id, deleted_at);
+    ''' + sync_tracking_sql('subjects')
+         + sync_tracking_sql('tasks')
+         + sync_tracking_sql('notes', has_updated_at=True)
+         + sync_tracking_sql('study_sessions')
+         + sync_tracking_sql('goals')
+         + sync_tracking_sql('planner_blocks', has_created_at=False)),
+    (6, 'mark generated planner blocks', '''
+        ALTER TABLE planner_blocks ADD COLUMN source TEXT DEFAULT 'manual';
+    '''),
+    (7, 'precomputed suggestion cache', '''
+        CREATE TABLE IF NOT EXISTS suggestion_cache (
+            user_id INTEGER PRIMARY KEY,
+            suggestions TEXT NOT NULL,
+            computed_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+    '''),
+    (8, 'spaced-repetition schedule for notes', '''
+        CREATE TABLE IF NOT EXISTS note_reviews (
+            note_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            ease REAL DEFAULT 2.5,
+            interval_days INTEGER DEFAULT 0,
+            repetitions INTEGER DEFAULT 0,
+            due_date TEXT NOT NULL,
+            last_reviewed TIMESTAMP,
+            FOREIGN KEY (note_id) REFERENCES notes(id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_note_reviews_due ON note_reviews(user_id, due_date);
+        INSERT OR IGNORE INTO note_reviews (note_id, user_id, due_date)
+        SELECT id, user_id, DATE(created_at, '+1 day') FROM notes;
+    '''),
+    (9, 'per-user timezone for day bucketing', '''
+        ALTER TABLE user_profile ADD COLUMN timezone TEXT;
+    '''),
+    (10, 'shared AI rate-limit buckets and call slots', '''
+        CREATE TABLE IF NOT EXISTS ai_rate_buckets (
+            user_id INTEGER PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ai_call_slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            expires_at REAL NOT NULL
+        );
+    '''),
+    (11, 'last good AI suggestions per user', '''
+        CREATE TABLE IF NOT EXISTS ai_suggestion_cache (
+            user_id INTEGER PRIMARY KEY,
+            suggestions TEXT NOT NULL,
+            computed_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+    '''),
+    (12, 'user to shard map', '''
+        CREATE TABLE IF NOT EXISTS user_shards (
+            user_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        );
+    '''),
+    (13, 'session rollups and cold archive', '''
+        CREATE TABLE IF NOT EXISTS session_rollups (
+            user_id INTEGER NOT NULL,
+            subject_id INTEGER NOT NULL, -- 0 for sessions without a subject
+            session_type TEXT NOT NULL,
+            sessions INTEGER NOT NULL,
+            minutes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, subject_id, session_type)
+        );
+        CREATE TABLE IF NOT EXISTS session_slot_rollups (
+            user_id INTEGER NOT NULL,
+            slot INTEGER NOT NULL, -- UTC quarter-hour of the day, 0-95
+            minutes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, slot)
+        );
+        CREATE TABLE IF NOT EXISTS study_sessions_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            subject_id INTEGER,
+            duration_minutes INTEGER NOT NULL,
+            session_type TEXT,
+            notes TEXT,
+            created_at TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_archive_user ON study_sessions_archive(user_id, created_at);
+        CREATE VIEW IF NOT EXISTS session_totals AS
+            SELECT user_id, subject_id, session_type, COUNT(*) AS sessions, SUM(duration_minutes) AS minutes
+            FROM study_sessions GROUP BY user_id, subject_id, session_type
+            UNION ALL
+            SELECT user_id, subject_id, session_type, sessions, minutes FROM session_rollups;
+        CREATE VIEW IF NOT EXISTS session_slots AS
+            SELECT user_id, (CAST(strftime('%H', created_at) AS INTEGER) * 60
+                             + CAST(strftime('%M', created_at) AS INTEGER)) / 15 AS slot,
+                   duration_minutes AS minutes
+            FROM study_sessions
+            UNION ALL
+            SELECT user_id, slot, minutes FROM session_slot_rollups;
+        CREATE VIEW IF NOT EXISTS study_sessions_all AS
+            SELECT id, user_id, subject_id, duration_minutes, session_type, notes, created_at FROM study_sessions
+            UNION ALL
+            SELECT id, user_id, subject_id, duration_minutes, session_type, notes, created_at FROM study_sessions_archive;
+    '''),
+    # Archiving files untyped sessions under 'manual'; hot rows must match or
+    # by-type totals change when a session is archived
+    (14, 'session totals treat untyped sessions as manual', '''
+        DROP VIEW IF EXISTS session_totals;
+        CREATE VIEW session_totals AS
+            SELECT user_id, subject_id, COALESCE(session_type, 'manual') AS session_type,
+                   COUNT(*) AS sessions, SUM(duration_minutes) AS minutes
+            FROM study_sessions GROUP BY 1, 2, 3
+            UNION ALL
+            SELECT user_id, subject_id, session_type, sessions, minutes FROM session_rollups;
+    '''),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Milliseconds a migration waits for a busy database before giving up
+MIGRATION_BUSY_TIMEOUT = 30000
+
+
+def split_sql(script):
+    """Split a SQL script into complete statements (trigger bodies stay intact)."""
+    statements = []
+    pending = ''
+    for line in script.splitlines(keepends=True):
+        pending += line
+        if sqlite3.complete_statement(pending):
+            statements.append(pending.strip())
+            pending = ''
+    if pending.strip():
+        statements.append(pending.strip())
+    return statements
+
+
+def applied_migrations(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
     ''')
+    return {row[0] for row in db.execute('SELECT version FROM schema_version')}
+
+
+def migrate_db(db, target=None):
+    """Apply pending migrations up to target (default: latest). Returns versions applied."""
+    target = target or SCHEMA_VERSION
+    db.execute(f'PRAGMA busy_timeout = {MIGRATION_BUSY_TIMEOUT}')
+    db.commit()
+    done = applied_migrations(db)
+    db.commit()
+
+    applied = []
+    for version, name, sql in MIGRATIONS:
+        if version in done or version > target:
+            continue
+        # BEGIN IMMEDIATE takes the write lock up front so two workers booting
+        # at once serialize here instead of deadlocking mid-migration
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if version in applied_migrations(db):
+                db.rollback()
+                continue
+            for statement in split_sql(sql):
+                db.execute(statement)
+            db.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append(version)
+
+    current = max(applied_migrations(db) | {0})
+    db.execute(f'PRAGMA user_version = {current}')
+    db.commit()
+    return applied
+
+
+SCHEMA_OBJECT_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?(TABLE|INDEX|VIEW)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.I)
+SCHEMA_DROP_RE = re.compile(r'DROP\s+(?:TABLE|INDEX|VIEW)\s+(?:IF\s+EXISTS\s+)?(\w+)', re.I)
+
+
+def verify_schema(db):
+    """Returns a list of problems: missing migrations or missing tables/indexes."""
+    problems = []
+    # Read-only: don't create the ledger table on a database we're inspecting
+    has_ledger = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_version'").fetchone()
+    done = applied_migrations(db) if has_ledger else set()
+    for version, name, sql in MIGRATIONS:
+        if version not in done:
+            problems.append(f'migration {version} ({name}) not applied')
+    expected = {}
+    for version, name, sql in MIGRATIONS:
+        # Statement by statement, so an object dropped and recreated stays expected
+        for statement in split_sql(sql):
+            for obj in SCHEMA_DROP_RE.findall(statement):
+                expected.pop(obj, None)
+            for kind, obj in SCHEMA_OBJECT_RE.findall(statement):
+                expected[obj] = (kind.lower(), version)
+    existing = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index', 'view')")}
+    for obj, (kind, version) in expected.items():
+        if obj not in existing:
+            problems.append(f'{kind} {obj} missing (migration {version})')
+    return problems
+
+
+# ===================== LIVE EVENTS =====================
+
+# Seconds between SSE keep-alive comments, and how long one stream stays open
+# before the server closes it (EventSource reconnects with Last-Event-ID).
+SSE_HEARTBEAT = 15
+SSE_MAX_SECONDS = 300
+# Recent events LocalBroker keeps so a reconnecting stream can resume from Last-Event-ID
+SSE_REPLAY_EVENTS = 1000
+# Set while a server worker drains for shutdown or reload; open streams end at
+# their next message or heartbeat and the browser reconnects to a live worker.
+server_draining = threading.Event()
+
+
+class LocalBroker:
+    """In-process pub/sub. Only reaches subscribers in the same worker.
+
+    The last SSE_REPLAY_EVENTS events are kept in a ring buffer, so a stream
+    that reconnects with Last-Event-ID first replays what it missed.
+    """
+
+    def __init__(self, replay=SSE_REPLAY_EVENTS):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._ids = itertools.count(1)
+        self._recent = collections.deque(maxlen=replay) # (user_id, message)
+
+    def publish(self, user_id, event, data):
+        message = (next(self._ids), event, json.dumps(data, default=str))
+        # Buffering and fan-out share the lock, so a listener subscribing
+        # concurrently gets each message from exactly one of the two
+        with self._lock:
+            self._recent.append((user_id, message))
+            queues = list(self._subscribers.get(user_id, ()))
+        for q in queues:
+            q.put(message)
+
+    def listen(self, user_id, last_id=None, timeout=SSE_HEARTBEAT):
+        """Yields (id, event, payload) tuples, or None when idle for `timeout` seconds."""
+        import queue
+
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(q)
+            missed = [m for uid, m in self._recent if uid == user_id and m[0] > last_id] if last_id is not None else []
+        try:
+            yield from missed
+            while True:
+                try:
+                    yield q.get(timeout=timeout)
+                except queue.Empty:
+                    yield None
+        finally:
+            with self._lock:
+                self._subscribers[user_id].discard(q)
+                if not self._subscribers[user_id]:
+                    del self._subscribers[user_id]
+
+
+class SQLiteBroker:
+    """Shares events between workers through the event_log table.
+
+    Subscribers poll for rows newer than the last id they saw, which also lets
+    a reconnecting EventSource replay whatever it missed via Last-Event-ID.
+    """
+
+    def __init__(self, path, poll_interval=1.0, retention_minutes=10):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention_minutes = retention_minutes
+        self._publishes = itertools.count()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=5)
+        ensure_schema(db, self.path)
+        return db
+
+    def publish(self, user_id, event, data):
+        db = self._connect()
+        try:
+            db.execute('INSERT INTO event_log (user_id, event, payload) VALUES (?, ?, ?)',
+                       (user_id, event, json.dumps(data, default=str)))
+            if next(self._publishes) % 100 == 0:
+                db.execute("DELETE FROM event_log WHERE created_at < datetime('now', ?)",
+                           (f'-{self.retention_minutes} minutes',))
+            db.commit()
+        finally:
+            db.close()
+
+    def listen(self, user_id, last_id=None, timeout=SSE_HEARTBEAT):
+        db = self._connect()
+        try:
+            if last_id is None:
+                last_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM event_log').fetchone()[0]
+            idle = 0.0
+            while True:
+                rows = db.execute('SELECT id, event, payload FROM event_log WHERE user_id = ? AND id > ? ORDER BY id',
+                                  (user_id, last_id)).fetchall()
+                for row in rows:
+                    last_id = row[0]
+                    yield tuple(row)
+                if rows:
+                    idle = 0.0
+                    continue
+                time.sleep(self.poll_interval)
+                idle += self.poll_interval
+                if idle >= timeout:
+                    idle = 0.0
+                    yield None
+        finally:
+            db.close()
+
+
+_broker = None
+
+def get_broker():
+    """EVENT_BROKER=sqlite shares events across worker processes; default is in-process."""
+    global _broker
+    if _broker is None:
+        if os.environ.get('EVENT_BROKER', 'local') == 'sqlite':
+            _broker = SQLiteBroker(DATABASE)
+        else:
+            _broker = LocalBroker()
+    return _broker
+
+
+def publish_event(event, data, user_id=None):
+    """Push a delta to the user's open event streams. Call after committing."""
+    if user_id is None:
+        user_id = current_user.id
+    get_broker().publish(user_id, event, data)
+
+
+# ===================== AI LIMITS =====================
+
+# Each user gets a token bucket of AI calls (chat and suggestions share it), and
+# at most AI_MAX_CONCURRENT Groq requests are in flight at once. Callers that
+# are refused fall back to cached or rule-based answers instead of waiting.
+AI_RATE_PER_MINUTE = float(os.environ.get('AI_RATE_PER_MINUTE', 6))
+AI_BURST = float(os.environ.get('AI_BURST', 10))
+AI_MAX_CONCURRENT = int(os.environ.get('AI_MAX_CONCURRENT', 4))
+# A worker that dies mid-call gives its shared slot back after this many seconds
+AI_SLOT_LEASE = 60
+
+
+def refill_bucket(tokens, updated_at, now):
+    return min(AI_BURST, tokens + (now - updated_at) * AI_RATE_PER_MINUTE / 60.0)
+
+
+class LocalAIGuard:
+    """In-process buckets and semaphore. Each worker enforces its own limits."""
+
+    def __init__(self, max_concurrent=AI_MAX_CONCURRENT):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def take_token(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(user_id, (AI_BURST, now))
+            tokens = refill_bucket(tokens, updated_at, now)
+            allowed = tokens >= 1
+            self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def acquire_slot(self):
+        return True if self._slots.acquire(blocking=False) else None
+
+    def release_slot(self, lease):
+        self._slots.release()
+
+
+class SQLiteAIGuard:
+    """Buckets and call slots shared by every worker through the database.
+
+    Slots are leased rows with an expiry, so a crashed worker cannot hold one
+    forever. Both checks run under BEGIN IMMEDIATE to serialise competing workers.
+    """
+
+    def __init__(self, path, max_concurrent=AI_MAX_CONCURRENT):
+        self.path = path
+        self.max_concurrent = max_concurrent
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        ensure_schema(db, self.path)
+        return db
+
+    def take_token(self, user_id):
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT tokens, updated_at FROM ai_rate_buckets WHERE user_id = ?', (user_id,)).fetchone()
+            tokens = refill_bucket(*row, now) if row else AI_BURST
+            allowed = tokens >= 1
+            db.execute('INSERT OR REPLACE INTO ai_rate_buckets (user_id, tokens, updated_at) VALUES (?, ?, ?)',
+                       (user_id, tokens - 1 if allowed else tokens, now))
+            db.execute('COMMIT')
+            return allowed
+        finally:
+            db.close()
+
+    def acquire_slot(self):
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM ai_call_slots WHERE expires_at < ?', (now,))
+            lease = None
+            if db.execute('SELECT COUNT(*) FROM ai_call_slots').fetchone()[0] < self.max_concurrent:
+                lease = db.execute('INSERT INTO ai_call_slots (expires_at) VALUES (?)', (now + AI_SLOT_LEASE,)).lastrowid
+            db.execute('COMMIT')
+            return lease
+        finally:
+            db.close()
+
+    def release_slot(self, lease):
+        db = self._connect()
+        try:
+            db.execute('DELETE FROM ai_call_slots WHERE id = ?', (lease,))
+        finally:
+            db.close()
+
+
+_ai_guard = None
+
+def get_ai_guard():
+    """AI_LIMITER=sqlite shares limits across worker processes; default is in-process."""
+    global _ai_guard
+    if _ai_guard is None:
+        if os.environ.get('AI_LIMITER', 'local') == 'sqlite':
+            _ai_guard = SQLiteAIGuard(DATABASE)
+        else:
+            _ai_guard = LocalAIGuard()
+    return _ai_guard
+
+
+@contextlib.contextmanager
+def ai_call_slot():
+    """Yields True while holding one of the global Groq call slots, False if all are busy."""
+    guard = get_ai_guard()
+    lease = guard.acquire_slot()
+    try:
+        yield lease is not None
+    finally:
+        if lease is not None:
+            guard.release_slot(lease)
 
 
 # ===================== AI SUGGESTIONS =====================
@@ -225,26 +1128,28 @@ def get_study_context(db):
         WHERE t.user_id = ? AND t.status = "pending" 
         ORDER BY t.priority DESC, t.deadline ASC LIMIT 5
     ''', (current_user.id,)).fetchall()
-    goals = db.execute('SELECT * FROM goals WHERE user_id = ? AND status = "active"', (current_user.id,)).fetchall()
+    goals = db.execute('SELECT id, title, target_hours, current_hours, deadline FROM goals WHERE user_id = ? AND status = "active"',
+                       (current_user.id,)).fetchall()
 
     # Calculate study hours per subject
-    hours_per_subject = db.execute('''
-        SELECT s.name, COALESCE(SUM(ss.duration_minutes), 0) / 60.0 as hours
+    hours_per_subject = db.execute(f'''
+        WITH {SUBJECT_MINUTES_CTE}
+        SELECT s.name, COALESCE(sm.minutes, 0) / 60.0 as hours
         FROM subjects s
-        LEFT JOIN study_sessions ss ON s.id = ss.subject_id
-        WHERE s.user_id = ?
-        GROUP BY s.id
-    ''', (current_user.id,)).fetchall()
+        LEFT JOIN subject_minutes sm ON s.id = sm.subject_id
+        WHERE s.user_id = :uid
+    ''', {'uid': current_user.id}).fetchall()
 
-    # Recent 7-day totals
-    week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+    # Recent 7-day totals, from local midnight a week ago
+    tz = user_zone(db, current_user.id)
+    week_ago = utc_midnight(tz, local_today(tz) - timedelta(days=7))
     weekly_hours_row = db.execute('''
         SELECT COALESCE(SUM(duration_minutes), 0) / 60.0 as hours
         FROM study_sessions WHERE user_id = ? AND created_at >= ?
     ''', (current_user.id, week_ago,)).fetchone()
     weekly_hours = weekly_hours_row['hours'] if weekly_hours_row else 0
 
-    total_sessions_row = db.execute('SELECT COUNT(*) as c FROM study_sessions WHERE user_id = ?', (current_user.id,)).fetchone()
+    total_sessions_row = db.execute('SELECT COALESCE(SUM(sessions), 0) as c FROM session_totals WHERE user_id = ?', (current_user.id,)).fetchone()
     total_sessions = total_sessions_row['c'] if total_sessions_row else 0
 
     context = {
@@ -256,13 +1161,92 @@ def get_study_context(db):
         'active_goals': [dict(g) for g in goals],
         'recent_sessions_count': db.execute('SELECT COUNT(*) as c FROM study_sessions WHERE user_id = ? ORDER BY created_at DESC LIMIT 20', (current_user.id,)).fetchone()['c'],
         'total_sessions': total_sessions,
-        'profile': dict(profile)
+        'profile': dict(profile),
+        'now': local_now(tz),
     }
     return context
 
 
+# Tokens the student-data block of a prompt may use. Estimated at ~4 characters
+# per token, which is close enough for English text to keep prompts bounded.
+PROMPT_CONTEXT_TOKENS = int(os.environ.get('PROMPT_CONTEXT_TOKENS', 300))
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _clip(text, limit=60):
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def _context_sections(context):
+    """(key, label, entries) per prompt section, entries ranked most useful first."""
+    hours = context['hours_per_subject']
+    mean = sum(hours.values()) / len(hours) if hours else 0
+    # The most and least studied subjects are what balance advice hinges on
+    subjects = sorted(hours.items(), key=lambda kv: -abs(kv[1] - mean))
+    tasks = []
+    for t in context['pending_tasks']: # already ordered by priority, then deadline
+        details = [d for d in (t.get('subject'), t.get('priority'),
+                               t.get('deadline') and 'due ' + str(t['deadline'])[:10]) if d]
+        tasks.append(_clip(t['title']) + (f" [{', '.join(details)}]" if details else ''))
+    goals = sorted(context['active_goals'], key=lambda g: (g['deadline'] is None, g['deadline'] or ''))
+    return [
+        ('subjects', 'Study hours by subject', [f'{_clip(name, 40)} {h:g}h' for name, h in subjects]),
+        ('tasks', 'Pending tasks', tasks),
+        ('goals', 'Active goals', [f"{_clip(g['title'])} {g['current_hours'] or 0:.1f}/{g['target_hours'] or 0:g}h"
+                                   + (f" by {g['deadline']}" if g['deadline'] else '') for g in goals]),
+    ]
+
+
+def compact_context(context, keys=('subjects', 'tasks', 'goals'), budget=PROMPT_CONTEXT_TOKENS):
+    """Prompt lines for the chosen sections, kept within `budget` estimated tokens.
+
+    Entries are taken round-robin in rank order so a long task list can't crowd
+    out goals; whatever doesn't fit is summarised as "(+N more)".
+    """
+    sections = [s for s in _context_sections(context) if s[0] in keys]
+    used = sum(estimate_tokens(f'- {label}: (+999 more)\n') for _, label, _ in sections)
+    taken = [0] * len(sections)
+    progress = True
+    while progress:
+        progress = False
+        for i, (_, _, entries) in enumerate(sections):
+            if taken[i] < len(entries):
+                cost = estimate_tokens(entries[taken[i]] + '; ')
+                if used + cost <= budget:
+                    used += cost
+                    taken[i] += 1
+                    progress = True
+    lines = []
+    for (_, label, entries), n in zip(sections, taken):
+        text = '; '.join(entries[:n]) or 'none'
+        if n < len(entries):
+            text += f' (+{len(entries) - n} more)'
+        lines.append(f'- {label}: {text}')
+    return '\n'.join(lines)
+
+
 def get_ai_suggestions(db):
     """Factory function to get suggestions either from AI or fallback rules."""
+    ai_ready = ai_client_active and current_user.is_authenticated
+    # With the breaker open, answer at once instead of waiting on a failing upstream
+    use_ai = ai_ready and not groq_breaker.is_open() and get_ai_guard().take_token(current_user.id)
+    if ai_ready and not use_ai:
+        last_good = last_good_suggestions(db, current_user.id)
+        if last_good:
+            return last_good
+    if not use_ai and current_user.is_authenticated:
+        # Rules-only mode or rate limited: serve the nightly batch result when it's still fresh
+        cached = cached_suggestions(db, current_user.id, user_zone(db, current_user.id))
+        if cached is not None:
+            for s in cached:
+                s['source'] = 'smart_rules'
+            return cached
+
     context = get_study_context(db)
     if not context:
         return [] # No context if user not authenticated
@@ -270,13 +1254,19 @@ def get_ai_suggestions(db):
     suggestions = []
     ai_powered = False
 
-    if ai_client_active:
-        try:
-            suggestions = get_groq_suggestions(context)
-            if suggestions:
-                ai_powered = True
-        except Exception:
-            pass # Fallback to smart rules if AI fails
+    if use_ai:
+        with ai_call_slot() as acquired:
+            if acquired: # All Groq slots busy: answer from rules rather than queue
+                try:
+                    suggestions = get_groq_suggestions(context)
+                    if suggestions:
+                        ai_powered = True
+                except Exception:
+                    pass # Fallback to smart rules if AI fails
+        if not ai_powered:
+            last_good = last_good_suggestions(db, current_user.id)
+            if last_good:
+                return last_good
     
     # Ensure we only return 4 valid suggestions
     valid_suggestions = [s for s in suggestions if isinstance(s, dict) and all(k in s for k in ['title', 'description', 'type', 'priority'])][:4]
@@ -288,6 +1278,7 @@ def get_ai_suggestions(db):
          
     # Mark them with the type for the frontend
     if ai_powered:
+        remember_suggestions(db, current_user.id, valid_suggestions)
         for s in valid_suggestions:
             s['source'] = 'ai'
     else:
@@ -301,19 +1292,17 @@ def get_groq_suggestions(context):
     prompt = f"""You are a smart study planner AI assistant. Based on the following student data, provide exactly 4 actionable study suggestions. Each suggestion should have a title (max 8 words), a description (max 25 words), a type (one of: schedule, focus, break, goal, revision, balance), and a priority (high, medium, low).
 
 Student Data:
-- Subjects: {json.dumps(context['subjects'], default=str)}
-- Pending Tasks: {json.dumps(context['pending_tasks'][:5], default=str)}
-- Study Hours by Subject: {json.dumps(context['hours_per_subject'])}
+{compact_context(context)}
 - Weekly Study Hours: {context['weekly_study_hours']}
-- Active Goals: {json.dumps(context['active_goals'], default=str)}
 - Total Study Sessions: {context['total_sessions']}
 
-Current date/time: {datetime.now().strftime('%Y-%m-%d %H:%M')}
+Current date/time: {context['now'].strftime('%Y-%m-%d %H:%M')}
 
 Respond ONLY with a valid JSON array of 4 objects, each with keys: "title", "description", "type", "priority". No markdown, no extra text."""
 
+    # Upstream errors propagate so the caller can fall back; only bad output is handled here
+    text = call_groq_rest(prompt, model_name='llama3-8b-8192', kind='suggestions')
     try:
-        text = call_groq_rest(prompt, model_name='llama3-8b-8192')
         # Clean potential markdown wrapping
         if text.startswith('```'):
             text = text.split('\n', 1)[1]
@@ -324,140 +1313,1138 @@ Respond ONLY with a valid JSON array of 4 objects, each with keys: "title", "des
     except Exception:
         pass
 
-    return get_smart_fallback_suggestions(context)
+    return [] # caller pads with rule-based suggestions
+
+
+# How long the last good AI answer may stand in while Groq is unavailable
+AI_CACHE_MAX_AGE = timedelta(hours=24)
+
+
+def remember_suggestions(db, user_id, suggestions):
+    db.execute('INSERT OR REPLACE INTO ai_suggestion_cache (user_id, suggestions, computed_at) VALUES (?, ?, ?)',
+               (user_id, json.dumps(suggestions), datetime.utcnow().strftime(SQL_TIMESTAMP)))
+    db.commit()
+
+
+def last_good_suggestions(db, user_id):
+    """The user's last AI suggestions if younger than AI_CACHE_MAX_AGE, else None."""
+    cutoff = (datetime.utcnow() - AI_CACHE_MAX_AGE).strftime(SQL_TIMESTAMP)
+    row = db.execute('SELECT suggestions FROM ai_suggestion_cache WHERE user_id = ? AND computed_at >= ?',
+                     (user_id, cutoff)).fetchone()
+    if not row:
+        return None
+    suggestions = json.loads(row['suggestions'])
+    for s in suggestions:
+        s['source'] = 'ai_cached'
+    return suggestions
 
 
 def get_smart_fallback_suggestions(context):
     """Rule-based smart suggestions when AI is not available."""
-    suggestions = []
-    now = datetime.now()
-    hour = now.hour
+    hits = evaluate_suggestion_rules(features_from_context(context, context['now']))[0]
+    return [s for _, s in hits][:4]
+
+
+# ===================== SUGGESTION RULES =====================
 
-    # 1. Check for overdue / urgent tasks
-    urgent_tasks = []
+# Per-user features the rules read. Rules see them as columns (one list per
+# feature, one entry per user) so a single pass covers any number of users.
+SUGGESTION_FEATURES = (
+    'user_id', 'hour', 'urgent_title', 'urgent_subject', 'urgent_days',
+    'max_subject', 'max_hours', 'min_subject', 'min_hours', 'weekly_hours',
+    'goal_title', 'goal_pct', 'subject_count', 'total_sessions',
+)
+
+def _rule(when, title, description, type, priority, live=False):
+    return {'when': when, 'title': title, 'description': description,
+            'type': type, 'priority': priority, 'live': live}
+
+# Evaluated in order; the first four that fire are shown. `when` maps the
+# feature columns to a list of booleans. Templates are str.format()ed with the
+# user's feature row. `live` rules depend on the clock and are never cached.
+SUGGESTION_RULES = [
+    # 1. Overdue / urgent tasks
+    _rule(lambda c: [d is not None and d < 0 for d in c['urgent_days']],
+          'Overdue: {urgent_title:.20}', 'This task for {urgent_subject} is past its deadline. Complete it ASAP!',
+          'focus', 'high'),
+    _rule(lambda c: [d is not None and d >= 0 for d in c['urgent_days']],
+          'Urgent deadline approaching', '"{urgent_title:.15}" is due in {urgent_days} day(s). Prioritize it now.',
+          'focus', 'high'),
+    # 2. Study balance check
+    _rule(lambda c: [hi is not None and hi > 0 and lo < hi * 0.3 for hi, lo in zip(c['max_hours'], c['min_hours'])],
+          'Balance your study time', 'You\'ve studied {min_subject} much less than {max_subject}. Dedicate more time to it.',
+          'balance', 'medium'),
+    # 3. Time-based suggestion
+    _rule(lambda c: [h < 12 for h in c['hour']],
+          'Morning focus session', 'Mornings are great for complex topics. Start a deep study session now!',
+          'schedule', 'medium', live=True),
+    _rule(lambda c: [12 <= h < 17 for h in c['hour']],
+          'Afternoon revision block', 'Review what you studied this morning for better retention.',
+          'revision', 'medium', live=True),
+    _rule(lambda c: [h >= 17 for h in c['hour']],
+          'Evening light review', 'Do a light recap or flashcard session before winding down.',
+          'revision', 'low', live=True),
+    # 4. Weekly hours check
+    _rule(lambda c: [w < 5 for w in c['weekly_hours']],
+          'Boost your weekly hours', 'Only {weekly_hours}h this week. Aim for at least 10 hours.',
+          'goal', 'high'),
+    _rule(lambda c: [w > 30 for w in c['weekly_hours']],
+          'Remember to take breaks', 'You\'ve studied a lot this week. Rest is important for memory!',
+          'break', 'medium'),
+    _rule(lambda c: [5 <= w <= 30 for w in c['weekly_hours']],
+          'Great study momentum!', '{weekly_hours}h this week. Keep up the consistent effort!',
+          'goal', 'low'),
+    # 5. Goals progress
+    _rule(lambda c: [p is not None for p in c['goal_pct']],
+          'Goal needs attention', '"{goal_title:.15}" is only {goal_pct:.0f}% complete. Step it up!',
+          'goal', 'high'),
+    # 6. No subjects yet
+    _rule(lambda c: [n == 0 for n in c['subject_count']],
+          'Add your subjects', 'Start by adding the subjects you\'re studying to organize your plan.',
+          'schedule', 'high'),
+    # 7. Pomodoro suggestion
+    _rule(lambda c: [n < 3 for n in c['total_sessions']],
+          'Try the Pomodoro Timer', 'Use 25-min focused sessions with 5-min breaks for better productivity.',
+          'focus', 'medium'),
+]
+
+
+def evaluate_suggestion_rules(columns, live=None):
+    """Returns, per user, the fired rules as (rule_index, suggestion) pairs.
+
+    live=None evaluates every rule, True/False only the clock-dependent or
+    cacheable ones.
+    """
+    rules = [(i, r) for i, r in enumerate(SUGGESTION_RULES) if live is None or r['live'] == live]
+    masks = [(i, r, r['when'](columns)) for i, r in rules]
+    results = []
+    for row in range(len(columns['user_id'])):
+        hits = []
+        for i, rule, mask in masks:
+            if mask[row]:
+                values = {name: columns[name][row] for name in SUGGESTION_FEATURES}
+                hits.append((i, {
+                    'title': rule['title'].format(**values),
+                    'description': rule['description'].format(**values),
+                    'type': rule['type'],
+                    'priority': rule['priority'],
+                }))
+                if len(hits) == 4:
+                    break
+        results.append(hits)
+    return results
+
+
+def _balance_features(hours):
+    if not hours:
+        return None, None, None, None
+    max_subj = max(hours, key=hours.get)
+    min_subj = min(hours, key=hours.get)
+    return max_subj, hours[max_subj], min_subj, hours[min_subj]
+
+
+def _lagging_goal(goals):
+    for goal in goals:
+        pct = (goal['current_hours'] / goal['target_hours'] * 100) if goal['target_hours'] > 0 else 0
+        if pct < 30 and goal['deadline']:
+            return goal['title'], pct
+    return None, None
+
+
+def features_from_context(context, now):
+    """One-row feature columns built from get_study_context() output."""
+    urgent = (None, None, None)
     for t in context['pending_tasks']:
+        try:
+            days_left = (date.fromisoformat(t['deadline']) - now.date()).days if t.get('deadline') else None
+        except ValueError:
+            days_left = None
+        if days_left is not None and days_left <= 2:
+            urgent = (t['title'], t.get('subject') or 'Unknown', days_left)
+            break
+    max_subj, max_hours, min_subj, min_hours = _balance_features(context['hours_per_subject'])
+    goal_title, goal_pct = _lagging_goal(context['active_goals'])
+    row = {
+        'user_id': context['profile'].get('user_id'), 'hour': now.hour,
+        'urgent_title': urgent[0], 'urgent_subject': urgent[1], 'urgent_days': urgent[2],
+        'max_subject': max_subj, 'max_hours': max_hours, 'min_subject': min_subj, 'min_hours': min_hours,
+        'weekly_hours': context['weekly_study_hours'], 'goal_title': goal_title, 'goal_pct': goal_pct,
+        'subject_count': len(context['subjects']), 'total_sessions': context['total_sessions'],
+    }
+    return {name: [row[name]] for name in SUGGESTION_FEATURES}
+
+
+def batch_suggestion_features(db, now):
+    """Feature columns for every user, from one grouped query per feature.
+
+    `now` is an aware instant. Hours, days left and the weekly window are taken
+    in each user's zone, through a small VALUES table with one row per zone.
+    """
+    # Users whose data lives in this database: the main DB's users table also
+    # lists everyone who has been moved out to a shard
+    users = db.execute('''
+        SELECT u.id, COALESCE(p.timezone, '') as tz
+        FROM users u LEFT JOIN user_profile p ON p.user_id = u.id
+        WHERE u.id NOT IN (SELECT user_id FROM user_shards) ORDER BY u.id
+    ''').fetchall()
+    user_ids = [r['id'] for r in users]
+    position = {uid: i for i, uid in enumerate(user_ids)}
+    n = len(user_ids)
+    columns = {name: [None] * n for name in SUGGESTION_FEATURES}
+    columns['user_id'] = user_ids
+    columns['weekly_hours'] = [0.0] * n
+    columns['subject_count'] = [0] * n
+    columns['total_sessions'] = [0] * n
+    if not n:
+        columns['hour'] = []
+        return columns
+
+    zones = {}
+    for name in {r['tz'] for r in users}:
+        tz = load_zone(name)
+        local = now.astimezone(tz)
+        zones[name] = (local.hour, local.strftime('%Y-%m-%d'), utc_midnight(tz, local.date() - timedelta(days=7)))
+    columns['hour'] = [zones[r['tz']][0] for r in users]
+    zone_cte = 'zones(name, today, week_start) AS (VALUES ' + ', '.join('(?, ?, ?)' for _ in zones) + ')'
+    zone_params = [v for name, (_, today, week_start) in zones.items() for v in (name, today, week_start)]
+
+    # Same candidate set as get_study_context: each user's top 5 pending tasks.
+    # Days left are computed by SQLite, so there's no per-row date parsing here.
+    urgent = db.execute(f'''
+        WITH {zone_cte}, top AS (
+            SELECT t.user_id, t.title, s.name as subject, t.deadline,
+                   ROW_NUMBER() OVER (PARTITION BY t.user_id ORDER BY t.priority DESC, t.deadline ASC) as rn
+            FROM tasks t LEFT JOIN subjects s ON t.subject_id = s.id
+            WHERE t.status = 'pending'
+        )
+        SELECT top.user_id, title, subject, CAST(julianday(deadline) - julianday(z.today) AS INTEGER) as days_left
+        FROM top
+        LEFT JOIN user_profile p ON p.user_id = top.user_id
+        JOIN zones z ON z.name = COALESCE(p.timezone, '')
+        WHERE rn <= 5 AND julianday(deadline) - julianday(z.today) <= 2
+        ORDER BY top.user_id, rn
+    ''', zone_params)
+    for row in urgent:
+        i = position.get(row['user_id'])
+        if i is not None and columns['urgent_days'][i] is None:
+            columns['urgent_title'][i] = row['title']
+            columns['urgent_subject'][i] = row['subject'] or 'Unknown'
+            columns['urgent_days'][i] = row['days_left']
+
+    hours = {}
+    for row in db.execute('''
+        SELECT s.user_id, s.name, COALESCE(SUM(t.minutes), 0) / 60.0 as hours
+        FROM subjects s LEFT JOIN session_totals t ON s.id = t.subject_id
+        GROUP BY s.id
+    '''):
+        hours.setdefault(row['user_id'], {})[row['name']] = round(row['hours'], 1)
+        if row['user_id'] in position:
+            columns['subject_count'][position[row['user_id']]] += 1
+    for uid, per_subject in hours.items():
+        if uid in position:
+            i = position[uid]
+            (columns['max_subject'][i], columns['max_hours'][i],
+             columns['min_subject'][i], columns['min_hours'][i]) = _balance_features(per_subject)
+
+    for row in db.execute('SELECT user_id, SUM(sessions) as total FROM session_totals GROUP BY user_id'):
+        if row['user_id'] in position:
+            columns['total_sessions'][position[row['user_id']]] = row['total']
+    for row in db.execute(f'''
+        WITH {zone_cte}
+        SELECT ss.user_id, COALESCE(SUM(ss.duration_minutes), 0) / 60.0 as weekly
+        FROM study_sessions ss
+        LEFT JOIN user_profile p ON p.user_id = ss.user_id
+        JOIN zones z ON z.name = COALESCE(p.timezone, '')
+        WHERE ss.created_at >= z.week_start GROUP BY ss.user_id
+    ''', zone_params):
+        if row['user_id'] in position:
+            columns['weekly_hours'][position[row['user_id']]] = round(row['weekly'], 1)
+
+    goals = {}
+    for row in db.execute("SELECT user_id, title, current_hours, target_hours, deadline FROM goals WHERE status = 'active' ORDER BY id"):
+        goals.setdefault(row['user_id'], []).append(row)
+    for uid, user_goals in goals.items():
+        if uid in position:
+            i = position[uid]
+            columns['goal_title'][i], columns['goal_pct'][i] = _lagging_goal(user_goals)
+
+    return columns
+
+
+def precompute_suggestions(db, now=None):
+    """Nightly batch: evaluate the cacheable rules for every user and store them."""
+    columns = batch_suggestion_features(db, now or datetime.now(timezone.utc))
+    hits = evaluate_suggestion_rules(columns, live=False)
+    db.executemany(
+        f'INSERT OR REPLACE INTO suggestion_cache (user_id, suggestions, computed_at) VALUES (?, ?, {SYNC_NOW})',
+        [(uid, json.dumps([{'rule': i, **s} for i, s in user_hits])) for uid, user_hits in zip(columns['user_id'], hits)]
+    )
+    db.commit()
+    return len(columns['user_id'])
+
+
+def cached_suggestions(db, user_id, tz):
+    """Today's precomputed suggestions merged with the live rules, or None if stale.
+
+    "Today" starts at local midnight in `tz`, the user's zone.
+    """
+    row = db.execute('SELECT suggestions, computed_at FROM suggestion_cache WHERE user_id = ?', (user_id,)).fetchone()
+    if not row or row['computed_at'] < utc_midnight(tz, local_today(tz)):
+        return None
+    # Any write to the user's data since the batch ran (tracked by the sync
+    # stamps) invalidates the cached rules
+    changed = db.execute(
+        'SELECT MAX(stamp) FROM (' + ' UNION ALL '.join(
+            [f'SELECT MAX(updated_at) as stamp FROM {t} WHERE user_id = :uid' for t in SYNC_TABLES]
+            + ['SELECT MAX(deleted_at) as stamp FROM sync_tombstones WHERE user_id = :uid']) + ')',
+        {'uid': user_id}).fetchone()[0]
+    if changed and changed > row['computed_at']:
+        return None
+
+    live_columns = {name: [None] for name in SUGGESTION_FEATURES}
+    live_columns.update(user_id=[user_id], hour=[local_now(tz).hour])
+    hits = [(s.pop('rule'), s) for s in json.loads(row['suggestions'])]
+    hits += evaluate_suggestion_rules(live_columns, live=True)[0]
+    hits.sort(key=lambda h: h[0])
+    return [s for _, s in hits][:4]
+
+
+# ===================== STUDY PLAN ENGINE =====================
+
+PRIORITY_WEIGHT = {'high': 3, 'medium': 2, 'low': 1}
+# Hours of study a pending task gets per week when nothing else is known
+PLAN_TASK_HOURS = {'high': 3, 'medium': 2, 'low': 1}
+PLAN_DAYS = 7
+PLAN_SLOTS = PLAN_DAYS * 24
+
+# Score weights: spread load across days, pull urgent work earlier, and avoid
+# leaving free gaps too short for the next block in the queue (lookahead).
+PLAN_LOAD_WEIGHT = 0.6
+PLAN_URGENCY_WEIGHT = 0.25
+PLAN_FRAGMENT_WEIGHT = 0.8
+
+
+def _hour_preference(peak):
+    return [1.0 - abs(h - peak) / 12.0 for h in range(24)]
+
+# Deep work in the morning, routine work in the afternoon, light review in the
+# evening. Stored as prefix sums so a block's score is one subtraction.
+PLAN_HOUR_PREF = {}
+for _priority, _peak in (('high', 9), ('medium', 14), ('low', 18)):
+    _prefix = [0.0]
+    for _value in _hour_preference(_peak):
+        _prefix.append(_prefix[-1] + _value)
+    PLAN_HOUR_PREF[_priority] = _prefix
+
+
+def plan_demands(tasks, deficits, today):
+    """Turn pending tasks and subject deficits into (deadline_slot, weight, hours, block) demands."""
+    demands = []
+    for t in tasks:
+        priority = t.get('priority') if t.get('priority') in PRIORITY_WEIGHT else 'medium'
+        deadline_slot = PLAN_SLOTS
         if t.get('deadline'):
             try:
-                dl = datetime.strptime(t['deadline'], '%Y-%m-%d')
-                days_left = (dl - now).days
-                if days_left <= 2:
-                    urgent_tasks.append((t, days_left))
+                days_left = (datetime.strptime(t['deadline'], '%Y-%m-%d').date() - today).days
+                deadline_slot = min(PLAN_SLOTS, max(days_left + 1, 1) * 24)
             except ValueError:
                 pass
-
-    if urgent_tasks:
-        task, days = urgent_tasks[0]
-        subj = task.get('subject_name', 'Unknown')
-        if days < 0:
-            suggestions.append({
-                'title': f'Overdue: {task["title"][:20]}',
-                'description': f'This task for {subj} is past its deadline. Complete it ASAP!',
-                'type': 'focus',
-                'priority': 'high'
-            })
-        else:
-            suggestions.append({
-                'title': f'Urgent deadline approaching',
-                'description': f'"{task["title"][:15]}" is due in {days} day(s). Prioritize it now.',
-                'type': 'focus',
-                'priority': 'high'
+        subject = deficits.get(t.get('subject_id'))
+        weight = PRIORITY_WEIGHT[priority] + (min(subject[1], 5) / 5 if subject else 0)
+        demands.append((deadline_slot, weight, PLAN_TASK_HOURS[priority], {
+            'subject_id': t.get('subject_id'), 'title': t['title'], 'task_id': t.get('id'), 'priority': priority,
+        }))
+
+    # Subjects that fell behind get review time even without a pending task
+    for subject_id, (name, short) in deficits.items():
+        if short >= 1:
+            demands.append((PLAN_SLOTS, 1 + min(short, 5) / 5, min(int(round(short)), 2), {
+                'subject_id': subject_id, 'title': f'Review {name}', 'task_id': None, 'priority': 'low',
+            }))
+
+    # Earliest deadline first keeps the plan feasible; heavier work breaks ties
+    demands.sort(key=lambda d: (d[0], -d[1]))
+    return demands
+
+
+def generate_study_plan(tasks, deficits, busy, now, free_hours=(8, 20), max_hours_per_day=4):
+    """Greedy EDF scheduler over a 7-day x 24-hour slot grid.
+
+    tasks: dicts with id, title, subject_id, priority, deadline (YYYY-MM-DD).
+    deficits: {subject_id: (name, hours_short)}.
+    busy: set of (day_of_week, hour) already taken by manual blocks.
+    Returns (blocks, unscheduled) where blocks use planner_blocks columns.
+    """
+    first_hour, last_hour = free_hours
+    first_weekday = now.weekday()
+    free = [False] * PLAN_SLOTS
+    for offset in range(PLAN_DAYS):
+        weekday = (first_weekday + offset) % 7
+        for h in range(first_hour, last_hour):
+            if (weekday, h) not in busy and (offset > 0 or h > now.hour):
+                free[offset * 24 + h] = True
+    day_load = [0] * PLAN_DAYS
+
+    demands = plan_demands(tasks, deficits, now.date())
+    blocks = []
+    unscheduled = []
+    for index, (deadline_slot, weight, hours, info) in enumerate(demands):
+        next_len = demands[index + 1][2] if index + 1 < len(demands) else 1
+        pref = PLAN_HOUR_PREF[info['priority']]
+        remaining = hours
+        while remaining > 0:
+            best = None
+            for length in range(remaining, 0, -1):
+                for offset in range(min(PLAN_DAYS, (deadline_slot + 23) // 24)):
+                    if day_load[offset] + length > max_hours_per_day:
+                        continue
+                    base = offset * 24
+                    day_score = -PLAN_LOAD_WEIGHT * day_load[offset] - PLAN_URGENCY_WEIGHT * weight * offset
+                    end_limit = min(24, deadline_slot - base)
+                    h = 0
+                    # Walk the day's free runs and score every start that fits
+                    while h < end_limit:
+                        if not free[base + h]:
+                            h += 1
+                            continue
+                        run_start = h
+                        while h < 24 and free[base + h]:
+                            h += 1
+                        run_end = h
+                        for start in range(run_start, min(run_end, end_limit) - length + 1):
+                            score = pref[start + length] - pref[start] + day_score
+                            for gap in (start - run_start, run_end - start - length):
+                                if 0 < gap < next_len:
+                                    score -= PLAN_FRAGMENT_WEIGHT
+                            if best is None or score > best[0]:
+                                best = (score, offset, start, length)
+                if best:
+                    break
+            if not best:
+                if deadline_slot < PLAN_SLOTS:
+                    # Can't make the deadline any more; late is better than never
+                    deadline_slot = PLAN_SLOTS
+                    continue
+                break
+            _, offset, start, length = best
+            for h in range(start, start + length):
+                free[offset * 24 + h] = False
+            day_load[offset] += length
+            remaining -= length
+            blocks.append({
+                'day_of_week': (first_weekday + offset) % 7, 'start_hour': start, 'end_hour': start + length,
+                'subject_id': info['subject_id'], 'title': info['title'], 'task_id': info['task_id'],
             })
+        if remaining > 0:
+            unscheduled.append({'title': info['title'], 'task_id': info['task_id'], 'hours': remaining})
+    return blocks, unscheduled
 
-    # 2. Study balance check
-    hours = context['hours_per_subject']
-    if hours:
-        max_subj = max(hours, key=hours.get)
-        min_subj = min(hours, key=hours.get)
-        if hours[max_subj] > 0 and hours[min_subj] < hours[max_subj] * 0.3:
-            suggestions.append({
-                'title': f'Balance your study time',
-                'description': f'You\'ve studied {min_subj} much less than {max_subj}. Dedicate more time to it.',
-                'type': 'balance',
-                'priority': 'medium'
-            })
 
-    # 3. Time-based suggestion
-    if hour < 12:
-        suggestions.append({
-            'title': 'Morning focus session',
-            'description': 'Mornings are great for complex topics. Start a deep study session now!',
-            'type': 'schedule',
-            'priority': 'medium'
-        })
-    elif hour < 17:
-        suggestions.append({
-            'title': 'Afternoon revision block',
-            'description': 'Review what you studied this morning for better retention.',
-            'type': 'revision',
-            'priority': 'medium'
-        })
+# ===================== SPACED REPETITION =====================
+
+# SM-2 never lets a note's ease factor drop below this
+SM2_MIN_EASE = 1.3
+
+
+def sm2_schedule(ease, interval, repetitions, quality):
+    """One SM-2 step. quality is 0-5; below 3 counts as forgotten."""
+    if quality < 3:
+        repetitions = 0
+        interval = 1
     else:
-        suggestions.append({
-            'title': 'Evening light review',
-            'description': 'Do a light recap or flashcard session before winding down.',
-            'type': 'revision',
-            'priority': 'low'
-        })
+        repetitions += 1
+        if repetitions == 1:
+            interval = 1
+        elif repetitions == 2:
+            interval = 6
+        else:
+            interval = round(interval * ease)
+    ease = max(SM2_MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return ease, interval, repetitions
 
-    # 4. Weekly hours check
-    if context['weekly_study_hours'] < 5:
-        suggestions.append({
-            'title': 'Boost your weekly hours',
-            'description': f'Only {context["weekly_study_hours"]}h this week. Aim for at least 10 hours.',
-            'type': 'goal',
-            'priority': 'high'
-        })
-    elif context['weekly_study_hours'] > 30:
-        suggestions.append({
-            'title': 'Remember to take breaks',
-            'description': 'You\'ve studied a lot this week. Rest is important for memory!',
-            'type': 'break',
-            'priority': 'medium'
-        })
+
+def advance_reviews(db, today=None):
+    """Daily batch: lapse every review left overdue for longer than its interval.
+
+    One set-based UPDATE per time zone in use, each against that zone's local
+    date, so reviews lapse at the user's midnight. Lapsed notes restart the
+    SM-2 ladder with a lower ease and come due tomorrow, the same as grading
+    them "forgotten". An explicit `today` applies to every user.
+    """
+    if today:
+        zones = {None: today}
     else:
-        suggestions.append({
-            'title': 'Great study momentum!',
-            'description': f'{context["weekly_study_hours"]}h this week. Keep up the consistent effort!',
-            'type': 'goal',
-            'priority': 'low'
-        })
+        names = {r[0] for r in db.execute("SELECT DISTINCT COALESCE(timezone, '') FROM user_profile")} | {''}
+        zones = {name: local_today(load_zone(name)).isoformat() for name in names}
+    count = 0
+    for name, day in zones.items():
+        cursor = db.execute('''
+            UPDATE note_reviews
+            SET repetitions = 0, interval_days = 1, ease = MAX(?, ease - 0.2), due_date = DATE(?, '+1 day')
+            WHERE repetitions > 0 AND julianday(?) - julianday(due_date) > interval_days
+              AND (? IS NULL OR COALESCE((SELECT timezone FROM user_profile p WHERE p.user_id = note_reviews.user_id), '') = ?)
+        ''', (SM2_MIN_EASE, day, day, name, name))
+        count += cursor.rowcount
+    db.commit()
+    return count
+
+
+# ===================== EXPORT / IMPORT =====================
+
+# Tables a user can export/import, in dependency order (subjects first so the
+# importer can remap subject_id for everything after them)
+EXPORT_TABLES = ('subjects', 'tasks', 'study_sessions', 'notes', 'planner_blocks')
+# Tables read through a view that also covers archived rows
+EXPORT_SOURCES = {'study_sessions': 'study_sessions_all'}
+EXPORT_CHUNK = 1000
+IMPORT_BATCH = 500
+IMPORT_MAX_ERRORS = 50
+
+# column -> (type, required). Ids, user_id and sync stamps are never imported:
+# updated_at is stamped on insert so sync clients pull the imported rows.
+IMPORT_COLUMNS = {
+    'subjects': {'name': (str, True), 'color': (str, False), 'icon': (str, False), 'created_at': (str, False)},
+    'tasks': {'subject_id': (int, False), 'title': (str, True), 'description': (str, False), 'priority': (str, False),
+              'deadline': (str, False), 'status': (str, False), 'created_at': (str, False)},
+    'study_sessions': {'subject_id': (int, False), 'duration_minutes': (int, True), 'session_type': (str, False),
+                       'notes': (str, False), 'created_at': (str, False)},
+    'notes': {'subject_id': (int, False), 'title': (str, True), 'content': (str, False), 'created_at': (str, False)},
+    'planner_blocks': {'subject_id': (int, False), 'day_of_week': (int, True), 'start_hour': (int, True),
+                       'end_hour': (int, True), 'title': (str, False), 'source': (str, False)},
+}
+
+
+def iter_export(db, tables, fmt='ndjson', user_id=None):
+    """Yields export text chunk by chunk; rows are pulled from the cursor with fetchmany."""
+    import csv
+
+    for table in tables:
+        where, params = ('WHERE user_id = ?', (user_id,)) if user_id is not None else ('', ())
+        cursor = db.execute(f'SELECT * FROM {EXPORT_SOURCES.get(table, table)} {where} ORDER BY id', params)
+        columns = [d[0] for d in cursor.description]
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            if fmt == 'csv':
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                yield ''.join(json.dumps({'table': table, 'row': dict(zip(columns, r))}, default=str) + '\n' for r in rows)
+        if fmt == 'csv' and buffer.tell():
+            yield buffer.getvalue()
+
+
+def validate_import_row(table, row):
+    """Returns (clean_row, error). Coerces CSV strings to the column types."""
+    if table is None:
+        return None, 'malformed record'
+    spec = IMPORT_COLUMNS.get(table)
+    if spec is None:
+        return None, f'unknown table {table!r}'
+    if not isinstance(row, dict):
+        return None, 'row must be an object'
+    clean = {}
+    for column, (kind, required) in spec.items():
+        value = row.get(column)
+        if value in (None, ''):
+            if required:
+                return None, f'{column} is required'
+            continue
+        try:
+            clean[column] = kind(value)
+        except (TypeError, ValueError):
+            return None, f'{column} must be {kind.__name__}'
+    if table == 'planner_blocks' and not valid_block_span(clean['day_of_week'], clean['start_hour'], clean['end_hour']):
+        return None, 'invalid time range'
+    return clean, None
+
+
+def import_records(db, user_id, records):
+    """Insert (line_no, table, row) records for user_id in batched transactions.
+
+    Subject ids from the source are remapped to the new ones; references to
+    subjects that weren't part of the import are dropped. Planner blocks that
+    would overlap an existing (or earlier imported) block are skipped, so
+    importing the same export twice doesn't double-book the week.
+
+    Returns (counts, errors, skipped).
+    """
+    subject_map = {}
+    counts = dict.fromkeys(EXPORT_TABLES, 0)
+    errors = []
+    skipped = []
+    pending = 0
+    planner = None
+    sessions = [] # (created_at, minutes) for the goal counters
+    for line_no, table, row in records:
+        clean, error = validate_import_row(table, row)
+        if error:
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({'line': line_no, 'error': error})
+            continue
+        if table == 'planner_blocks':
+            if planner is None:
+                planner = PlannerIndex(db.execute('SELECT id, day_of_week, start_hour, end_hour FROM planner_blocks WHERE user_id = ?',
+                                                  (user_id,)).fetchall())
+            conflicts = planner.conflicts(clean['day_of_week'], clean['start_hour'], clean['end_hour'])
+            if conflicts:
+                if len(skipped) < IMPORT_MAX_ERRORS:
+                    skipped.append({'line': line_no, 'error': 'overlaps a planner block', 'conflicts': conflicts})
+                continue
+        if 'subject_id' in clean:
+            clean['subject_id'] = subject_map.get(clean['subject_id'])
+        clean['user_id'] = user_id
+        columns = ', '.join(clean)
+        cursor = db.execute(f'INSERT INTO {table} ({columns}) VALUES ({", ".join("?" * len(clean))})', tuple(clean.values()))
+        if table == 'subjects' and isinstance(row.get('id'), (int, str)) and str(row['id']).isdigit():
+            subject_map[int(row['id'])] = cursor.lastrowid
+        elif table == 'planner_blocks':
+            planner.add(clean['day_of_week'], clean['start_hour'], clean['end_hour'], cursor.lastrowid)
+        elif table == 'study_sessions':
+            sessions.append((clean.get('created_at') or datetime.utcnow().strftime(SQL_TIMESTAMP), clean['duration_minutes']))
+        counts[table] += 1
+        pending += 1
+        if pending >= IMPORT_BATCH:
+            db.commit()
+            pending = 0
+
+    # Derived state that the per-row endpoints normally maintain. As in api_save_note,
+    # a note's first review is the next day in the user's zone
+    due = (local_today(user_zone(db, user_id)) + timedelta(days=1)).isoformat()
+    db.execute('INSERT OR IGNORE INTO note_reviews (note_id, user_id, due_date) SELECT id, user_id, ? FROM notes WHERE user_id = ?',
+               (due, user_id))
+    if sessions:
+        # Same rule as deleting a session: an active goal counts sessions from its creation on
+        goals = db.execute("SELECT id, created_at FROM goals WHERE user_id = ? AND status = 'active'", (user_id,)).fetchall()
+        db.executemany('UPDATE goals SET current_hours = current_hours + ? WHERE id = ?',
+                       [(sum(m for at, m in sessions if at >= str(goal['created_at'])) / 60.0, goal['id']) for goal in goals])
+        recompute_streak(db, user_id)
+    db.commit()
+    if any(counts.values()):
+        publish_event('resync', {'reason': 'import'}, user_id=user_id)
+    return counts, errors, skipped
 
-    # 5. Goals progress
-    for goal in context['active_goals']:
-        pct = (goal['current_hours'] / goal['target_hours'] * 100) if goal['target_hours'] > 0 else 0
-        if pct < 30 and goal.get('deadline'):
-            suggestions.append({
-                'title': f'Goal needs attention',
-                'description': f'"{goal["title"][:15]}" is only {pct:.0f}% complete. Step it up!',
-                'type': 'goal',
-                'priority': 'high'
-            })
+
+def ndjson_records(lines):
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_no, None, None
+            continue
+        if isinstance(record, dict):
+            yield line_no, record.get('table'), record.get('row')
+        else:
+            yield line_no, None, None
+
+
+def csv_records(table, lines):
+    import csv
+
+    for line_no, row in enumerate(csv.DictReader(lines), 2):
+        yield line_no, table, row
+
+
+# ===================== OFFLINE ANALYTICS =====================
+
+# Snapshots of study_sessions for institution-wide reporting live here, one
+# directory per month. Each column is a raw typed array file that reports
+# memory-map instead of querying the live database.
+ANALYTICS_DIR = os.environ.get('ANALYTICS_DIR', os.path.join(BASE_DIR, 'analytics'))
+
+# column -> array typecode. Strings are dictionary-encoded per partition.
+SNAPSHOT_COLUMNS = {
+    'user_id': 'i',
+    'subject': 'i',          # index into meta['subjects'], -1 for none
+    'session_type': 'H',     # index into meta['session_types']
+    'duration_minutes': 'i',
+    'day': 'b',              # day of month
+    'hour': 'b',             # hour of day in UTC: the cohort spans zones, so it isn't shifted per user
+}
+
+
+def _session_chunks(dbs):
+    for db in dbs:
+        cursor = db.execute('''
+            SELECT ss.user_id, s.name, ss.session_type, ss.duration_minutes, ss.created_at
+            FROM study_sessions_all ss LEFT JOIN subjects s ON ss.subject_id = s.id
+        ''')
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            yield rows
+
+
+def snapshot_sessions(dbs, out_dir=None):
+    """Write study_sessions into per-month columnar partitions. Returns row count.
+
+    `dbs` are the main DB and any shards; their rows merge into the same
+    partitions. Reads through one streaming cursor per database and swaps the
+    new snapshot into place atomically, so reports never see a half-written
+    partition.
+    """
+    import array
+
+    out_dir = out_dir or ANALYTICS_DIR
+    partitions = {}
+    total = 0
+    for rows in _session_chunks(dbs):
+        for user_id, subject, session_type, minutes, created_at in rows:
+            created_at = str(created_at)
+            part = partitions.get(created_at[:7])
+            if part is None:
+                part = partitions[created_at[:7]] = {
+                    'columns': {name: array.array(code) for name, code in SNAPSHOT_COLUMNS.items()},
+                    'subjects': {}, 'session_types': {},
+                }
+            cols = part['columns']
+            cols['user_id'].append(user_id)
+            cols['subject'].append(-1 if subject is None else part['subjects'].setdefault(subject, len(part['subjects'])))
+            cols['session_type'].append(part['session_types'].setdefault(session_type or 'manual', len(part['session_types'])))
+            cols['duration_minutes'].append(minutes or 0)
+            cols['day'].append(int(created_at[8:10]))
+            cols['hour'].append(int(created_at[11:13]))
+            total += 1
+
+    staging = out_dir + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for month, part in partitions.items():
+        part_dir = os.path.join(staging, f'sessions-{month}')
+        os.makedirs(part_dir)
+        for name, values in part['columns'].items():
+            with open(os.path.join(part_dir, f'{name}.col'), 'wb') as f:
+                values.tofile(f)
+        with open(os.path.join(part_dir, 'meta.json'), 'w') as f:
+            json.dump({'month': month, 'rows': len(part['columns']['user_id']), 'byteorder': sys.byteorder,
+                       'columns': SNAPSHOT_COLUMNS, 'subjects': list(part['subjects']),
+                       'session_types': list(part['session_types'])}, f)
+
+    previous = out_dir + '.old'
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.rename(out_dir, previous)
+    os.rename(staging, out_dir)
+    shutil.rmtree(previous, ignore_errors=True)
+    return total
+
+
+class SessionPartition:
+    """One month of snapshot columns, memory-mapped as typed memoryviews."""
+
+    def __init__(self, path):
+        import array
+        import mmap
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a {self.meta["byteorder"]}-endian machine')
+        self._maps = []
+        self.columns = {}
+        for name, code in self.meta['columns'].items():
+            if not self.meta['rows']:
+                self.columns[name] = memoryview(array.array(code))
+                continue
+            with open(os.path.join(path, f'{name}.col'), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(mapped)
+            self.columns[name] = memoryview(mapped).cast(code)
+
+    def close(self):
+        for view in self.columns.values():
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def snapshot_months(root=None, start=None, end=None):
+    """Partition directories in month order, optionally limited to [start, end] (YYYY-MM)."""
+    root = root or ANALYTICS_DIR
+    if not os.path.isdir(root):
+        return []
+    months = sorted(d for d in os.listdir(root) if d.startswith('sessions-'))
+    return [os.path.join(root, d) for d in months
+            if (not start or d[9:] >= start) and (not end or d[9:] <= end)]
+
+
+def cohort_report(root=None, start=None, end=None):
+    """Institution-wide aggregates computed from the snapshot, not the live DB."""
+    by_subject = {}
+    by_type = {}
+    by_hour = [0] * 24
+    per_user = {}
+    total_minutes = 0
+    rows = 0
+    for path in snapshot_months(root, start, end):
+        with SessionPartition(path) as part:
+            cols = part.columns
+            subjects = part.meta['subjects']
+            types = part.meta['session_types']
+            subject_minutes = [0] * (len(subjects) + 1)   # last slot collects -1 (no subject)
+            type_minutes = [0] * len(types)
+            type_counts = [0] * len(types)
+            for user_id, subject, stype, minutes, hour in zip(cols['user_id'], cols['subject'], cols['session_type'],
+                                                             cols['duration_minutes'], cols['hour']):
+                subject_minutes[subject] += minutes
+                type_minutes[stype] += minutes
+                type_counts[stype] += 1
+                by_hour[hour] += minutes
+                per_user[user_id] = per_user.get(user_id, 0) + minutes
+            for name, minutes in zip(subjects + ['(none)'], subject_minutes):
+                if minutes:
+                    by_subject[name] = by_subject.get(name, 0) + minutes
+            for name, minutes, count in zip(types, type_minutes, type_counts):
+                entry = by_type.setdefault(name, {'count': 0, 'hours': 0})
+                entry['count'] += count
+                entry['hours'] += minutes
+            total_minutes += sum(type_minutes)
+            rows += part.meta['rows']
+
+    user_hours = sorted(m / 60.0 for m in per_user.values())
+    percentile = lambda p: round(user_hours[min(len(user_hours) - 1, int(p * len(user_hours)))], 1) if user_hours else 0
+    return {
+        'sessions': rows,
+        'total_hours': round(total_minutes / 60.0, 1),
+        'active_users': len(per_user),
+        'hours_per_user': {'p50': percentile(0.5), 'p90': percentile(0.9)},
+        'by_subject': {name: round(m / 60.0, 1) for name, m in sorted(by_subject.items(), key=lambda kv: -kv[1])},
+        'by_type': {name: {'count': e['count'], 'hours': round(e['hours'] / 60.0, 1)} for name, e in by_type.items()},
+        'by_hour': [{'hour': h, 'hours': round(m / 60.0, 1)} for h, m in enumerate(by_hour) if m],
+    }
+
+
+# ===================== SESSION ARCHIVE =====================
+# Sessions older than the horizon are folded into session_rollups (per subject
+# and type) and session_slot_rollups (per UTC quarter-hour), then moved to
+# study_sessions_archive. All-time aggregates read the session_totals and
+# session_slots views, which combine the rollups with the hot table, so they
+# stay correct while study_sessions only holds recent months.
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+# Day-bucketed views (30-day trend, weekly stats) must keep reading raw rows
+ARCHIVE_MIN_DAYS = 35
+ARCHIVE_BATCH = 5000
+
+# Per-subject all-time minutes for one user (:uid), hot and archived combined
+SUBJECT_MINUTES_CTE = '''
+    subject_minutes AS (
+        SELECT subject_id, SUM(minutes) AS minutes FROM session_totals
+        WHERE user_id = :uid GROUP BY subject_id
+    )'''
+
+
+def archive_sessions(db, days=None, now=None):
+    """Fold and move sessions older than `days` into the cold tables. Returns rows moved.
+
+    Works in ARCHIVE_BATCH-sized transactions so app writers are never locked
+    out for long; a crash between batches leaves every row counted exactly once.
+    """
+    days = max(ARCHIVE_MIN_DAYS, days or ARCHIVE_AFTER_DAYS)
+    cutoff = ((now or datetime.utcnow()) - timedelta(days=days)).strftime(SQL_TIMESTAMP)
+    db.isolation_level = None
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)')
+    moved = 0
+    while True:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM archive_batch')
+            count = db.execute('INSERT INTO archive_batch SELECT id FROM study_sessions WHERE created_at < ? ORDER BY id LIMIT ?',
+                               (cutoff, ARCHIVE_BATCH)).rowcount
+            if count:
+                db.execute('''
+                    INSERT INTO session_rollups (user_id, subject_id, session_type, sessions, minutes)
+                    SELECT user_id, COALESCE(subject_id, 0), COALESCE(session_type, 'manual'), COUNT(*), SUM(duration_minutes)
+                    FROM study_sessions WHERE id IN (SELECT id FROM archive_batch)
+                    GROUP BY 1, 2, 3
+                    ON CONFLICT (user_id, subject_id, session_type) DO UPDATE SET
+                        sessions = sessions + excluded.sessions, minutes = minutes + excluded.minutes
+                ''')
+                db.execute('''
+                    INSERT INTO session_slot_rollups (user_id, slot, minutes)
+                    SELECT user_id, (CAST(strftime('%H', created_at) AS INTEGER) * 60
+                                     + CAST(strftime('%M', created_at) AS INTEGER)) / 15, SUM(duration_minutes)
+                    FROM study_sessions WHERE id IN (SELECT id FROM archive_batch)
+                    GROUP BY 1, 2
+                    ON CONFLICT (user_id, slot) DO UPDATE SET minutes = minutes + excluded.minutes
+                ''')
+                db.execute('''
+                    INSERT INTO study_sessions_archive (id, user_id, subject_id, duration_minutes, session_type, notes, created_at)
+                    SELECT id, user_id, subject_id, duration_minutes, session_type, notes, created_at
+                    FROM study_sessions WHERE id IN (SELECT id FROM archive_batch)
+                ''')
+                db.execute('DELETE FROM study_sessions WHERE id IN (SELECT id FROM archive_batch)')
+                # The delete trigger records tombstones; archived rows were not deleted by the user
+                db.execute("DELETE FROM sync_tombstones WHERE table_name = 'study_sessions' AND row_id IN (SELECT id FROM archive_batch)")
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        moved += count
+        if count < ARCHIVE_BATCH:
+            return moved
+
+
+# ===================== PLANNER INDEX =====================
+
+class PlannerIndex:
+    """A user's week as per-day interval lists sorted by start hour.
+
+    Each day keeps a running max of end hours alongside the sorted starts, so
+    "is [start, end) free?" is one bisect even if legacy data already overlaps.
+    """
+
+    def __init__(self, blocks=()):
+        self.days = [[] for _ in range(7)]
+        self.max_end = [[] for _ in range(7)]
+        for b in blocks:
+            self.days[b['day_of_week'] % 7].append((b['start_hour'], b['end_hour'], b['id']))
+        for day in range(7):
+            self.days[day].sort()
+            self._reindex(day)
+
+    def _reindex(self, day):
+        running = 0
+        self.max_end[day] = []
+        for start, end, _ in self.days[day]:
+            running = max(running, end)
+            self.max_end[day].append(running)
+
+    def is_free(self, day, start, end):
+        # Only intervals starting before `end` can overlap; the latest end among them decides
+        i = bisect.bisect_left(self.days[day], (end,))
+        return i == 0 or self.max_end[day][i - 1] <= start
+
+    def conflicts(self, day, start, end):
+        if self.is_free(day, start, end):
+            return []
+        i = bisect.bisect_left(self.days[day], (end,))
+        return [bid for s, e, bid in self.days[day][:i] if e > start]
+
+    def add(self, day, start, end, id):
+        bisect.insort(self.days[day], (start, end, id))
+        self._reindex(day)
+
+    def remove(self, day, id):
+        self.days[day] = [iv for iv in self.days[day] if iv[2] != id]
+        self._reindex(day)
+
+
+def valid_block_span(day, start, end):
+    return (isinstance(day, int) and isinstance(start, int) and isinstance(end, int)
+            and 0 <= day <= 6 and 0 <= start < end <= 24)
+
+
+# ===================== STATIC ASSETS =====================
+# `flask build-assets` writes minified, content-hashed copies of the stylesheet
+# and app script (plus .gz/.br twins) to static/dist with a manifest. Templates
+# link through asset_url(), which falls back to the plain file when no build
+# exists, and hashed files are served as immutable for a year. The manifest
+# keeps its fixed name across builds, so it is revalidated instead.
+
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+ASSET_DIST = 'dist'
+ASSET_SOURCES = ('css/style.css', 'js/app.js')
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+CSS_SPACE_RE = re.compile(r'\s*([{};,>])\s*|:\s+')
+JS_BACKTICK_RE = re.compile(r'(?<!\\)`')
+
+
+def minify_css(text):
+    text = CSS_COMMENT_RE.sub('', text)
+    text = ' '.join(text.split())
+    text = CSS_SPACE_RE.sub(lambda m: m.group(1) or ':', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    """Drops indentation, blank lines and whole-line // comments.
+
+    Deliberately conservative: nothing inside a line is touched, and lines
+    that continue a multi-line template literal are copied through as they
+    are. Literals are tracked by counting unescaped backticks per kept line,
+    so a backtick inside a quoted string or a trailing comment would throw
+    it off; app.js has none.
+    """
+    out = []
+    in_template = False
+    for line in text.splitlines():
+        if not in_template:
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+        out.append(line)
+        if len(JS_BACKTICK_RE.findall(line)) % 2:
+            in_template = not in_template
+    return '\n'.join(out) + '\n'
+
+
+ASSET_MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+def build_assets(static_dir=STATIC_DIR):
+    """Minify, fingerprint and precompress ASSET_SOURCES. Returns the manifest."""
+    import gzip
+    import hashlib
+    try:
+        import brotli # optional; gzip alone already covers every browser
+    except ImportError:
+        brotli = None
+    dist = os.path.join(static_dir, ASSET_DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for name in ASSET_SOURCES:
+        stem, ext = os.path.splitext(name)
+        with open(os.path.join(static_dir, name), encoding='utf-8') as f:
+            data = ASSET_MINIFIERS[ext](f.read()).encode('utf-8')
+        built = f'{ASSET_DIST}/{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}'
+        path = os.path.join(static_dir, built)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data))
+        manifest[name] = built
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+_asset_manifest = None
+
+def asset_manifest():
+    global _asset_manifest
+    if _asset_manifest is None or app.debug: # debug picks up rebuilds without a restart
+        try:
+            with open(os.path.join(STATIC_DIR, ASSET_DIST, 'manifest.json')) as f:
+                _asset_manifest = json.load(f)
+        except (OSError, ValueError):
+            _asset_manifest = {}
+    return _asset_manifest
+
+
+@app.context_processor
+def asset_helpers():
+    def asset_url(name):
+        return url_for('static', filename=asset_manifest().get(name, name))
+    return {'asset_url': asset_url}
+
+
+@app.route('/static/dist/<path:filename>')
+def built_asset(filename):
+    """Hashed build output: precompressed variant when accepted, cached forever."""
+    accepted = request.accept_encodings
+    dist = os.path.join(STATIC_DIR, ASSET_DIST)
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[encoding] and os.path.isfile(os.path.join(dist, filename + suffix)):
+            import mimetypes
+            response = send_from_directory(dist, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
             break
+    else:
+        response = send_from_directory(dist, filename)
+    response.headers['Cache-Control'] = 'no-cache' if filename == 'manifest.json' else IMMUTABLE_CACHE
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
-    # 6. No subjects yet
-    if not context['subjects']:
-        suggestions.append({
-            'title': 'Add your subjects',
-            'description': 'Start by adding the subjects you\'re studying to organize your plan.',
-            'type': 'schedule',
-            'priority': 'high'
-        })
 
-    # 7. Pomodoro suggestion
-    if context['total_sessions'] < 3:
-        suggestions.append({
-            'title': 'Try the Pomodoro Timer',
-            'description': 'Use 25-min focused sessions with 5-min breaks for better productivity.',
-            'type': 'focus',
-            'priority': 'medium'
-        })
+# Public files that shared caches may store
+PUBLIC_ASSET_ENDPOINTS = {'static', 'built_asset'}
 
-    return suggestions[:4]
 
+class AssetAwareSessionInterface(SecureCookieSessionInterface):
+    """Skips the session cookie on public assets.
 
-# ===================== PAGE ROUTES =====================
+    flask_login reads the session after every request, which would otherwise
+    add `Vary: Cookie` and split each asset's cache entry per visitor.
+    """
 
-from flask import send_from_directory
+    def save_session(self, app, user_session, response):
+        if request.endpoint in PUBLIC_ASSET_ENDPOINTS:
+            return
+        super().save_session(app, user_session, response)
+
+
+app.session_interface = AssetAwareSessionInterface()
+
+
+# ===================== JSON RESPONSES =====================
+# List endpoints serialize straight from cursor tuples: no sqlite3.Row or
+# per-row dict(row) copy, orjson when it is installed, compact separators and
+# no key sorting otherwise. Large bodies are gzipped for clients that accept it.
+
+JSON_GZIP_MIN_BYTES = 16 * 1024
+JSON_GZIP_LEVEL = 5 # most of level 9's ratio on JSON at a fraction of the CPU
+
+
+def stdlib_dumps(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'),
+                      check_circular=False, default=str).encode('utf-8')
+
+
+_default_encoder = None
+
+def default_encoder():
+    """orjson when it is installed, else stdlib_dumps; looked up on first use, not at import."""
+    global _default_encoder
+    if _default_encoder is None:
+        try:
+            import orjson # optional; several times faster than the stdlib encoder
+            _default_encoder = lambda payload: orjson.dumps(payload, default=str)
+        except ImportError:
+            _default_encoder = stdlib_dumps
+    return _default_encoder
+
+
+def json_response(payload, status=200, encode=None):
+    """JSON response encoded with `encode` (default_encoder() when omitted)."""
+    body = (encode or default_encoder())(payload)
+    response = app.response_class(body, status=status, mimetype='application/json')
+    if len(body) >= JSON_GZIP_MIN_BYTES:
+        response.vary.add('Accept-Encoding')
+        if request.accept_encodings['gzip']:
+            import gzip
+            response.set_data(gzip.compress(body, compresslevel=JSON_GZIP_LEVEL))
+            response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def rows_response(cursor, encode=None):
+    """JSON list response for an executed SELECT.
+
+    Returns the usual array of objects. With ?shape=columns it returns
+    {"columns": [...], "rows": [[...], ...]} instead, which skips repeating
+    every key on every row. `encode` is passed on to json_response.
+    """
+    cursor.row_factory = None # plain tuples, whatever the connection uses
+    columns = [d[0] for d in cursor.description]
+    if request.args.get('shape') == 'columns':
+        return json_response({'columns': columns, 'rows': cursor.fetchall()}, encode=encode)
+    return json_response([dict(zip(columns, row)) for row in cursor], encode=encode)
+
+
+# ===================== PAGE ROUTES =====================
 
 @app.route('/google40531eb192b92e63.html')
 def google_verification():
@@ -517,7 +2504,7 @@ def register():
         name = request.form.get('name')
         password = request.form.get('password')
         
-        db = get_db()
+        db = get_global_db()
         existing_user = db.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
         
         if existing_user:
@@ -529,7 +2516,7 @@ def register():
         
         # Create initial profile
         user_id = cursor.lastrowid
-        db.execute('INSERT INTO user_profile (user_id, xp, level) VALUES (?, 0, 1)', (user_id,))
+        create_user_profile(db, user_id)
         db.commit()
         
         # Auto-login after register
@@ -549,7 +2536,7 @@ def login():
         email = request.form.get('email')
         password = request.form.get('password')
         
-        db = get_db()
+        db = get_global_db()
         user_data = db.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
         
         if user_data and user_data['password_hash'] and check_password_hash(user_data['password_hash'], password):
@@ -567,10 +2554,11 @@ def login_google():
         flash('Google Client ID not configured on this server.', 'error')
         return redirect(url_for('login'))
     redirect_uri = url_for('auth_callback', _external=True)
-    return google.authorize_redirect(redirect_uri)
+    return get_google().authorize_redirect(redirect_uri)
 
 @app.route('/auth/callback')
 def auth_callback():
+    google = get_google()
     token = google.authorize_access_token()
     user_info = google.parse_id_token(token, nonce=None)
     
@@ -582,7 +2570,7 @@ def auth_callback():
     name = user_info.get('name')
     google_id = user_info.get('sub')
     
-    db = get_db()
+    db = get_global_db()
     
     # Check if user already exists
     user_data = db.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
@@ -596,7 +2584,7 @@ def auth_callback():
         # Create new user via Google
         cursor = db.execute('INSERT INTO users (email, name, google_id) VALUES (?, ?, ?)', (email, name, google_id))
         user_id = cursor.lastrowid
-        db.execute('INSERT INTO user_profile (user_id, xp, level) VALUES (?, 0, 1)', (user_id,))
+        create_user_profile(db, user_id)
         db.commit()
         
     user = load_user(user_id)
@@ -609,6 +2597,88 @@ def logout():
     logout_user()
     return redirect(url_for('login'))
 
+# ===================== TIME ZONES =====================
+# created_at columns hold SQLite's CURRENT_TIMESTAMP (UTC). Days are bucketed in the
+# user's zone by converting each local day to a UTC range, so aggregates stay plain
+# range scans on idx_sessions_user_created instead of per-row conversions.
+
+SQL_TIMESTAMP = '%Y-%m-%d %H:%M:%S'
+
+
+def load_zone(name):
+    """ZoneInfo for an IANA name, or UTC when unset or unknown."""
+    if name:
+        from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return timezone.utc
+
+
+def user_zone(db, user_id):
+    row = db.execute('SELECT timezone FROM user_profile WHERE user_id = ?', (user_id,)).fetchone()
+    return load_zone(row['timezone'] if row else None)
+
+
+def local_today(tz):
+    return datetime.now(tz).date()
+
+
+def local_now(tz):
+    """Naive wall-clock time in `tz`, for hour-of-day and deadline arithmetic."""
+    return datetime.now(tz).replace(tzinfo=None)
+
+
+def utc_midnight(tz, day):
+    """UTC timestamp of the local midnight that starts `day` in `tz`."""
+    return datetime(day.year, day.month, day.day, tzinfo=tz).astimezone(timezone.utc).strftime(SQL_TIMESTAMP)
+
+
+def local_date(timestamp, tz):
+    """Local date in `tz` of a UTC SQL timestamp, at the offset in effect at that instant."""
+    instant = datetime.fromisoformat(str(timestamp)[:19]).replace(tzinfo=timezone.utc)
+    return instant.astimezone(tz).date()
+
+
+def utc_offset_minutes(tz):
+    """The zone's offset right now.
+
+    Only for aggregates that no longer carry dates (session_slots): applied to
+    all history, it files sessions from the other side of a DST change one
+    hour off. Anything with a date goes through local_date or utc_midnight.
+    """
+    return int(datetime.now(tz).utcoffset().total_seconds() // 60)
+
+
+def local_day_ranges(tz, days, label_fmt):
+    """(label, utc_start, utc_end) for the last `days` local days, oldest first.
+
+    Boundaries are local midnights converted to UTC one by one, so a DST change
+    inside the window yields a 23 or 25 hour day rather than a shifted bucket.
+    """
+    today = local_today(tz)
+    ranges = []
+    for i in range(days - 1, -1, -1):
+        day = today - timedelta(days=i)
+        ranges.append((day.strftime(label_fmt), utc_midnight(tz, day), utc_midnight(tz, day + timedelta(days=1))))
+    return ranges
+
+
+def hours_by_local_day(db, user_id, ranges):
+    """Study hours per range from local_day_ranges, in one query."""
+    values = ', '.join('(?, ?, ?)' for _ in ranges)
+    params = [v for i, (_, start, end) in enumerate(ranges) for v in (i, start, end)]
+    rows = db.execute(f'''
+        WITH days(pos, start, finish) AS (VALUES {values})
+        SELECT days.pos, COALESCE(SUM(ss.duration_minutes), 0) / 60.0 AS h
+        FROM days LEFT JOIN study_sessions ss
+            ON ss.user_id = ? AND ss.created_at >= days.start AND ss.created_at < days.finish
+        GROUP BY days.pos ORDER BY days.pos
+    ''', params + [user_id]).fetchall()
+    return [(ranges[r['pos']][0], r['h']) for r in rows]
+
+
 # ===================== ROUTES =====================
 
 # --- Gamification / Profile ---
@@ -627,48 +2697,138 @@ def award_xp(db, xp_amount):
         new_level = calculate_level(new_xp)
         db.execute('UPDATE user_profile SET xp=?, level=? WHERE user_id = ?', (new_xp, new_level, current_user.id))
     db.commit()
+    publish_profile(db)
+
+def record_study_day(db, day):
+    """Advance the streak counters for a session logged on `day` (YYYY-MM-DD)."""
+    profile = db.execute('SELECT current_streak, longest_streak, last_study_day FROM user_profile WHERE user_id = ?',
+                         (current_user.id,)).fetchone()
+    if not profile:
+        db.execute('INSERT INTO user_profile (user_id, current_streak, longest_streak, last_study_day) VALUES (?, 1, 1, ?)',
+                   (current_user.id, day))
+        return
+
+    last = profile['last_study_day']
+    if last == day or (last and last > day):
+        return # Already counted (or a backdated session), streak unchanged
+    yesterday = (datetime.strptime(day, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+    streak = (profile['current_streak'] or 0) + 1 if last == yesterday else 1
+    db.execute('UPDATE user_profile SET current_streak=?, longest_streak=?, last_study_day=? WHERE user_id = ?',
+               (streak, max(streak, profile['longest_streak'] or 0), day, current_user.id))
+
+
+def recompute_streak(db, user_id):
+    """Rebuild a user's streak counters from study_sessions (after deletes or a timezone change).
+
+    Each session is dated with the offset in effect when it happened, so a
+    DST change in the history doesn't move sessions to a neighbouring day.
+    """
+    tz = user_zone(db, user_id)
+    days = sorted({local_date(r[0], tz) for r in db.execute(
+        'SELECT DISTINCT created_at FROM study_sessions_all WHERE user_id = ? AND created_at IS NOT NULL', (user_id,))})
+    current = longest = 0
+    for i, day in enumerate(days):
+        current = current + 1 if i and day - days[i - 1] == timedelta(days=1) else 1
+        longest = max(longest, current)
+    db.execute('UPDATE user_profile SET longest_streak = ?, last_study_day = ?, current_streak = ? WHERE user_id = ?',
+               (longest, days[-1].isoformat() if days else None, current, user_id))
+
+
+def current_streak(profile, tz=timezone.utc):
+    """The stored streak is only live if the last study day was today or yesterday in `tz`."""
+    if not profile or not profile['last_study_day']:
+        return 0
+    today = local_today(tz)
+    live_days = (today.isoformat(), (today - timedelta(days=1)).isoformat())
+    return profile['current_streak'] if profile['last_study_day'] in live_days else 0
+
+
+def profile_payload(db):
+    profile = db.execute('SELECT xp, level, current_streak, longest_streak, last_study_day, timezone FROM user_profile WHERE user_id = ?',
+                         (current_user.id,)).fetchone()
+    if not profile:
+        return {'xp': 0, 'level': 1, 'streak': 0, 'longest_streak': 0, 'timezone': None}
+    return {'xp': profile['xp'], 'level': profile['level'],
+            'streak': current_streak(profile, load_zone(profile['timezone'])),
+            'longest_streak': profile['longest_streak'] or 0, 'timezone': profile['timezone']}
+
+
+def publish_profile(db):
+    publish_event('profile', profile_payload(db))
+
 
 @app.route('/api/profile', methods=['GET'])
 @login_required
 def api_profile():
+    return jsonify(profile_payload(get_db()))
+
+
+@app.route('/api/profile', methods=['PUT'])
+@login_required
+def api_update_profile():
+    """Set the IANA timezone used to bucket study days (e.g. "Asia/Kolkata")."""
+    data = request.get_json(silent=True) or {}
+    name = data.get('timezone')
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        return jsonify({'error': 'Unknown timezone'}), 400
     db = get_db()
-    profile = db.execute('SELECT xp, level FROM user_profile WHERE user_id = ?', (current_user.id,)).fetchone()
-    if not profile:
-        profile = {'xp': 0, 'level': 1}
-    return jsonify(dict(profile))
+    db.execute('''INSERT INTO user_profile (user_id, timezone) VALUES (?, ?)
+                  ON CONFLICT(user_id) DO UPDATE SET timezone = excluded.timezone''',
+               (current_user.id, name))
+    recompute_streak(db, current_user.id) # existing sessions may now fall on other days
+    db.commit()
+    publish_profile(db)
+    return jsonify(profile_payload(db))
+
+
+# --- Live Events ---
+@app.route('/api/events')
+@login_required
+def api_events():
+    """Server-sent event stream of deltas (task, session, profile, planner) for the current user."""
+    user_id = current_user.id
+    last_id = request.headers.get('Last-Event-ID', type=int)
+
+    def stream():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        yield 'retry: 3000\n\n'
+        for message in get_broker().listen(user_id, last_id):
+            if message is None:
+                yield ': keep-alive\n\n'
+            else:
+                event_id, event, payload = message
+                yield f'id: {event_id}\nevent: {event}\ndata: {payload}\n\n'
+            if time.monotonic() > deadline or server_draining.is_set():
+                break
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # --- Stats ---
 @app.route('/api/stats')
 @login_required
 def api_stats():
     db = get_db()
-    total_hours = db.execute('SELECT COALESCE(SUM(duration_minutes), 0) / 60.0 as h FROM study_sessions WHERE user_id = ?', (current_user.id,)).fetchone()['h']
+    totals = db.execute('SELECT COALESCE(SUM(minutes), 0) / 60.0 as h, COALESCE(SUM(sessions), 0) as c FROM session_totals WHERE user_id = ?',
+                        (current_user.id,)).fetchone()
+    total_hours = totals['h']
     tasks_done = db.execute('SELECT COUNT(*) as c FROM tasks WHERE user_id = ? AND status = "completed"', (current_user.id,)).fetchone()['c']
     tasks_total = db.execute('SELECT COUNT(*) as c FROM tasks WHERE user_id = ?', (current_user.id,)).fetchone()['c']
     subjects_count = db.execute('SELECT COUNT(*) as c FROM subjects WHERE user_id = ?', (current_user.id,)).fetchone()['c']
-    sessions_count = db.execute('SELECT COUNT(*) as c FROM study_sessions WHERE user_id = ?', (current_user.id,)).fetchone()['c']
-
-    # Weekly data (last 7 days)
-    weekly = []
-    for i in range(6, -1, -1):
-        day = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        day_label = (datetime.now() - timedelta(days=i)).strftime('%a')
-        hours = db.execute(
-            'SELECT COALESCE(SUM(duration_minutes), 0) / 60.0 as h FROM study_sessions WHERE user_id = ? AND DATE(created_at) = ?',
-            (current_user.id, day,)
-        ).fetchone()['h']
-        weekly.append({'day': day_label, 'hours': round(hours, 1)})
-
-    # Streak calculation
-    streak = 0
-    for i in range(0, 60):
-        day = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        count = db.execute('SELECT COUNT(*) as c FROM study_sessions WHERE user_id = ? AND DATE(created_at) = ?', (current_user.id, day,)).fetchone()['c']
-        if count > 0:
-            streak += 1
-        else:
-            if i > 0:
-                break
+    sessions_count = totals['c']
+
+    # Weekly data (last 7 local days)
+    tz = user_zone(db, current_user.id)
+    weekly = [{'day': label, 'hours': round(hours, 1)}
+              for label, hours in hours_by_local_day(db, current_user.id, local_day_ranges(tz, 7, '%a'))]
+
+    # Streak is maintained incrementally by api_add_session / api_delete_session
+    profile = db.execute('SELECT current_streak, last_study_day FROM user_profile WHERE user_id = ?',
+                         (current_user.id,)).fetchone()
+    streak = current_streak(profile, tz)
 
     # Upcoming deadlines
     upcoming = db.execute('''
@@ -705,7 +2865,7 @@ def api_stats():
 def api_suggestions():
     db = get_db()
     suggestions = get_ai_suggestions(db)
-    ai_powered = bool(ai_client_active)
+    ai_powered = any(s.get('source') in ('ai', 'ai_cached') for s in suggestions)
     return jsonify({'suggestions': suggestions, 'ai_powered': ai_powered})
 
 
@@ -721,44 +2881,94 @@ def api_chat():
         
     db = get_db()
     context = get_study_context(db)
-    
+    if groq_breaker.is_open():
+        return ai_busy_reply(context, "My AI brain is taking a short break", status=503,
+                             retry_after=groq_breaker.snapshot()['retry_in'])
+    if not get_ai_guard().take_token(current_user.id):
+        return ai_busy_reply(context, "You're messaging faster than I can keep up")
+
     prompt = f"""You are 'StudyAI', a friendly, encouraging, and highly intelligent study buddy chatbot.
 The user just said: "{user_message}"
 
 Here is their current study context:
 - Level: {context['profile']['level']} (XP: {context['profile']['xp']})
-- Subjects: {json.dumps(context['subjects'], default=str)}
-- Pending Tasks: {len(context['pending_tasks'])} remaining
-- Top Pending Tasks: {json.dumps(context['pending_tasks'][:3], default=str)}
+{compact_context(context, keys=('subjects', 'tasks'))}
 - Weekly Study Hours: {context['weekly_study_hours']}
 
 Respond naturally, concisely, and helpfully. Keep it under 3-4 sentences. Use emojis if appropriate. Acknowledge their tasks or stats if it makes sense contextually. Do not use markdown outside of bolding text. Do not return JSON."""
 
+    import urllib.error
+
     try:
-        text = call_groq_rest(prompt, model_name='llama-3.3-70b-versatile')
+        with ai_call_slot() as acquired:
+            if not acquired:
+                return ai_busy_reply(context, "I'm helping a lot of students right now")
+            text = call_groq_rest(prompt, model_name='llama-3.3-70b-versatile', kind='chat')
         return jsonify({'reply': text})
+    except CircuitOpenError:
+        return ai_busy_reply(context, "My AI brain is taking a short break", status=503)
     except urllib.error.HTTPError as e:
         return jsonify({'reply': f"[Groq Error: HTTP {e.code} - {e.read().decode()}]"})
     except Exception as e:
         return jsonify({'reply': f"[Groq Error: {str(e)}]"})
 
+
+@app.route('/api/ai/metrics')
+@login_required
+def api_ai_metrics():
+    """Prompt token counts per AI call kind since this worker started."""
+    with _ai_metrics_lock:
+        snapshot = {kind: dict(m) for kind, m in AI_METRICS.items()}
+    return jsonify({'context_budget': PROMPT_CONTEXT_TOKENS, 'kinds': snapshot})
+
+
+@app.route('/api/health')
+def api_health():
+    """Liveness for load balancers: database reachability and the Groq breaker state."""
+    try:
+        get_db().execute('SELECT 1').fetchone()
+        db_ok = True
+    except sqlite3.Error:
+        db_ok = False
+    breaker = groq_breaker.snapshot()
+    degraded = ai_client_active and breaker['state'] != 'closed'
+    return jsonify({
+        'status': 'error' if not db_ok else 'degraded' if degraded else 'ok',
+        'database': db_ok,
+        'ai': {'enabled': ai_client_active, 'breaker': breaker},
+    }), 200 if db_ok else 503
+
+
+def ai_busy_reply(context, reason, status=429, retry_after=None):
+    """Rule-based chat answer for when the limiter or the circuit breaker refused the AI call."""
+    tip = get_smart_fallback_suggestions(context)[:1]
+    reply = f"{reason}, give me a minute! ⏳"
+    if tip:
+        reply += f" Meanwhile: {tip[0]['title']}. {tip[0]['description']}"
+    response = jsonify({'reply': reply, 'limited': True})
+    if retry_after is None:
+        retry_after = 60 / AI_RATE_PER_MINUTE
+    response.headers['Retry-After'] = str(max(1, round(retry_after)))
+    return response, status
+
 # --- Subjects ---
 @app.route('/api/subjects', methods=['GET'])
 @login_required
 def api_get_subjects():
     db = get_db()
-    subjects = db.execute('''
+    subjects = db.execute(f'''
+        WITH {SUBJECT_MINUTES_CTE}
         SELECT s.*, 
-            COALESCE(SUM(ss.duration_minutes), 0) / 60.0 as total_hours,
-            COUNT(DISTINCT t.id) as task_count
+            COALESCE(sm.minutes, 0) / 60.0 as total_hours,
+            COUNT(t.id) as task_count
         FROM subjects s
-        LEFT JOIN study_sessions ss ON s.id = ss.subject_id
+        LEFT JOIN subject_minutes sm ON s.id = sm.subject_id
         LEFT JOIN tasks t ON s.id = t.subject_id AND t.status = 'pending'
-        WHERE s.user_id = ?
+        WHERE s.user_id = :uid
         GROUP BY s.id
         ORDER BY s.name
-    ''', (current_user.id,)).fetchall()
-    return jsonify([dict(s) for s in subjects])
+    ''', {'uid': current_user.id})
+    return rows_response(subjects)
 
 
 @app.route('/api/subjects', methods=['POST'])
@@ -796,6 +3006,22 @@ def api_delete_subject(id):
 
 
 # --- Tasks ---
+def task_row(db, id):
+    return db.execute('''
+        SELECT t.*, s.name as subject_name, s.color as subject_color
+        FROM tasks t LEFT JOIN subjects s ON t.subject_id = s.id
+        WHERE t.id = ? AND t.user_id = ?
+    ''', (id, current_user.id)).fetchone()
+
+
+def publish_task(db, id):
+    """Publish the task's current state; returns it so the response can carry it too."""
+    row = task_row(db, id)
+    task = dict(row) if row else {'id': id, 'deleted': True}
+    publish_event('task', task)
+    return task
+
+
 @app.route('/api/tasks', methods=['GET'])
 @login_required
 def api_get_tasks():
@@ -809,8 +3035,8 @@ def api_get_tasks():
             CASE status WHEN 'pending' THEN 0 ELSE 1 END,
             CASE priority WHEN 'high' THEN 0 WHEN 'medium' THEN 1 ELSE 2 END,
             deadline ASC
-    ''', (current_user.id,)).fetchall()
-    return jsonify([dict(t) for t in tasks])
+    ''', (current_user.id,))
+    return rows_response(tasks)
 
 
 @app.route('/api/tasks', methods=['POST'])
@@ -824,8 +3050,9 @@ def api_add_task():
          data.get('priority', 'medium'), data.get('deadline'))
     )
     db.commit()
+    task = publish_task(db, cursor.lastrowid)
     award_xp(db, 5) # 5 xp for creating task
-    return jsonify({'success': True, 'id': cursor.lastrowid})
+    return jsonify({'success': True, 'id': cursor.lastrowid, 'task': task})
 
 
 @app.route('/api/tasks/<int:id>', methods=['PUT'])
@@ -837,7 +3064,7 @@ def api_update_task(id):
                (data.get('subject_id'), data['title'], data.get('description', ''),
                 data.get('priority', 'medium'), data.get('deadline'), data.get('status', 'pending'), id, current_user.id))
     db.commit()
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'task': publish_task(db, id)})
 
 
 @app.route('/api/tasks/<int:id>/toggle', methods=['POST'])
@@ -846,6 +3073,7 @@ def api_toggle_task(id):
     db = get_db()
     task = db.execute('SELECT status FROM tasks WHERE id=? AND user_id = ?', (id, current_user.id)).fetchone()
     earned_xp = 0
+    updated = None
     if task:
         new_status = 'completed' if task['status'] != 'completed' else 'pending'
         db.execute('UPDATE tasks SET status=? WHERE id=? AND user_id = ?', (new_status, id, current_user.id))
@@ -856,7 +3084,8 @@ def api_toggle_task(id):
             earned_xp = 50
             
         db.commit()
-    return jsonify({'success': True, 'earned_xp': earned_xp})
+        updated = publish_task(db, id)
+    return jsonify({'success': True, 'earned_xp': earned_xp, 'task': updated})
 
 @app.route('/api/tasks/<int:id>/status', methods=['PUT'])
 @login_required
@@ -869,13 +3098,14 @@ def api_update_task_status(id):
     
     db.execute('UPDATE tasks SET status = ? WHERE id = ? AND user_id = ?', (status, id, current_user.id))
     db.commit()
+    task = publish_task(db, id)
     
     xp_awarded = 0
     if prev and prev['status'] != 'completed' and status == 'completed':
         xp_awarded = 25
         award_xp(db, xp_awarded)
         
-    return jsonify({'success': True, 'xp_awarded': xp_awarded})
+    return jsonify({'success': True, 'xp_awarded': xp_awarded, 'task': task})
 
 
 @app.route('/api/tasks/<int:id>', methods=['DELETE'])
@@ -884,6 +3114,7 @@ def api_delete_task(id):
     db = get_db()
     db.execute('DELETE FROM tasks WHERE id = ? AND user_id = ?', (id, current_user.id))
     db.commit()
+    publish_event('task', {'id': id, 'deleted': True})
     return jsonify({'success': True})
 
 
@@ -897,8 +3128,8 @@ def api_get_sessions():
         FROM study_sessions ss LEFT JOIN subjects s ON ss.subject_id = s.id
         WHERE ss.user_id = ?
         ORDER BY ss.created_at DESC LIMIT 50
-    ''', (current_user.id,)).fetchall()
-    return jsonify([dict(s) for s in sessions])
+    ''', (current_user.id,))
+    return rows_response(sessions)
 
 
 @app.route('/api/sessions', methods=['POST'])
@@ -916,18 +3147,46 @@ def api_add_session():
         (current_user.id, data.get('subject_id'), duration, 
          data.get('session_type', 'manual'), data.get('notes', ''))
     )
+
+    # Keep streak and goal progress counters in step with the new session
+    record_study_day(db, local_today(user_zone(db, current_user.id)).isoformat()) # created_at is now
+    db.execute("UPDATE goals SET current_hours = current_hours + ? WHERE user_id = ? AND status = 'active'",
+               (duration / 60.0, current_user.id))
     db.commit()
-    award_xp(db, xp_awarded)
+    session_row = db.execute('''
+        SELECT ss.*, s.name as subject_name, s.color as subject_color
+        FROM study_sessions ss LEFT JOIN subjects s ON ss.subject_id = s.id
+        WHERE ss.id = ?
+    ''', (cursor.lastrowid,)).fetchone()
+    publish_event('session', dict(session_row))
+    award_xp(db, xp_awarded) # also publishes the updated streak with the XP
     
-    return jsonify({'success': True, 'id': cursor.lastrowid, 'xp_awarded': xp_awarded})
+    return jsonify({'success': True, 'id': cursor.lastrowid, 'xp_awarded': xp_awarded, 'session': dict(session_row)})
 
 
 @app.route('/api/sessions/<int:id>', methods=['DELETE'])
 @login_required
 def api_delete_session(id):
     db = get_db()
+    tz = user_zone(db, current_user.id)
+    removed = db.execute('SELECT duration_minutes, created_at FROM study_sessions WHERE id=? AND user_id = ?',
+                         (id, current_user.id)).fetchone()
     db.execute('DELETE FROM study_sessions WHERE id=? AND user_id = ?', (id, current_user.id))
+
+    if removed:
+        # Only goals that were already running when the session happened counted it
+        db.execute('''UPDATE goals SET current_hours = MAX(0, current_hours - ?)
+                      WHERE user_id = ? AND status = 'active' AND created_at <= ?''',
+                   (removed['duration_minutes'] / 60.0, current_user.id, removed['created_at']))
+        day = local_date(removed['created_at'], tz)
+        same_day = db.execute('SELECT 1 FROM study_sessions WHERE user_id = ? AND created_at >= ? AND created_at < ? LIMIT 1',
+                              (current_user.id, utc_midnight(tz, day), utc_midnight(tz, day + timedelta(days=1)))).fetchone()
+        if not same_day:
+            recompute_streak(db, current_user.id)
     db.commit()
+    if removed:
+        publish_event('session', {'id': id, 'deleted': True})
+        publish_profile(db)
     return jsonify({'success': True})
 
 
@@ -936,8 +3195,8 @@ def api_delete_session(id):
 @login_required
 def api_get_goals():
     db = get_db()
-    goals = db.execute('SELECT * FROM goals WHERE user_id = ? ORDER BY status, deadline', (current_user.id,)).fetchall()
-    return jsonify([dict(g) for g in goals])
+    goals = db.execute('SELECT * FROM goals WHERE user_id = ? ORDER BY status, deadline', (current_user.id,))
+    return rows_response(goals)
 
 
 @app.route('/api/goals', methods=['POST'])
@@ -956,8 +3215,9 @@ def api_add_goal():
 def api_update_goal(id):
     db = get_db()
     data = request.json
-    db.execute('UPDATE goals SET title=?, target_hours=?, current_hours=?, deadline=?, status=? WHERE id=? AND user_id = ?',
-               (data['title'], data.get('target_hours', 10), data.get('current_hours', 0),
+    # current_hours is accumulated from sessions; only overwrite it when given explicitly
+    db.execute('UPDATE goals SET title=?, target_hours=?, current_hours=COALESCE(?, current_hours), deadline=?, status=? WHERE id=? AND user_id = ?',
+               (data['title'], data.get('target_hours', 10), data.get('current_hours'),
                 data.get('deadline'), data.get('status', 'active'), id, current_user.id))
     db.commit()
     return jsonify({'success': True})
@@ -985,7 +3245,7 @@ def api_get_notes():
             FROM notes n 
             LEFT JOIN subjects s ON n.subject_id = s.id 
             WHERE n.subject_id = ? AND n.user_id = ? ORDER BY n.updated_at DESC
-        ''', (subject_id, current_user.id)).fetchall()
+        ''', (subject_id, current_user.id))
     else:
         notes = db.execute('''
             SELECT n.*, s.name as subject_name, s.color as subject_color 
@@ -993,9 +3253,9 @@ def api_get_notes():
             LEFT JOIN subjects s ON n.subject_id = s.id
             WHERE n.user_id = ?
             ORDER BY n.updated_at DESC
-        ''', (current_user.id,)).fetchall()
+        ''', (current_user.id,))
         
-    return jsonify([dict(n) for n in notes])
+    return rows_response(notes)
 
 
 @app.route('/api/notes', methods=['POST'])
@@ -1017,6 +3277,9 @@ def api_save_note():
             (current_user.id, data.get('subject_id'), data.get('title'), data.get('content', ''))
         )
         note_id = cursor.lastrowid
+        # First review the day after writing it
+        db.execute('INSERT INTO note_reviews (note_id, user_id, due_date) VALUES (?, ?, ?)',
+                   (note_id, current_user.id, (local_today(user_zone(db, current_user.id)) + timedelta(days=1)).isoformat()))
         award_xp(db, 15) # new note
         
     db.commit()
@@ -1032,6 +3295,92 @@ def api_delete_note(id):
     return jsonify({'success': True})
 
 
+# --- Reviews ---
+@app.route('/api/reviews/due', methods=['GET'])
+@login_required
+def api_due_reviews():
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    db = get_db()
+    today = local_today(user_zone(db, current_user.id)).isoformat()
+    # Range scan on idx_note_reviews_due (user_id, due_date)
+    reviews = db.execute('''
+        SELECT r.note_id, r.due_date, r.interval_days, r.repetitions, n.title, n.subject_id,
+               s.name as subject_name, s.color as subject_color
+        FROM note_reviews r
+        JOIN notes n ON n.id = r.note_id
+        LEFT JOIN subjects s ON n.subject_id = s.id
+        WHERE r.user_id = ? AND r.due_date <= ?
+        ORDER BY r.due_date LIMIT ?
+    ''', (current_user.id, today, limit))
+    return rows_response(reviews)
+
+
+@app.route('/api/reviews/<int:note_id>', methods=['POST'])
+@login_required
+def api_grade_review(note_id):
+    quality = (request.json or {}).get('quality')
+    if not isinstance(quality, int) or isinstance(quality, bool) or not 0 <= quality <= 5:
+        return jsonify({'success': False, 'error': 'quality must be 0-5'}), 400
+    db = get_db()
+    review = db.execute('SELECT ease, interval_days, repetitions FROM note_reviews WHERE note_id = ? AND user_id = ?',
+                        (note_id, current_user.id)).fetchone()
+    if not review:
+        return jsonify({'success': False, 'error': 'not found'}), 404
+
+    ease, interval, repetitions = sm2_schedule(review['ease'], review['interval_days'], review['repetitions'], quality)
+    due = (local_today(user_zone(db, current_user.id)) + timedelta(days=interval)).isoformat()
+    db.execute('''UPDATE note_reviews SET ease=?, interval_days=?, repetitions=?, due_date=?, last_reviewed=CURRENT_TIMESTAMP
+                  WHERE note_id=? AND user_id=?''', (ease, interval, repetitions, due, note_id, current_user.id))
+    db.commit()
+    award_xp(db, 5) # reviewed a note
+    return jsonify({'success': True, 'due_date': due, 'interval_days': interval, 'xp_awarded': 5})
+
+
+# --- Export / Import ---
+@app.route('/api/export', methods=['GET'])
+@login_required
+def api_export():
+    """Stream the user's data as NDJSON (all tables) or CSV (one `table`)."""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt == 'csv':
+        table = request.args.get('table')
+        if table not in EXPORT_TABLES:
+            return jsonify({'success': False, 'error': f'csv export needs table= one of {", ".join(EXPORT_TABLES)}'}), 400
+        tables = (table,)
+    else:
+        tables = EXPORT_TABLES
+    user_id = current_user.id
+    path = shard_path(user_shard(get_global_db(), user_id))
+
+    def stream():
+        # Own connection: the generator outlives the request's g.db
+        db = sqlite3.connect(path)
+        try:
+            yield from iter_export(db, tables, fmt, user_id)
+        finally:
+            db.close()
+
+    name = f'study-planner-{tables[0] if fmt == "csv" else "export"}.{fmt}'
+    return app.response_class(stream(), mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+                              headers={'Content-Disposition': f'attachment; filename={name}'})
+
+
+@app.route('/api/import', methods=['POST'])
+@login_required
+def api_import():
+    """Stream-parse an NDJSON (or CSV with ?table=) upload and insert it in batches."""
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8')
+    if request.args.get('format') == 'csv':
+        table = request.args.get('table')
+        if table not in EXPORT_TABLES:
+            return jsonify({'success': False, 'error': f'csv import needs table= one of {", ".join(EXPORT_TABLES)}'}), 400
+        records = csv_records(table, lines)
+    else:
+        records = ndjson_records(lines)
+    counts, errors, skipped = import_records(get_db(), current_user.id, records)
+    return jsonify({'success': not errors, 'imported': counts, 'errors': errors, 'skipped': skipped})
+
+
 # --- Planner Blocks ---
 @app.route('/api/planner', methods=['GET'])
 @login_required
@@ -1043,8 +3392,29 @@ def api_get_planner():
         LEFT JOIN subjects s ON p.subject_id = s.id
         WHERE p.user_id = ?
         ORDER BY p.day_of_week, p.start_hour
-    ''', (current_user.id,)).fetchall()
-    return jsonify([dict(b) for b in blocks])
+    ''', (current_user.id,))
+    return rows_response(blocks)
+
+
+def planner_row(db, id):
+    return db.execute('''
+        SELECT p.*, s.name as subject_name, s.color as subject_color
+        FROM planner_blocks p LEFT JOIN subjects s ON p.subject_id = s.id
+        WHERE p.id = ? AND p.user_id = ?
+    ''', (id, current_user.id)).fetchone()
+
+
+def planner_index(db):
+    blocks = db.execute('SELECT id, day_of_week, start_hour, end_hour FROM planner_blocks WHERE user_id = ?',
+                        (current_user.id,)).fetchall()
+    return PlannerIndex(blocks)
+
+
+def publish_planner(db, ids, deleted=()):
+    for id in ids:
+        publish_event('planner', dict(planner_row(db, id)))
+    for id in deleted:
+        publish_event('planner', {'id': id, 'deleted': True})
 
 
 @app.route('/api/planner', methods=['POST'])
@@ -1052,13 +3422,157 @@ def api_get_planner():
 def api_add_planner_block():
     data = request.json
     db = get_db()
+    day, start = data.get('day_of_week'), data.get('start_hour')
+    end = data.get('end_hour', start + 1 if isinstance(start, int) else None)
+    if not valid_block_span(day, start, end):
+        return jsonify({'success': False, 'error': 'invalid time range'}), 400
+
+    conflicts = planner_index(db).conflicts(day, start, end)
+    if conflicts:
+        return jsonify({'success': False, 'error': 'overlap', 'conflicts': conflicts}), 409
+
     cursor = db.execute(
         'INSERT INTO planner_blocks (user_id, subject_id, day_of_week, start_hour, end_hour, title) VALUES (?, ?, ?, ?, ?, ?)',
-        (current_user.id, data.get('subject_id'), data.get('day_of_week'), data.get('start_hour'), 
-         data.get('end_hour', data.get('start_hour') + 1), data.get('title', ''))
+        (current_user.id, data.get('subject_id'), day, start, end, data.get('title', ''))
     )
     db.commit()
-    return jsonify({'success': True, 'id': cursor.lastrowid})
+    publish_planner(db, [cursor.lastrowid])
+    return jsonify({'success': True, 'id': cursor.lastrowid, 'block': dict(planner_row(db, cursor.lastrowid))})
+
+
+@app.route('/api/planner/bulk', methods=['PATCH'])
+@login_required
+def api_bulk_move_planner():
+    """Move/resize several blocks at once; all-or-nothing if any would overlap."""
+    moves = (request.json or {}).get('moves', [])
+    if not isinstance(moves, list) or not all(isinstance(m, dict) for m in moves):
+        return jsonify({'success': False, 'error': 'moves must be a list of objects'}), 400
+    db = get_db()
+    index = planner_index(db)
+    current = {r['id']: r for r in db.execute('SELECT id, day_of_week, start_hour, end_hour FROM planner_blocks WHERE user_id = ?',
+                                              (current_user.id,))}
+
+    # Lift every moved block out first so blocks can swap places
+    targets = []
+    for move in moves:
+        block = current.get(move.get('id'))
+        if not block:
+            return jsonify({'success': False, 'error': f'unknown block {move.get("id")}'}), 404
+        day = move.get('day_of_week', block['day_of_week'])
+        start = move.get('start_hour', block['start_hour'])
+        end = move.get('end_hour', start + block['end_hour'] - block['start_hour'] if isinstance(start, int) else None)
+        if not valid_block_span(day, start, end):
+            return jsonify({'success': False, 'error': f'invalid time range for block {block["id"]}'}), 400
+        index.remove(block['day_of_week'], block['id'])
+        targets.append((block['id'], day, start, end))
+
+    for id, day, start, end in targets:
+        conflicts = index.conflicts(day, start, end)
+        if conflicts:
+            return jsonify({'success': False, 'error': 'overlap', 'id': id, 'conflicts': conflicts}), 409
+        index.add(day, start, end, id)
+
+    db.executemany('UPDATE planner_blocks SET day_of_week=?, start_hour=?, end_hour=? WHERE id=? AND user_id=?',
+                   [(day, start, end, id, current_user.id) for id, day, start, end in targets])
+    db.commit()
+    publish_planner(db, [t[0] for t in targets])
+    return jsonify({'success': True, 'blocks': [dict(planner_row(db, t[0])) for t in targets]})
+
+
+@app.route('/api/planner/<int:id>/split', methods=['POST'])
+@login_required
+def api_split_planner_block(id):
+    at = (request.json or {}).get('at_hour')
+    db = get_db()
+    block = planner_row(db, id)
+    if not block:
+        return jsonify({'success': False, 'error': 'not found'}), 404
+    if not isinstance(at, int) or not block['start_hour'] < at < block['end_hour']:
+        return jsonify({'success': False, 'error': 'at_hour must fall inside the block'}), 400
+
+    db.execute('UPDATE planner_blocks SET end_hour=? WHERE id=? AND user_id=?', (at, id, current_user.id))
+    cursor = db.execute(
+        'INSERT INTO planner_blocks (user_id, subject_id, day_of_week, start_hour, end_hour, title, source) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (current_user.id, block['subject_id'], block['day_of_week'], at, block['end_hour'], block['title'], block['source'])
+    )
+    db.commit()
+    publish_planner(db, [id, cursor.lastrowid])
+    return jsonify({'success': True, 'blocks': [dict(planner_row(db, id)), dict(planner_row(db, cursor.lastrowid))]})
+
+
+@app.route('/api/planner/merge', methods=['POST'])
+@login_required
+def api_merge_planner_blocks():
+    """Merge touching/overlapping blocks on one day into the earliest of them."""
+    ids = (request.json or {}).get('ids', [])
+    if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+        return jsonify({'success': False, 'error': 'ids must be a list of block ids'}), 400
+    db = get_db()
+    rows = [planner_row(db, i) for i in set(ids)]
+    blocks = sorted((b for b in rows if b), key=lambda b: b['start_hour'])
+    if len(blocks) < 2 or len(blocks) != len(rows):
+        return jsonify({'success': False, 'error': 'need at least two of your blocks'}), 400
+    if len({b['day_of_week'] for b in blocks}) > 1:
+        return jsonify({'success': False, 'error': 'blocks are on different days'}), 400
+    end = blocks[0]['end_hour']
+    for b in blocks[1:]:
+        if b['start_hour'] > end:
+            return jsonify({'success': False, 'error': 'blocks are not contiguous'}), 400
+        end = max(end, b['end_hour'])
+
+    keep, removed = blocks[0]['id'], [b['id'] for b in blocks[1:]]
+    db.execute('UPDATE planner_blocks SET end_hour=? WHERE id=? AND user_id=?', (end, keep, current_user.id))
+    db.executemany('DELETE FROM planner_blocks WHERE id=? AND user_id=?', [(i, current_user.id) for i in removed])
+    db.commit()
+    publish_planner(db, [keep], deleted=removed)
+    return jsonify({'success': True, 'block': dict(planner_row(db, keep)), 'removed': removed})
+
+
+@app.route('/api/planner/generate', methods=['POST'])
+@login_required
+def api_generate_planner():
+    """Replace auto-generated blocks with a fresh plan around the manual ones."""
+    data = request.json or {}
+    try:
+        free_hours = (int(data.get('free_start', 8)), int(data.get('free_end', 20)))
+        max_hours = int(data.get('max_hours_per_day', 4))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'free_start, free_end and max_hours_per_day must be integers'}), 400
+    if not 0 <= free_hours[0] < free_hours[1] <= 24 or max_hours < 1:
+        return jsonify({'success': False, 'error': 'need 0 <= free_start < free_end <= 24 and max_hours_per_day >= 1'}), 400
+    db = get_db()
+
+    tasks = db.execute("SELECT id, title, subject_id, priority, deadline FROM tasks WHERE user_id = ? AND status != 'completed'",
+                       (current_user.id,)).fetchall()
+    # Subjects studied less than the average over the last week are in deficit
+    tz = user_zone(db, current_user.id)
+    week_ago = utc_midnight(tz, local_today(tz) - timedelta(days=7))
+    hours = db.execute('''
+        SELECT s.id, s.name, COALESCE(SUM(ss.duration_minutes), 0) / 60.0 as hours
+        FROM subjects s LEFT JOIN study_sessions ss ON s.id = ss.subject_id AND ss.created_at >= ?
+        WHERE s.user_id = ?
+        GROUP BY s.id
+    ''', (week_ago, current_user.id)).fetchall()
+    avg = sum(r['hours'] for r in hours) / len(hours) if hours else 0
+    deficits = {r['id']: (r['name'], avg - r['hours']) for r in hours if avg - r['hours'] > 0}
+
+    replaced = [r['id'] for r in db.execute("SELECT id FROM planner_blocks WHERE user_id = ? AND source = 'auto'",
+                                            (current_user.id,))]
+    db.execute("DELETE FROM planner_blocks WHERE user_id = ? AND source = 'auto'", (current_user.id,))
+    busy = set()
+    for b in db.execute('SELECT day_of_week, start_hour, end_hour FROM planner_blocks WHERE user_id = ?', (current_user.id,)):
+        busy.update((b['day_of_week'], h) for h in range(b['start_hour'], b['end_hour']))
+
+    blocks, unscheduled = generate_study_plan([dict(t) for t in tasks], deficits, busy, local_now(tz),
+                                              free_hours=free_hours, max_hours_per_day=max_hours)
+    for b in blocks:
+        b['id'] = db.execute(
+            "INSERT INTO planner_blocks (user_id, subject_id, day_of_week, start_hour, end_hour, title, source) VALUES (?, ?, ?, ?, ?, ?, 'auto')",
+            (current_user.id, b['subject_id'], b['day_of_week'], b['start_hour'], b['end_hour'], b['title'])
+        ).lastrowid
+    db.commit()
+    publish_planner(db, [b['id'] for b in blocks], deleted=replaced)
+    return jsonify({'success': True, 'blocks': blocks, 'unscheduled': unscheduled})
 
 
 @app.route('/api/planner/<int:id>', methods=['DELETE'])
@@ -1067,9 +3581,57 @@ def api_delete_planner_block(id):
     db = get_db()
     db.execute('DELETE FROM planner_blocks WHERE id = ? AND user_id = ?', (id, current_user.id))
     db.commit()
+    publish_planner(db, [], deleted=[id])
     return jsonify({'success': True})
 
 
+# --- Delta Sync ---
+
+# Tombstones older than this are pruned; clients that last synced before the
+# horizon get a full reset instead of a delta.
+SYNC_TOMBSTONE_DAYS = 30
+
+
+@app.route('/api/sync', methods=['GET'])
+@login_required
+def api_sync():
+    """Rows changed or deleted since `since` (an opaque token from a previous sync)."""
+    since = request.args.get('since') or ''
+    db = get_db()
+    horizon = (datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    reset = bool(since) and since < horizon
+    if reset:
+        since = ''
+
+    # One read transaction so every table comes from the same snapshot; the new
+    # token is the newest stamp actually seen, which no later commit can precede.
+    # Comparisons are >= so rows sharing the token's millisecond are re-sent, never lost.
+    db.execute('BEGIN')
+    try:
+        token = since
+        changes = {}
+        for table in SYNC_TABLES:
+            rows = db.execute(f'SELECT * FROM {table} WHERE user_id = ? AND updated_at >= ? ORDER BY updated_at',
+                              (current_user.id, since)).fetchall()
+            changes[table] = [dict(r) for r in rows]
+            if rows:
+                token = max(token, rows[-1]['updated_at'])
+
+        deleted = {table: [] for table in SYNC_TABLES}
+        if since:
+            for row in db.execute('SELECT table_name, row_id, deleted_at FROM sync_tombstones WHERE user_id = ? AND deleted_at >= ?',
+                                  (current_user.id, since)):
+                deleted.setdefault(row['table_name'], []).append(row['row_id'])
+                token = max(token, row['deleted_at'])
+    finally:
+        db.commit()
+
+    db.execute('DELETE FROM sync_tombstones WHERE user_id = ? AND deleted_at < ?', (current_user.id, horizon))
+    db.commit()
+
+    return jsonify({'token': token, 'reset': reset or not since, 'changes': changes, 'deleted': deleted})
+
+
 # --- Analytics ---
 @app.route('/api/analytics', methods=['GET'])
 @login_required
@@ -1077,36 +3639,33 @@ def api_analytics():
     db = get_db()
 
     # Hours by subject
-    by_subject = db.execute('''
-        SELECT s.name, s.color, COALESCE(SUM(ss.duration_minutes), 0) / 60.0 as hours
-        FROM subjects s LEFT JOIN study_sessions ss ON s.id = ss.subject_id
-        WHERE s.user_id = ?
-        GROUP BY s.id ORDER BY hours DESC
-    ''', (current_user.id,)).fetchall()
-
-    # Daily trend (last 30 days)
-    daily = []
-    for i in range(29, -1, -1):
-        day = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        label = (datetime.now() - timedelta(days=i)).strftime('%d %b')
-        h = db.execute(
-            'SELECT COALESCE(SUM(duration_minutes), 0) / 60.0 as h FROM study_sessions WHERE user_id = ? AND DATE(created_at) = ?',
-            (current_user.id, day,)
-        ).fetchone()['h']
-        daily.append({'date': label, 'hours': round(h, 1)})
+    by_subject = db.execute(f'''
+        WITH {SUBJECT_MINUTES_CTE}
+        SELECT s.name, s.color, COALESCE(sm.minutes, 0) / 60.0 as hours
+        FROM subjects s LEFT JOIN subject_minutes sm ON s.id = sm.subject_id
+        WHERE s.user_id = :uid
+        ORDER BY hours DESC
+    ''', {'uid': current_user.id}).fetchall()
+
+    # Daily trend (last 30 local days)
+    tz = user_zone(db, current_user.id)
+    daily = [{'date': label, 'hours': round(h, 1)}
+             for label, h in hours_by_local_day(db, current_user.id, local_day_ranges(tz, 30, '%d %b'))]
 
     # Sessions by type
     by_type = db.execute('''
-        SELECT session_type, COUNT(*) as count, SUM(duration_minutes) / 60.0 as hours
-        FROM study_sessions WHERE user_id = ? GROUP BY session_type
+        SELECT session_type, SUM(sessions) as count, SUM(minutes) / 60.0 as hours
+        FROM session_totals WHERE user_id = ? GROUP BY session_type
     ''', (current_user.id,)).fetchall()
 
     # Productivity by hour
+    # UTC quarter-hour slots shifted by the zone's current offset (+1440 keeps the sum
+    # non-negative). The slots carry no dates, so hours from before a DST change are off by one.
     by_hour = db.execute('''
-        SELECT CAST(strftime('%H', created_at) AS INTEGER) as hour,
-               COALESCE(SUM(duration_minutes), 0) / 60.0 as hours
-        FROM study_sessions WHERE user_id = ? GROUP BY hour ORDER BY hour
-    ''', (current_user.id,)).fetchall()
+        SELECT (slot * 15 + ? + 1440) / 60 % 24 as hour,
+               COALESCE(SUM(minutes), 0) / 60.0 as hours
+        FROM session_slots WHERE user_id = ? GROUP BY hour ORDER BY hour
+    ''', (utc_offset_minutes(tz), current_user.id)).fetchall()
 
     return jsonify({
         'by_subject': [dict(s) for s in by_subject],
@@ -1116,9 +3675,764 @@ def api_analytics():
     })
 
 
+# ===================== TOOLING =====================
+
+@app.cli.group('db')
+def db_cli():
+    """Schema migration and shard maintenance commands."""
+
+
+@db_cli.command('upgrade')
+@click.option('--target', type=int, default=None, help='Stop after this migration version.')
+@click.option('--database', default=None, help='Path to the SQLite file (defaults to DATABASE).')
+def db_upgrade(target, database):
+    """Apply pending migrations to an existing database without downtime."""
+    db = sqlite3.connect(database or DATABASE)
+    try:
+        applied = migrate_db(db, target)
+    finally:
+        db.close()
+    if applied:
+        click.echo('Applied migrations: ' + ', '.join(str(v) for v in applied))
+    else:
+        click.echo('Database already up to date.')
+
+
+@db_cli.command('status')
+@click.option('--database', default=None, help='Path to the SQLite file (defaults to DATABASE).')
+def db_status(database):
+    """List migrations and whether each has been applied."""
+    db = sqlite3.connect(database or DATABASE)
+    try:
+        rows = {}
+        if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_version'").fetchone():
+            rows = {r[0]: r[1] for r in db.execute('SELECT version, applied_at FROM schema_version')}
+    finally:
+        db.close()
+    for version, name, sql in MIGRATIONS:
+        click.echo(f'{version:>4}  {rows.get(version, "pending"):<19}  {name}')
+
+
+@db_cli.command('verify')
+@click.option('--database', default=None, help='Path to the SQLite file (defaults to DATABASE).')
+def db_verify(database):
+    """Check that every migration is applied and its tables/indexes exist."""
+    db = sqlite3.connect(database or DATABASE)
+    try:
+        problems = verify_schema(db)
+    finally:
+        db.close()
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException(f'{len(problems)} schema problem(s) found')
+    click.echo(f'Schema OK at version {SCHEMA_VERSION}.')
+
+
+def move_user_data(user_id, source, target):
+    """Move one user's rows from shard `source` to `target` (None = main DB).
+
+    Runs as one transaction over the source with the target (and the main DB,
+    for the user_shards map) attached, holding the source's write lock
+    throughout. A request that already opened the old shard can still write
+    there while the move runs, so rebalance during quiet hours.
+
+    Rows keep their ids when those already lie in the target's id range.
+    Other rows are renumbered into it: AUTOINCREMENT always allocates above
+    the largest id in a table, so a foreign id would move the target into
+    another database's range. Sync clients get tombstones for the old ids and
+    see the renumbered rows as new. A target whose counters already left its
+    range is refused.
+    """
+    src_path, dst_path = shard_path(source), shard_path(target)
+    if target is None:
+        connect_db(dst_path).close()
+    else:
+        open_shard(target).close() # creates the file, schema and id range
+    db = connect_db(src_path)
+    db.isolation_level = None
+    try:
+        db.execute('ATTACH DATABASE ? AS dst', (dst_path,))
+        meta = 'main' if source is None else 'dst' if target is None else 'meta'
+        if meta == 'meta':
+            db.execute('ATTACH DATABASE ? AS meta', (DATABASE,))
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            def purge(schema):
+                for table in reversed(SHARDED_TABLES):
+                    db.execute(f'DELETE FROM {schema}.{table} WHERE user_id = ?', (user_id,))
+                # Deleting rows fires the sync triggers; those tombstones are not real deletes
+                db.execute(f'DELETE FROM {schema}.sync_tombstones WHERE user_id = ?', (user_id,))
+
+            purge('dst') # leftovers of an interrupted move
+            renumber_moved_rows(db, user_id, target, os.path.basename(dst_path))
+            if target is not None:
+                db.execute('INSERT OR REPLACE INTO dst.users (id, email, name) SELECT id, email, name FROM main.users WHERE id = ?',
+                           (user_id,))
+            moved = 0
+            for table in SHARDED_TABLES:
+                cols = [c[1] for c in db.execute(f'PRAGMA dst.table_info({table})')]
+                values = ', '.join(
+                    f"COALESCE((SELECT new FROM temp.id_map WHERE tbl = '{table if c == 'id' else SHARD_ID_REFS[c]}' "
+                    f"AND old = src.{c}), src.{c})" if c == 'id' or c in SHARD_ID_REFS else f'src.{c}'
+                    for c in cols)
+                moved += db.execute(f'INSERT INTO dst.{table} ({", ".join(cols)}) '
+                                    f'SELECT {values} FROM main.{table} AS src WHERE user_id = ?', (user_id,)).rowcount
+            db.execute(f'''INSERT INTO dst.sync_tombstones (user_id, table_name, row_id, deleted_at)
+                          SELECT ?, tbl, old, {SYNC_NOW} FROM temp.id_map
+                          WHERE tbl IN ({", ".join("?" for _ in SYNC_TABLES)})''', (user_id, *SYNC_TABLES))
+            purge('main')
+            if source is not None:
+                db.execute('DELETE FROM main.users WHERE id = ?', (user_id,)) # the mirror; auth stays in the main DB
+            if target is None:
+                db.execute(f'DELETE FROM {meta}.user_shards WHERE user_id = ?', (user_id,))
+            else:
+                db.execute(f'INSERT OR REPLACE INTO {meta}.user_shards (user_id, shard) VALUES (?, ?)', (user_id, target))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    finally:
+        db.close()
+    return moved
+
+
+def renumber_moved_rows(db, user_id, target, label):
+    """Fill temp.id_map with new ids for the user's rows outside the target's range.
+
+    Runs inside move_user_data's transaction, with the source as `main` and
+    the target attached as `dst`.
+    """
+    start, end = shard_id_range(target)
+    counters = dict(db.execute('SELECT name, seq FROM dst.sqlite_sequence').fetchall())
+    tables = [t for t in SHARDED_TABLES
+              if any(c[1] == 'id' and c[5] for c in db.execute(f'PRAGMA dst.table_info({t})'))]
+    stray = [t for t in tables if not start <= counters.get(t, start) < end
+             or (db.execute(f'SELECT MAX(id) FROM dst.{t}').fetchone()[0] or start) >= end]
+    if stray:
+        raise click.ClickException(f'{label} already has ids outside its range ({", ".join(stray)}); '
+                                   f'refusing to move user {user_id}')
+
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS id_map (tbl TEXT, old INTEGER, new INTEGER, PRIMARY KEY (tbl, old))')
+    db.execute('DELETE FROM temp.id_map')
+    last = {}
+    for table in tables:
+        counter = SHARD_ID_COUNTERS.get(table, table)
+        if counter not in last:
+            last[counter] = max([counters.get(counter, start)] + [
+                db.execute(f'SELECT MAX(id) FROM dst.{t} WHERE id >= ? AND id < ?', (start, end)).fetchone()[0] or start
+                for t in tables if SHARD_ID_COUNTERS.get(t, t) == counter])
+        old_ids = [r[0] for r in db.execute(f'SELECT id FROM main.{table} WHERE user_id = ? AND NOT (id >= ? AND id < ?) '
+                                            'ORDER BY id', (user_id, start, end))]
+        new_ids = range(last[counter] + 1, last[counter] + 1 + len(old_ids))
+        db.executemany('INSERT INTO temp.id_map (tbl, old, new) VALUES (?, ?, ?)',
+                       [(table, old, new) for old, new in zip(old_ids, new_ids)])
+        last[counter] += len(old_ids)
+    for counter, seq in last.items():
+        if db.execute('UPDATE dst.sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (seq, counter)).rowcount == 0:
+            db.execute('INSERT INTO dst.sqlite_sequence (name, seq) VALUES (?, ?)', (counter, seq))
+
+
+@db_cli.command('rebalance')
+@click.option('--shards', type=int, default=None, help='Shard count to balance for (defaults to DB_SHARDS; 0 moves everyone back to the main DB).')
+@click.option('--dry-run', is_flag=True, help='Only report which users would move.')
+def db_rebalance(shards, dry_run):
+    """Move users whose data is not on shard user_id % N."""
+    shards = DB_SHARDS if shards is None else shards
+    db = connect_db(DATABASE)
+    try:
+        placement = {r[0]: None for r in db.execute('SELECT id FROM users')}
+        placement.update(db.execute('SELECT user_id, shard FROM user_shards').fetchall())
+    finally:
+        db.close()
+    moves = [(uid, cur, uid % shards if shards else None) for uid, cur in sorted(placement.items())]
+    moves = [m for m in moves if m[1] != m[2]]
+    for uid, cur, target in moves:
+        label = lambda s: 'main' if s is None else f'shard {s}'
+        if dry_run:
+            click.echo(f'user {uid}: {label(cur)} -> {label(target)}')
+            continue
+        rows = move_user_data(uid, cur, target)
+        click.echo(f'user {uid}: {label(cur)} -> {label(target)} ({rows} rows)')
+    click.echo(f'{len(moves)} user(s) {"to move" if dry_run else "moved"}.')
+
+
+@db_cli.command('shards')
+def db_shards():
+    """Users, sessions and file size per database."""
+    for path in database_paths():
+        db = sqlite3.connect(path)
+        try:
+            ensure_schema(db, path)
+            users = db.execute('SELECT COUNT(DISTINCT user_id) FROM user_profile').fetchone()[0]
+            sessions = db.execute('SELECT COUNT(*) FROM study_sessions').fetchone()[0]
+        finally:
+            db.close()
+        click.echo(f'{os.path.basename(path):<20} {users:>6} users {sessions:>9} sessions {os.path.getsize(path) / 1e6:>8.1f}MB')
+
+
+@app.cli.command('precompute-suggestions')
+def precompute_suggestions_command():
+    """Nightly job: evaluate the suggestion rules for all users in one batch per database."""
+    start = time.perf_counter()
+    count = 0
+    for path in database_paths():
+        db = connect_db(path)
+        try:
+            count += precompute_suggestions(db)
+        finally:
+            db.close()
+    click.echo(f'Precomputed suggestions for {count} users in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+
+@app.cli.command('advance-reviews')
+def advance_reviews_command():
+    """Daily job: lapse overdue spaced-repetition reviews for all users."""
+    count = 0
+    for path in database_paths():
+        db = connect_db(path)
+        try:
+            count += advance_reviews(db)
+        finally:
+            db.close()
+    click.echo(f'Lapsed {count} overdue reviews')
+
+
+@app.cli.command('archive-sessions')
+@click.option('--days', type=int, default=None, help=f'Archive sessions older than this (default ARCHIVE_AFTER_DAYS, min {ARCHIVE_MIN_DAYS}).')
+def archive_sessions_command(days):
+    """Nightly job: fold old sessions into rollups and move them to the archive table."""
+    start = time.perf_counter()
+    moved = 0
+    for path in database_paths():
+        db = connect_db(path)
+        try:
+            moved += archive_sessions(db, days)
+        finally:
+            db.close()
+    click.echo(f'Archived {moved} sessions in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+
+@app.cli.command('export-data')
+@click.option('--user-id', type=int, default=None, help='Export one user; omit for every user.')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--table', type=click.Choice(EXPORT_TABLES), default=None, help='Required for csv.')
+@click.option('--output', type=click.File('w'), default='-')
+def export_data_command(user_id, fmt, table, output):
+    """Stream an export to a file without loading it into memory."""
+    if fmt == 'csv' and not table:
+        raise click.UsageError('--table is required for csv')
+    if user_id is None:
+        paths = database_paths()
+        if fmt == 'csv' and len(paths) > 1:
+            raise click.UsageError('--user-id is required for csv exports of a sharded database')
+    else:
+        db = connect_db(DATABASE)
+        paths = [shard_path(user_shard(db, user_id))]
+        db.close()
+    for path in paths:
+        db = sqlite3.connect(path)
+        try:
+            for chunk in iter_export(db, (table,) if table else EXPORT_TABLES, fmt, user_id):
+                output.write(chunk)
+        finally:
+            db.close()
+
+
+@app.cli.command('import-data')
+@click.argument('source', type=click.File('r'))
+@click.option('--user-id', type=int, required=True, help='User that will own the imported rows.')
+@click.option('--table', type=click.Choice(EXPORT_TABLES), default=None, help='Treat SOURCE as CSV for this table.')
+def import_data_command(source, user_id, table):
+    """Import an NDJSON (or single-table CSV) export for a user."""
+    db = connect_db(DATABASE)
+    shard = user_shard(db, user_id)
+    if shard is not None:
+        db.close()
+        db = open_shard(shard)
+    try:
+        records = csv_records(table, source) if table else ndjson_records(source)
+        counts, errors, skipped = import_records(db, user_id, records)
+    finally:
+        db.close()
+    click.echo('Imported ' + ', '.join(f'{n} {t}' for t, n in counts.items()))
+    for error in errors + skipped:
+        click.echo(f'line {error["line"]}: {error["error"]}', err=True)
+
+
+@app.cli.command('snapshot-sessions')
+@click.option('--out', default=None, help='Snapshot directory (defaults to ANALYTICS_DIR).')
+def snapshot_sessions_command(out):
+    """Batch job: snapshot study_sessions into monthly columnar partitions."""
+    # Read-only connections; in WAL mode these never block the app's writers
+    dbs = [sqlite3.connect(f'file:{path}?mode=ro', uri=True) for path in database_paths()]
+    try:
+        start = time.perf_counter()
+        count = snapshot_sessions(dbs, out)
+    finally:
+        for db in dbs:
+            db.close()
+    click.echo(f'Snapshotted {count} sessions in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+
+@app.cli.command('report')
+@click.option('--root', default=None, help='Snapshot directory (defaults to ANALYTICS_DIR).')
+@click.option('--from', 'start', default=None, help='First month, YYYY-MM.')
+@click.option('--to', 'end', default=None, help='Last month, YYYY-MM.')
+def report_command(root, start, end):
+    """Cohort analytics from the snapshot files (never touches the live DB)."""
+    click.echo(json.dumps(cohort_report(root, start, end), indent=2))
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Minify, fingerprint and precompress static assets into static/dist."""
+    for name, built in build_assets().items():
+        raw = os.path.getsize(os.path.join(STATIC_DIR, name))
+        path = os.path.join(STATIC_DIR, built)
+        sizes = [f'{os.path.getsize(path)} min']
+        sizes += [f'{os.path.getsize(path + ext)} {ext[1:]}' for ext in ('.gz', '.br') if os.path.exists(path + ext)]
+        click.echo(f'{name} -> {built}: {raw} bytes -> ' + ', '.join(sizes))
+
+
+@app.cli.command('bench-planner')
+@click.option('--tasks', 'task_count', default=200, help='Pending tasks to schedule.')
+@click.option('--runs', default=20, help='Timed repetitions.')
+def bench_planner(task_count, runs):
+    """Time generate_study_plan on a synthetic worst case (every hour free, no daily cap)."""
+    import random
+
+    rng = random.Random(42)
+    today = datetime.now().date()
+    tasks = [{
+        'id': i, 'title': f'Task {i}', 'subject_id': i % 8, 'priority': rng.choice(list(PRIORITY_WEIGHT)),
+        'deadline': (today + timedelta(days=rng.randint(-1, 14))).strftime('%Y-%m-%d') if rng.random() < 0.8 else None,
+    } for i in range(task_count)]
+    deficits = {s: (f'Subject {s}', rng.uniform(0, 6)) for s in range(8)}
+    now = datetime.now().replace(hour=0)
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        blocks, unscheduled = generate_study_plan(tasks, deficits, set(), now, free_hours=(0, 24), max_hours_per_day=24)
+        timings.append((time.perf_counter() - start) * 1000)
+    click.echo(f'{task_count} tasks x {PLAN_DAYS} days x 24 hours: best {min(timings):.1f}ms, '
+               f'median {sorted(timings)[len(timings) // 2]:.1f}ms '
+               f'({len(blocks)} blocks, {len(unscheduled)} unscheduled)')
+
+
+@app.cli.command('bench-json')
+@click.option('--rows', 'row_count', default=10000, help='Tasks and notes to seed.')
+@click.option('--runs', default=10, help='Timed repetitions per variant.')
+def bench_json(row_count, runs):
+    """Compare the old dict(row) + jsonify path with rows_response and each available encoder.
+
+    Runs the api_get_tasks / api_get_notes queries directly, so every variant
+    encodes the same cursor rows.
+    """
+    import gzip
+    import tracemalloc
+
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    migrate_db(db)
+    db.execute("INSERT INTO users (id, email, name) VALUES (1, 'bench@example.com', 'Bench')")
+    db.executemany('INSERT INTO subjects (user_id, name) VALUES (1, ?)', [(f'Subject {i}',) for i in range(8)])
+    db.executemany('INSERT INTO tasks (user_id, subject_id, title, description, priority, deadline) VALUES (1, ?, ?, ?, ?, ?)',
+                   [(i % 8 + 1, f'Task {i}', 'Read chapter and do the exercises ' * 2, ('high', 'medium', 'low')[i % 3],
+                     f'2026-{i % 12 + 1:02d}-{i % 28 + 1:02d}') for i in range(row_count)])
+    db.executemany('INSERT INTO notes (user_id, subject_id, title, content) VALUES (1, ?, ?, ?)',
+                   [(i % 8 + 1, f'Note {i}', 'Key idea: ' + 'lorem ipsum dolor sit amet ' * 8) for i in range(row_count)])
+    db.commit()
+
+    queries = {
+        'tasks': '''SELECT t.*, s.name as subject_name, s.color as subject_color
+                    FROM tasks t LEFT JOIN subjects s ON t.subject_id = s.id WHERE t.user_id = 1
+                    ORDER BY CASE status WHEN 'pending' THEN 0 ELSE 1 END,
+                             CASE priority WHEN 'high' THEN 0 WHEN 'medium' THEN 1 ELSE 2 END, deadline''',
+        'notes': '''SELECT n.*, s.name as subject_name, s.color as subject_color
+                    FROM notes n LEFT JOIN subjects s ON n.subject_id = s.id
+                    WHERE n.user_id = 1 ORDER BY n.updated_at DESC''',
+    }
+    encoders = {'stdlib json': stdlib_dumps}
+    if default_encoder() is not stdlib_dumps:
+        encoders['orjson'] = default_encoder()
+    variants = [('dict(row) + jsonify', lambda cursor: jsonify([dict(r) for r in cursor.fetchall()]), '')]
+    for name, encode in encoders.items():
+        respond = lambda cursor, encode=encode: rows_response(cursor, encode)
+        variants += [(f'rows, {name}', respond, ''), (f'columns, {name}', respond, '?shape=columns')]
+
+    click.echo(f'{row_count} rows per query, best of {runs}')
+    for table, sql in queries.items():
+        for label, respond, query in variants:
+            with app.test_request_context('/' + query):
+                cpu = []
+                for _ in range(runs):
+                    start = time.process_time()
+                    body = respond(db.execute(sql)).get_data()
+                    cpu.append((time.process_time() - start) * 1000)
+                tracemalloc.start()
+                respond(db.execute(sql))
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            click.echo(f'  {table:<6} {label:<22} cpu {min(cpu):6.1f}ms  '
+                       f'peak alloc {peak / 1e6:5.1f}MB  body {len(body) / 1e6:.2f}MB '
+                       f'(gzip {len(gzip.compress(body, JSON_GZIP_LEVEL)) / 1e6:.2f}MB)')
+    db.close()
+
+
+# Modules that must stay off the import path of app.py; they are loaded on
+# first use by get_google(), call_groq_rest() and the features that need them.
+LAZY_MODULES = ('authlib', 'dotenv', 'urllib.request', 'gzip', 'mmap', 'queue', 'zoneinfo', 'orjson')
+# Cold-start budget for what app.py adds on top of Flask itself
+STARTUP_BUDGET_MS = 100.0
+
+
+def measure_startup():
+    """Import app in a fresh interpreter: (framework ms, app.py ms, lazy modules that got imported)."""
+    import subprocess
+
+    probe = (
+        'import sys, time; t = time.perf_counter(); '
+        'import click, flask, flask_login, werkzeug.security; f = time.perf_counter(); import app; '
+        'print((f - t) * 1000); print((time.perf_counter() - f) * 1000); '
+        f'print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+    )
+    env = dict(os.environ)
+    env.pop('GROQ_API_KEY', None)
+    # Time the import a deployed worker does, from cached bytecode rather than recompiling app.py
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    out = subprocess.run([sys.executable, '-c', probe], cwd=BASE_DIR, env=env,
+                         capture_output=True, text=True, check=True).stdout.split('\n')
+    return float(out[0]), float(out[1]), [m for m in out[2].split(',') if m]
+
+
+@app.cli.command('bench-startup')
+@click.option('--runs', default=5, help='Fresh interpreters to sample.')
+@click.option('--budget-ms', default=STARTUP_BUDGET_MS, help='Fail if the best app.py import exceeds this.')
+def bench_startup(runs, budget_ms):
+    """Measure cold `import app` time and enforce the startup budget.
+
+    The budget covers app.py's own import on top of Flask, Flask-Login and
+    click, which are timed separately since the app cannot make them faster.
+    """
+    measure_startup() # writes the bytecode cache
+    samples = [measure_startup() for _ in range(runs)]
+    framework = min(s[0] for s in samples)
+    timings = sorted(s[1] for s in samples)
+    eager = samples[-1][2]
+
+    best = timings[0]
+    click.echo(f'import app: best {best:.1f}ms, median {timings[len(timings) // 2]:.1f}ms over {runs} runs '
+               f'(+ {framework:.1f}ms for the framework)')
+    if eager:
+        raise click.ClickException(f'lazy modules imported at startup: {", ".join(eager)}')
+    if best > budget_ms:
+        raise click.ClickException(f'startup budget exceeded ({best:.1f}ms > {budget_ms:.0f}ms)')
+
+
+# ===================== SERVER =====================
+
+# `python -m app serve` (or `flask serve`) is the production entry point. A master
+# process imports the app, migrates every database and warms the shared caches
+# once, then forks workers that inherit all of it copy-on-write. Each worker
+# runs a threaded Werkzeug server on the shared listening socket and opens its
+# own SQLite connections after the fork.
+#   SIGHUP           reload: re-exec the master on the current code; the new
+#                    workers start serving before the old ones drain
+#   SIGTERM, SIGINT  drain in-flight requests and stop
+# With more than one worker the event broker and AI limiter default to their
+# SQLite backends so events and rate limits hold across processes.
+GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', 30))
+# Idle keep-alive connections are closed after this, which also bounds a drain
+KEEPALIVE_TIMEOUT = 5
+LISTEN_FD_ENV = 'STUDY_PLANNER_LISTEN_FD'
+OLD_WORKERS_ENV = 'STUDY_PLANNER_OLD_WORKERS'
+
+
+def default_workers():
+    """WEB_CONCURRENCY when set, else one worker per core this process may run on."""
+    if os.environ.get('WEB_CONCURRENCY'):
+        return max(1, int(os.environ['WEB_CONCURRENCY']))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # macOS
+        return os.cpu_count() or 1
+
+
+def preload_app():
+    """Master-side warm-up, done once and shared by every worker through fork."""
+    init_db()
+    for path in database_paths()[1:]:
+        connect_db(path).close() # migrate shards now rather than on a first request
+    app.url_map.update()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    asset_manifest()
+    # Lazy for serverless cold starts; a long-lived server pays for them once here
+    if os.environ.get('GOOGLE_CLIENT_ID'):
+        get_google()
+    if ai_client_active:
+        import urllib.request
+
+
+def warm_worker():
+    """Worker-side warm-up after fork: SQLite connections can't be inherited."""
+    if DB_POOL_SIZE:
+        main_pool.warm()
+
+
+def run_worker(listener, access_log, ready_fd):
+    """Body of a forked worker; never returns."""
+    import signal
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class RequestHandler(WSGIRequestHandler):
+        timeout = KEEPALIVE_TIMEOUT
+
+        def end_headers(self):
+            if server_draining.is_set(): # tell keep-alive clients to reconnect elsewhere
+                self.send_header('Connection', 'close')
+            super().end_headers()
+
+        def log_request(self, *args, **kwargs):
+            if access_log:
+                super().log_request(*args, **kwargs)
+
+        def log_error(self, format, *args):
+            if not format.startswith('Request timed out'): # an idle keep-alive connection closing
+                super().log_error(format, *args)
+
+    status = 1
+    try:
+        warm_worker()
+        host, port = listener.getsockname()[:2]
+        server = make_server(host, port, app, threaded=True, request_handler=RequestHandler, fd=listener.fileno())
+
+        def drain(signum, frame):
+            server_draining.set()
+            threading.Thread(target=server.shutdown).start() # shutdown() blocks until serve_forever returns
+
+        signal.signal(signal.SIGTERM, drain)
+        signal.signal(signal.SIGINT, drain)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.pthread_sigmask(signal.SIG_SETMASK, set())
+        os.write(ready_fd, b'.')
+        os.close(ready_fd)
+        server.serve_forever()
+
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while threading.active_count() > 1 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        status = 0
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        os._exit(status) # skip the master's atexit handlers and buffered state
+
+
+def serve(host, port, workers, access_log):
+    """Run the pre-fork master until SIGTERM/SIGINT; SIGHUP re-execs it in place."""
+    import select
+    import signal
+    import socket
+    import subprocess
+
+    if workers > 1:
+        os.environ.setdefault('EVENT_BROKER', 'sqlite')
+        os.environ.setdefault('AI_LIMITER', 'sqlite')
+    preload_app()
+
+    inherited = os.environ.pop(LISTEN_FD_ENV, None)
+    if inherited is not None: # reloaded: keep the socket, so no connection is refused
+        listener = socket.socket(fileno=int(inherited))
+    else:
+        listener = socket.create_server((host, port), backlog=2048)
+    # Workers all accept() on this socket; non-blocking so the losers of a wake-up move on
+    listener.setblocking(False)
+    old_workers = {int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid}
+
+    handled = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD)
+    signal.pthread_sigmask(signal.SIG_BLOCK, handled)
+    worker_pids = set()
+
+    def spawn(count):
+        """Fork `count` workers and wait until each has warmed up and is accepting."""
+        ready_r, ready_w = os.pipe()
+        for _ in range(count):
+            pid = os.fork()
+            if pid == 0:
+                os.close(ready_r)
+                run_worker(listener, access_log, ready_w)
+            worker_pids.add(pid)
+        os.close(ready_w)
+        ready, deadline = 0, time.monotonic() + 60
+        while ready < count and time.monotonic() < deadline:
+            if select.select([ready_r], [], [], 1)[0]:
+                chunk = os.read(ready_r, count)
+                if not chunk: # every worker exited or signalled
+                    break
+                ready += len(chunk)
+        os.close(ready_r)
+        return ready
+
+    def reap():
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            old_workers.discard(pid)
+            if pid in worker_pids:
+                worker_pids.discard(pid)
+                if not stopping:
+                    click.echo(f'[serve] worker {pid} exited with status {status}; starting a replacement', err=True)
+                    spawn(1)
+
+    def terminate(pids):
+        for pid in list(pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    stopping = False
+    ready = spawn(workers)
+    click.echo(f'[serve] http://{host}:{listener.getsockname()[1]} master {os.getpid()}, '
+               f'{ready}/{workers} workers ready, DB pool {DB_POOL_SIZE}')
+    terminate(old_workers) # the previous generation drains now that we are serving
+
+    while True:
+        info = signal.sigtimedwait(handled, 1.0)
+        reap()
+        signum = info.si_signo if info else None
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            stopping = True
+            terminate(worker_pids | old_workers)
+            deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+            while (worker_pids or old_workers) and time.monotonic() < deadline:
+                signal.sigtimedwait([signal.SIGCHLD], 0.2)
+                reap()
+            for pid in worker_pids | old_workers:
+                os.kill(pid, signal.SIGKILL)
+            click.echo('[serve] stopped')
+            return
+        if signum == signal.SIGHUP:
+            # Refuse to reload into code that doesn't import; keep serving the old one
+            check = subprocess.run([sys.executable, '-c', 'import app'], cwd=BASE_DIR,
+                                   capture_output=True, text=True)
+            if check.returncode != 0:
+                click.echo(f'[serve] reload aborted, app failed to import:\n{check.stderr}', err=True)
+                continue
+            click.echo('[serve] reloading')
+            listener.set_inheritable(True)
+            os.environ[LISTEN_FD_ENV] = str(listener.fileno())
+            os.environ[OLD_WORKERS_ENV] = ','.join(map(str, worker_pids | old_workers))
+            # Same pid, so the current workers stay our children and are reaped after the exec
+            os.execv(sys.executable, sys.orig_argv)
+
+
+@app.cli.command('serve', with_appcontext=False)
+@click.option('--host', default='0.0.0.0', show_default=True)
+@click.option('--port', default=int(os.environ.get('PORT', 5001)), show_default=True)
+@click.option('--workers', type=int, default=None, help='Worker processes (default WEB_CONCURRENCY or one per core).')
+@click.option('--pool', type=int, default=None, help='Pooled main-DB connections per worker (default DB_POOL_SIZE or 8).')
+@click.option('--access-log/--no-access-log', default=False, help='Log every request to stderr.')
+def serve_command(host, port, workers, pool, access_log):
+    """Production server: pre-forked, preloaded workers with warm connection pools."""
+    global DB_POOL_SIZE
+    DB_POOL_SIZE = pool if pool is not None else DB_POOL_SIZE or 8
+    serve(host, port, workers or default_workers(), access_log)
+
+
+def _bench_client(args):
+    """One keep-alive connection firing GETs until the deadline; returns (requests, errors)."""
+    import http.client
+
+    port, path, deadline = args
+    done = errors = 0
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    while time.time() < deadline:
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors += 1
+            else:
+                done += 1
+            if response.will_close:
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+    conn.close()
+    return done, errors
+
+
+@app.cli.command('bench-serve', with_appcontext=False)
+@click.option('--seconds', default=5.0, help='Load duration per server and path.')
+@click.option('--concurrency', default=16, help='Concurrent keep-alive client connections.')
+@click.option('--workers', type=int, default=None, help='Workers for the production server.')
+@click.option('--path', 'paths', multiple=True, default=('/api/health', '/login'),
+              help='Paths to load (repeatable). Defaults hit the database and render a template.')
+def bench_serve(seconds, concurrency, workers, paths):
+    """Compare throughput of `app.run(debug=True)` with `serve` on the same machine."""
+    import multiprocessing
+    import signal
+    import socket
+    import subprocess
+    import urllib.request
+
+    def free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    workers = workers or default_workers()
+    servers = (
+        ('dev server (debug)', lambda port: [sys.executable, '-c',
+            f'import app; app.app.run(debug=True, port={port}, use_reloader=False)']),
+        (f'serve, {workers} workers', lambda port: [sys.executable, os.path.join(BASE_DIR, 'app.py'), 'serve',
+            '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers)]),
+    )
+    env = dict(os.environ)
+    env.pop('GROQ_API_KEY', None) # keep the AI out of the measurement
+    env.pop('FLASK_RUN_FROM_CLI', None) # app.run() is a no-op when this is set
+    pool = multiprocessing.get_context('fork').Pool(concurrency)
+    click.echo(f'{concurrency} connections, {seconds:.0f}s per path, {default_workers()} cores')
+    try:
+        for label, command in servers:
+            port = free_port()
+            proc = subprocess.Popen(command(port), cwd=BASE_DIR, env=env,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                for _ in range(100): # wait for the port to answer
+                    try:
+                        urllib.request.urlopen(f'http://127.0.0.1:{port}/api/health', timeout=1).read()
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+                for path in paths:
+                    results = pool.map(_bench_client, [(port, path, time.time() + seconds)] * concurrency)
+                    done = sum(r[0] for r in results)
+                    errors = sum(r[1] for r in results)
+                    click.echo(f'  {label:<22} {path:<14} {done / seconds:8.0f} req/s  ({errors} errors)')
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                proc.wait(timeout=GRACEFUL_TIMEOUT + 10)
+    finally:
+        pool.terminate()
+
+
 # ===================== MAIN =====================
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']: # python -m app serve [--workers N ...]
+        serve_command.main(sys.argv[2:], prog_name='app.py serve')
     init_db()
     print("\n  [*] Smart Study Planner running at http://localhost:5001\n")
     if ai_client_active:
@@ -1126,4 +4440,5 @@ if __name__ == '__main__':
     else:
         print("  [AI] Suggestions: Smart Algorithm Mode")
         print("  [!] Set GROQ_API_KEY env variable for LLaMA AI\n")
+    print("  [*] Development server; for production run: python -m app serve\n")
     app.run(debug=True, port=5001)
@@ -122,27 +122,42 @@ document.addEventListener('DOMContentLoaded', () => {
 });
 
 // ========== GAMIFICATION PROFILE ==========
+function applyProfile(data) {
+    const levelEl = document.getElementById('navLevel');
+    const xpEl = document.getElementById('navXp');
+    const fillEl = document.getElementById('navXpFill');
+
+    if (levelEl) levelEl.textContent = 'Lvl ' + data.level;
+    if (xpEl) xpEl.textContent = data.xp;
+    if (fillEl) {
+        const percentage = ((data.xp % 500) / 500) * 100;
+        fillEl.style.width = percentage + '%';
+    }
+}
+
 window.updateProfile = async function () {
     try {
         const res = await fetch('/api/profile');
         if (!res.ok) return;
         const data = await res.json();
-
-        const levelEl = document.getElementById('navLevel');
-        const xpEl = document.getElementById('navXp');
-        const fillEl = document.getElementById('navXpFill');
-
-        if (levelEl) levelEl.textContent = 'Lvl ' + data.level;
-        if (xpEl) xpEl.textContent = data.xp;
-        if (fillEl) {
-            const percentage = ((data.xp % 500) / 500) * 100;
-            fillEl.style.width = percentage + '%';
-        }
+        applyProfile(data);
+        syncTimezone(data);
     } catch (err) {
         console.error('Failed to update profile', err);
     }
 };
 
+// Stats and streaks are bucketed by the profile's timezone; keep it in step with the browser
+function syncTimezone(profile) {
+    const zone = Intl.DateTimeFormat().resolvedOptions().timeZone;
+    if (!zone || profile.timezone === zone) return;
+    fetch('/api/profile', {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ timezone: zone })
+    }).catch(err => console.error('Failed to sync timezone', err));
+}
+
 // Also globally handle showing earned XP
 window.showXpToast = function (xp) {
     if (xp > 0) {
@@ -156,6 +171,47 @@ document.addEventListener('DOMContentLoaded', () => {
     updateProfile();
 });
 
+// ========== LIVE EVENTS ==========
+// The server pushes deltas (task, session, profile, planner) over SSE. Pages patch
+// their state from their own mutations' responses and from `study:<type>` DOM
+// events (patching by id is idempotent, so seeing a change twice is harmless).
+// After a reconnect they get `study:resync` and reload, in case events were
+// missed while the stream was down or were published by another instance.
+window.studyEvents = { connected: false };
+
+if (window.EventSource) {
+    const source = new EventSource('/api/events');
+    let opened = false;
+    source.onopen = () => {
+        window.studyEvents.connected = true;
+        if (opened) document.dispatchEvent(new CustomEvent('study:resync'));
+        opened = true;
+    };
+    source.onerror = () => { window.studyEvents.connected = false; };
+    // `resync` is sent after bulk changes such as an import
+    ['task', 'session', 'profile', 'planner', 'resync'].forEach(type => {
+        source.addEventListener(type, (e) => {
+            document.dispatchEvent(new CustomEvent('study:' + type, { detail: JSON.parse(e.data) }));
+        });
+    });
+}
+
+document.addEventListener('study:profile', (e) => applyProfile(e.detail));
+document.addEventListener('study:resync', () => updateProfile());
+
+// Replace (or remove, for deleted deltas) the item with the same id in a list
+window.patchById = function (list, item) {
+    const idx = list.findIndex(x => x.id === item.id);
+    if (item.deleted) {
+        if (idx !== -1) list.splice(idx, 1);
+    } else if (idx !== -1) {
+        list[idx] = item;
+    } else {
+        list.push(item);
+    }
+    return list;
+};
+
 // ========== AI CHATBOT ==========
 document.addEventListener('DOMContentLoaded', () => {
     const toggleBtn = document.getElementById('chatbotToggle');
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.pop('GROQ_API_KEY', None) # tests never call the real AI
+
+import app as study_app
+
+
+@pytest.fixture
+def planner(tmp_path, monkeypatch):
+    """The app module pointed at a fresh database in a temp directory."""
+    monkeypatch.setattr(study_app, 'DATABASE', str(tmp_path / 'study_planner.db'))
+    study_app.app.config['TESTING'] = True
+    study_app.init_db()
+    return study_app
+
+
+def register(planner, email='student@example.com'):
+    """Test client logged in as a newly registered user."""
+    client = planner.app.test_client()
+    response = client.post('/register', data={'email': email, 'name': 'Student', 'password': 'secret'})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def client(planner):
+    return register(planner)
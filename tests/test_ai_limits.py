@@ -0,0 +1,36 @@
+import pytest
+
+
+@pytest.fixture(params=['local', 'sqlite'])
+def ai(request, planner, monkeypatch):
+    """Chat with the AI switched on, a one-call bucket and Groq stubbed out."""
+    monkeypatch.setattr(planner, 'ai_client_active', True)
+    monkeypatch.setattr(planner, 'AI_BURST', 1.0)
+    monkeypatch.setattr(planner, 'call_groq_rest', lambda *args, **kwargs: 'Keep going!')
+    monkeypatch.setattr(planner, 'groq_breaker', planner.CircuitBreaker())
+
+    def use_guard(max_concurrent=planner.AI_MAX_CONCURRENT):
+        if request.param == 'local':
+            guard = planner.LocalAIGuard(max_concurrent)
+        else:
+            guard = planner.SQLiteAIGuard(planner.DATABASE, max_concurrent)
+        monkeypatch.setattr(planner, '_ai_guard', guard)
+    use_guard()
+    return use_guard
+
+
+def test_rate_limited_chat_sends_retry_after(client, ai, planner):
+    assert client.post('/api/chat', json={'message': 'hi'}).get_json() == {'reply': 'Keep going!'}
+
+    response = client.post('/api/chat', json={'message': 'hi again'})
+    assert response.status_code == 429
+    assert response.get_json()['limited']
+    # The next token arrives after 60 / AI_RATE_PER_MINUTE seconds
+    assert response.headers['Retry-After'] == str(max(1, round(60 / planner.AI_RATE_PER_MINUTE)))
+
+
+def test_busy_call_slots_send_retry_after(client, ai):
+    ai(max_concurrent=0)
+    response = client.post('/api/chat', json={'message': 'hi'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+TOTALS = ('total_hours', 'sessions_count', 'weekly', 'streak')
+ANALYTICS = ('by_subject', 'by_type', 'by_hour', 'daily_trend')
+
+
+def test_archiving_keeps_stats_and_analytics_totals(client, planner):
+    subject = client.post('/api/subjects', json={'name': 'Biology'}).get_json()['id']
+    client.post('/api/sessions', json={'duration_minutes': 25, 'subject_id': subject})
+    client.post('/api/sessions', json={'duration_minutes': 40, 'session_type': 'pomodoro'})
+
+    db = planner.connect_db(planner.DATABASE)
+    old = [((datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S'), subject_id, minutes, kind)
+           for days, subject_id, minutes, kind in ((200, subject, 50, 'pomodoro'), (300, None, 35, 'manual'),
+                                                   (90, subject, 20, None))]
+    db.executemany('INSERT INTO study_sessions (user_id, created_at, subject_id, duration_minutes, session_type) VALUES (1, ?, ?, ?, ?)', old)
+    db.commit()
+
+    def snapshot():
+        stats = client.get('/api/stats').get_json()
+        analytics = client.get('/api/analytics').get_json()
+        subjects = client.get('/api/subjects').get_json()
+        return ({k: stats[k] for k in TOTALS}, {k: analytics[k] for k in ANALYTICS},
+                [s['total_hours'] for s in subjects])
+
+    before = snapshot()
+    assert before[0]['sessions_count'] == 5
+    assert planner.archive_sessions(db, 60) == 3
+    assert db.execute('SELECT COUNT(*) FROM study_sessions').fetchone()[0] == 2
+    assert snapshot() == before
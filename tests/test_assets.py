@@ -0,0 +1,30 @@
+import shutil
+
+from conftest import register
+
+
+def test_built_assets_cache_headers(planner, tmp_path, monkeypatch):
+    static = tmp_path / 'static'
+    shutil.copytree(planner.STATIC_DIR, static, ignore=shutil.ignore_patterns('dist'))
+    monkeypatch.setattr(planner, 'STATIC_DIR', str(static))
+    manifest = planner.build_assets(str(static))
+    client = register(planner)
+
+    script = client.get(f"/static/{manifest['js/app.js']}", headers={'Accept-Encoding': 'gzip'})
+    assert script.headers['Cache-Control'] == planner.IMMUTABLE_CACHE
+    assert script.headers['Content-Encoding'] == 'gzip'
+    assert script.headers['Vary'] == 'Accept-Encoding'
+    assert 'Set-Cookie' not in script.headers
+
+    listing = client.get('/static/dist/manifest.json')
+    assert listing.headers['Cache-Control'] == 'no-cache'
+    assert listing.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_pages_still_vary_on_cookie(client):
+    assert 'Cookie' in client.get('/tasks').headers['Vary']
+
+
+def test_minify_js_keeps_multiline_template_literals(planner):
+    source = 'function card() {\n    // header\n    return `\n        <div>\n\n        // shown as text\n        </div>`;\n}\n'
+    assert planner.minify_js(source) == 'function card() {\nreturn `\n        <div>\n\n        // shown as text\n        </div>`;\n}\n'
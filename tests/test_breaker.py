@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.fixture
+def clock(planner, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(planner.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_breaker_opens_then_half_opens_after_the_cooldown(planner, clock):
+    breaker = planner.CircuitBreaker(threshold=2, cooldown=30)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure(TimeoutError('timed out'))
+    assert breaker.is_open()
+    assert breaker.snapshot()['state'] == 'open'
+    with pytest.raises(planner.CircuitOpenError):
+        breaker.before_call()
+
+    clock[0] += 30
+    assert breaker.snapshot()['state'] == 'half_open'
+    breaker.before_call() # the single trial call
+    with pytest.raises(planner.CircuitOpenError):
+        breaker.before_call()
+
+    # A failed trial reopens it for a full cooldown, a successful one closes it
+    breaker.record_failure(TimeoutError('timed out'))
+    assert breaker.snapshot() == {'state': 'open', 'failures': 3, 'retry_in': 30.0,
+                                  'last_error': 'TimeoutError: timed out'}
+    clock[0] += 30
+    breaker.before_call()
+    breaker.record_success()
+    assert not breaker.is_open()
+    assert breaker.snapshot()['state'] == 'closed'
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+
+@pytest.fixture(params=['local', 'sqlite'])
+def broker(request, planner, monkeypatch):
+    if request.param == 'local':
+        broker = planner.LocalBroker()
+    else:
+        broker = planner.SQLiteBroker(planner.DATABASE, poll_interval=0.01)
+    monkeypatch.setattr(planner, '_broker', broker)
+    return broker
+
+
+def read_events(client, count, last_id=None):
+    """First `count` events of a fresh /api/events stream, as (id, event, data)."""
+    headers = {'Last-Event-ID': str(last_id)} if last_id is not None else {}
+    response = client.get('/api/events', headers=headers, buffered=False)
+    events = []
+    try:
+        for chunk in response.response:
+            fields = dict(line.split(': ', 1) for line in chunk.decode().strip().split('\n') if ': ' in line)
+            if 'event' in fields:
+                events.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+            if len(events) == count:
+                return events
+    finally:
+        response.close()
+
+
+def test_stream_replays_events_missed_while_disconnected(client, broker):
+    client.post('/api/tasks', json={'title': 'Seen live'})
+    seen = [e for e in read_events(client, 2, last_id=0) if e[1] == 'task']
+    assert seen[0][2]['title'] == 'Seen live'
+
+    # Published while no stream is open
+    client.post('/api/tasks', json={'title': 'Missed'})
+
+    task_events = [e for e in read_events(client, 2, last_id=seen[0][0]) if e[1] == 'task']
+    assert [e[2]['title'] for e in task_events] == ['Missed']
+
+
+def test_mutation_responses_carry_the_changed_row(client):
+    created = client.post('/api/tasks', json={'title': 'Essay'}).get_json()
+    assert created['task']['title'] == 'Essay'
+
+    toggled = client.post(f"/api/tasks/{created['id']}/toggle").get_json()
+    assert toggled['task']['status'] == 'completed'
+
+    session = client.post('/api/sessions', json={'duration_minutes': 25}).get_json()
+    assert session['session']['duration_minutes'] == 25
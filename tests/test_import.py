@@ -0,0 +1,54 @@
+import json
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+
+def export(client):
+    return client.get('/api/export').get_data()
+
+
+def test_importing_an_export_twice_does_not_double_book_the_planner(client):
+    client.post('/api/planner', json={'day_of_week': 1, 'start_hour': 9, 'end_hour': 11})
+    client.post('/api/planner', json={'day_of_week': 1, 'start_hour': 11, 'end_hour': 12})
+    client.post('/api/planner', json={'day_of_week': 4, 'start_hour': 18, 'end_hour': 20})
+    body = export(client)
+
+    for _ in range(2):
+        result = client.post('/api/import', data=body).get_json()
+        assert result['success']
+        assert result['imported']['planner_blocks'] == 0
+        assert len(result['skipped']) == 3
+    assert len(client.get('/api/planner').get_json()) == 3
+
+
+def test_import_keeps_goal_and_streak_counters(client):
+    client.post('/api/goals', json={'title': 'Ten hours', 'target_hours': 10})
+    original = client.post('/api/sessions', json={'duration_minutes': 60}).get_json()['id']
+    body = export(client)
+    # Only the session, so the goal itself isn't imported again
+    sessions = b'\n'.join(line for line in body.splitlines() if json.loads(line)['table'] == 'study_sessions')
+
+    assert client.post('/api/import', data=sessions).get_json()['imported']['study_sessions'] == 1
+    client.delete(f'/api/sessions/{original}')
+
+    goal = client.get('/api/goals').get_json()[0]
+    assert goal['current_hours'] == 1.0
+    assert client.get('/api/profile').get_json()['streak'] == 1
+
+
+def test_import_publishes_a_resync(client, planner, monkeypatch):
+    published = []
+    monkeypatch.setattr(planner, 'publish_event', lambda event, data, user_id=None: published.append(event))
+    client.post('/api/import', data=b'{"table": "tasks", "row": {"title": "Imported"}}\n')
+    assert published == ['resync']
+
+
+def test_imported_notes_come_due_tomorrow_in_the_users_zone(client, planner):
+    client.put('/api/profile', json={'timezone': 'Pacific/Kiritimati'})
+    body = b'{"table": "notes", "row": {"title": "Cells", "updated_at": "2020-01-01 00:00:00"}}\n'
+    assert client.post('/api/import', data=body).get_json()['imported']['notes'] == 1
+
+    db = planner.connect_db(planner.DATABASE)
+    due, updated = db.execute('SELECT r.due_date, n.updated_at FROM note_reviews r JOIN notes n ON n.id = r.note_id').fetchone()
+    assert due == (datetime.now(ZoneInfo('Pacific/Kiritimati')).date() + timedelta(days=1)).isoformat()
+    assert updated > '2020-01-01 00:00:00' # stamped on insert, so sync clients pull it
@@ -0,0 +1,19 @@
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.mark.parametrize('query', ['', '?shape=columns'])
+def test_rows_response_encoders_agree(planner, query):
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE t (id INTEGER, name TEXT, score REAL)')
+    db.executemany('INSERT INTO t VALUES (?, ?, ?)', [(1, 'ä', 1.5), (2, None, 0.0)])
+
+    bodies = []
+    for encode in (None, planner.stdlib_dumps):
+        with planner.app.test_request_context('/' + query):
+            bodies.append(json.loads(planner.rows_response(db.execute('SELECT * FROM t'), encode).get_data()))
+    assert bodies[0] == bodies[1]
+    assert bodies[0] == ({'columns': ['id', 'name', 'score'], 'rows': [[1, 'ä', 1.5], [2, None, 0.0]]} if query
+                         else [{'id': 1, 'name': 'ä', 'score': 1.5}, {'id': 2, 'name': None, 'score': 0.0}])
@@ -0,0 +1,79 @@
+import pytest
+
+
+@pytest.mark.parametrize('body', [
+    {'free_end': 30},
+    {'free_start': 20, 'free_end': 8},
+    {'free_start': 'eight'},
+    {'free_start': -1},
+    {'max_hours_per_day': 0},
+    {'max_hours_per_day': None},
+])
+def test_generate_rejects_bad_parameters(client, body):
+    response = client.post('/api/planner/generate', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_generate_publishes_new_and_replaced_blocks(client, planner, monkeypatch):
+    client.post('/api/tasks', json={'title': 'Revise algebra', 'priority': 'high'})
+    published = []
+    monkeypatch.setattr(planner, 'publish_event', lambda event, data, user_id=None: published.append((event, data)))
+
+    first = client.post('/api/planner/generate', json={'free_start': 8, 'free_end': 22}).get_json()
+    assert first['blocks']
+    assert [d['id'] for e, d in published if e == 'planner'] == [b['id'] for b in first['blocks']]
+
+    published.clear()
+    second = client.post('/api/planner/generate', json={'free_start': 8, 'free_end': 22}).get_json()
+    deleted = {d['id'] for e, d in published if e == 'planner' and d.get('deleted')}
+    assert deleted == {b['id'] for b in first['blocks']}
+    assert {d['id'] for e, d in published if e == 'planner' and not d.get('deleted')} == {b['id'] for b in second['blocks']}
+
+
+def add_block(client, day, start, end):
+    return client.post('/api/planner', json={'day_of_week': day, 'start_hour': start, 'end_hour': end})
+
+
+def test_overlapping_block_is_rejected_with_409(client):
+    first = add_block(client, 2, 9, 11).get_json()['id']
+    response = add_block(client, 2, 10, 12)
+    assert response.status_code == 409
+    assert response.get_json()['conflicts'] == [first]
+    # Touching blocks and other days are fine
+    assert add_block(client, 2, 11, 12).status_code == 200
+    assert add_block(client, 3, 9, 11).status_code == 200
+    assert len(client.get('/api/planner').get_json()) == 3
+
+
+def test_bulk_move_is_all_or_nothing_on_overlap(client):
+    a = add_block(client, 1, 8, 9).get_json()['id']
+    b = add_block(client, 1, 10, 11).get_json()['id']
+    c = add_block(client, 1, 14, 16).get_json()['id']
+
+    # Swapping a and b is allowed since moved blocks are lifted out first
+    swap = client.patch('/api/planner/bulk', json={'moves': [{'id': a, 'start_hour': 10}, {'id': b, 'start_hour': 8}]})
+    assert swap.status_code == 200
+
+    clash = client.patch('/api/planner/bulk', json={'moves': [{'id': a, 'start_hour': 12}, {'id': b, 'start_hour': 15}]})
+    assert clash.status_code == 409
+    assert clash.get_json()['conflicts'] == [c]
+    starts = {blk['id']: blk['start_hour'] for blk in client.get('/api/planner').get_json()}
+    assert starts == {a: 10, b: 8, c: 14}
+
+
+@pytest.mark.parametrize('body', [
+    {'moves': 'all'},
+    {'moves': [1]},
+    {'moves': [{'id': 1, 'start_hour': '9'}]},
+])
+def test_bulk_move_rejects_malformed_moves(client, body):
+    add_block(client, 1, 8, 9)
+    assert client.patch('/api/planner/bulk', json=body).status_code == 400
+
+
+@pytest.mark.parametrize('ids', [[[1], [2]], 'all', [1, '2']])
+def test_merge_rejects_malformed_ids(client, ids):
+    add_block(client, 1, 8, 9)
+    add_block(client, 1, 9, 10)
+    assert client.post('/api/planner/merge', json={'ids': ids}).status_code == 400
@@ -0,0 +1,20 @@
+import pytest
+
+
+def test_lapsed_review_comes_due_the_next_day(client, planner):
+    note = client.post('/api/notes', json={'title': 'Cells'}).get_json()['id']
+    db = planner.connect_db(planner.DATABASE)
+    db.execute("UPDATE note_reviews SET repetitions = 3, interval_days = 6, ease = 2.5, due_date = '2026-01-01'")
+    db.commit()
+
+    assert planner.advance_reviews(db, today='2026-01-10') == 1
+    review = db.execute('SELECT repetitions, interval_days, ease, due_date FROM note_reviews WHERE note_id = ?', (note,)).fetchone()
+    assert tuple(review) == (0, 1, 2.3, '2026-01-11')
+    # Not overdue any more, so the next run leaves it alone
+    assert planner.advance_reviews(db, today='2026-01-11') == 0
+
+
+@pytest.mark.parametrize('quality', [True, False, '4', 6, -1])
+def test_grade_rejects_non_integer_quality(client, quality):
+    note = client.post('/api/notes', json={'title': 'Cells'}).get_json()['id']
+    assert client.post(f'/api/reviews/{note}', json={'quality': quality}).status_code == 400
@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+from conftest import register
+
+
+@pytest.fixture
+def sharded(planner, tmp_path, monkeypatch):
+    monkeypatch.setattr(planner, 'DB_SHARDS', 2)
+    monkeypatch.setattr(planner, 'SHARD_DIR', str(tmp_path / 'shards'))
+    monkeypatch.setattr(planner, 'shard_pool', planner.ShardPool())
+    return planner
+
+
+@pytest.mark.parametrize('fresh_pool', [False, True])
+def test_reads_go_through_while_a_writer_holds_the_shard(sharded, monkeypatch, fresh_pool):
+    client = register(sharded)
+    client.post('/api/tasks', json={'title': 'Essay'})
+    if fresh_pool: # a worker that has not opened the shard yet
+        monkeypatch.setattr(sharded, 'shard_pool', sharded.ShardPool())
+
+    writer = sqlite3.connect(sharded.shard_path(1), timeout=0)
+    writer.execute('BEGIN IMMEDIATE')
+    try:
+        response = client.get('/api/tasks')
+    finally:
+        writer.rollback()
+        writer.close()
+    assert response.status_code == 200
+    assert [t['title'] for t in response.get_json()] == ['Essay']
+
+
+def test_moving_back_to_main_keeps_main_in_its_id_range(sharded, monkeypatch):
+    client = register(sharded)
+    subject = client.post('/api/subjects', json={'name': 'Bio'}).get_json()['id']
+    task = client.post('/api/tasks', json={'title': 'Essay', 'subject_id': subject}).get_json()['id']
+    assert task >= sharded.SHARD_ID_SPAN
+    token = client.get('/api/sync?since=0').get_json()['token']
+
+    sharded.move_user_data(1, 1, None)
+    monkeypatch.setattr(sharded, 'DB_SHARDS', 0)
+    tasks = client.get('/api/tasks').get_json()
+    assert tasks[0]['id'] < sharded.SHARD_ID_SPAN
+    assert tasks[0]['subject_name'] == 'Bio'
+    assert client.post('/api/tasks', json={'title': 'Next'}).get_json()['id'] < sharded.SHARD_ID_SPAN
+
+    # Offline clients drop the old id and pull the renumbered row
+    assert task in client.get(f'/api/sync?since={token}').get_json()['deleted']['tasks']
@@ -0,0 +1,8 @@
+import app
+
+
+def test_import_stays_lazy_and_within_budget():
+    app.measure_startup() # writes the bytecode cache
+    samples = [app.measure_startup() for _ in range(3)]
+    assert samples[-1][2] == [], 'lazy modules imported at startup'
+    assert min(s[1] for s in samples) < app.STARTUP_BUDGET_MS
@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta, timezone
+
+
+def streak(client):
+    profile = client.get('/api/profile').get_json()
+    return profile['streak'], profile['longest_streak']
+
+
+def test_deleting_a_session_keeps_the_streak_while_its_day_has_another(client, planner):
+    client.post('/api/goals', json={'title': 'Revise', 'target_hours': 10})
+    first = client.post('/api/sessions', json={'duration_minutes': 30}).get_json()['id']
+    second = client.post('/api/sessions', json={'duration_minutes': 30}).get_json()['id']
+    yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime('%Y-%m-%d 12:00:00')
+    db = planner.connect_db(planner.DATABASE)
+    db.execute('INSERT INTO study_sessions (user_id, duration_minutes, created_at) VALUES (1, 30, ?)', (yesterday,))
+    planner.recompute_streak(db, 1)
+    db.commit()
+    assert streak(client) == (2, 2)
+
+    client.delete(f'/api/sessions/{first}')
+    assert streak(client) == (2, 2)
+    hours = db.execute('SELECT current_hours FROM goals').fetchone()[0]
+    assert hours == 0.5
+
+    # The last session of the day does take the day out of the streak
+    client.delete(f'/api/sessions/{second}')
+    assert streak(client) == (1, 1)
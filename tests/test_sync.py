@@ -0,0 +1,12 @@
+def test_sync_returns_tombstones_for_rows_deleted_since_the_token(client):
+    kept = client.post('/api/tasks', json={'title': 'Essay'}).get_json()['id']
+    gone = client.post('/api/tasks', json={'title': 'Lab report'}).get_json()['id']
+    first = client.get('/api/sync').get_json()
+    assert first['reset'] and {t['id'] for t in first['changes']['tasks']} == {kept, gone}
+
+    client.delete(f'/api/tasks/{gone}')
+    delta = client.get('/api/sync', query_string={'since': first['token']}).get_json()
+    assert not delta['reset']
+    assert delta['deleted']['tasks'] == [gone]
+    assert gone not in [t['id'] for t in delta['changes']['tasks']]
+    assert delta['token'] >= first['token']
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from conftest import register
+
+EAST = 'Pacific/Kiritimati' # UTC+14
+WEST = 'Pacific/Pago_Pago'  # UTC-11
+
+
+def test_batch_features_use_each_users_zone(planner):
+    for email, zone in (('east@example.com', EAST), ('west@example.com', WEST)):
+        client = register(planner, email)
+        assert client.put('/api/profile', json={'timezone': zone}).status_code == 200
+        client.post('/api/tasks', json={'title': 'Essay', 'deadline': '2026-01-03'})
+    db = planner.connect_db(planner.DATABASE)
+
+    now = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+    columns = planner.batch_suggestion_features(db, now)
+    # 02:00 on Jan 2 in Kiritimati, 01:00 on Jan 1 in Pago Pago
+    assert columns['hour'] == [2, 1]
+    assert columns['urgent_days'] == [1, 2]
+
+
+def test_review_due_dates_follow_the_users_zone(planner):
+    client = register(planner)
+    client.put('/api/profile', json={'timezone': EAST})
+    client.post('/api/notes', json={'title': 'Cells'})
+
+    db = planner.connect_db(planner.DATABASE)
+    due = db.execute('SELECT due_date FROM note_reviews').fetchone()[0]
+    assert due == (datetime.now(ZoneInfo(EAST)).date() + timedelta(days=1)).isoformat()
+
+
+def test_streak_dates_sessions_with_their_own_utc_offset(planner):
+    client = register(planner)
+    client.put('/api/profile', json={'timezone': 'America/New_York'})
+    db = planner.connect_db(planner.DATABASE)
+    # 10:00 and 23:30 on Feb 28 in New York (UTC-5 then, UTC-4 for half the year)
+    db.executemany("INSERT INTO study_sessions (user_id, duration_minutes, created_at) VALUES (1, 30, ?)",
+                   [('2026-02-28 15:00:00',), ('2026-03-01 04:30:00',)])
+    planner.recompute_streak(db, 1)
+    profile = db.execute('SELECT current_streak, longest_streak, last_study_day FROM user_profile WHERE user_id = 1').fetchone()
+    assert tuple(profile) == (1, 1, '2026-02-28')